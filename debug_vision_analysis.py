@@ -1,15 +1,23 @@
 import asyncio
 import os
 from vision_service import VisionService
+from services.shared.database import DatabaseManager
+from services.shared.perceptual_hash import PerceptualHashIndex
 import sqlite3
 from datetime import datetime, timedelta
 
+DB_PATH = '/data/speciesid.db'
+
+def make_vision_service():
+    """A VisionService whose duplicate index reads the same database."""
+    return VisionService(DB_PATH, phash_index=PerceptualHashIndex(database=DatabaseManager(DB_PATH)))
+
 async def test_vision_analysis():
     """Test the OpenAI Vision integration with sample images."""
-    vision_service = VisionService()
+    vision_service = make_vision_service()
     
     # Get some recent detections to analyze
-    conn = sqlite3.connect('/data/speciesid.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
@@ -71,10 +79,10 @@ async def test_vision_analysis():
 
 async def test_batch_processing():
     """Test batch processing with cost limits."""
-    vision_service = VisionService()
+    vision_service = make_vision_service()
     
     # Get a batch of detections
-    conn = sqlite3.connect('/data/speciesid.db')
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
     try:
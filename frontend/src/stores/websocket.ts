@@ -13,12 +13,29 @@ export const useWebSocketStore = defineStore('websocket', () => {
   let pingInterval: number | undefined
   let reconnectTimeout: number | undefined
   let notificationId = 0
+  // Topics to receive, e.g. ['detection', 'camera:feeder'], or null for everything
+  let topics: string[] | null = null
+  // Position in the server's message log, used to resume after a reconnect
+  let epoch: string | null = null
+  let lastSeq: number | null = null
+  // The server collects messages for this many ms and sends them as one array frame
+  const batchWindowMs = 100
+  // Set when messages were missed and REST data should be refetched
+  const lastResync = ref<number | null>(null)
 
   const isConnected = computed(() => status.value.isConnected)
   const activeConnections = computed(() => status.value.connections)
 
   function connect() {
-    const wsUrl = `ws://${window.location.host}/ws`
+    const params = new URLSearchParams({ batch: String(batchWindowMs) })
+    if (epoch !== null && lastSeq !== null) {
+      params.set('since', String(lastSeq))
+      params.set('epoch', epoch)
+    }
+    if (topics) {
+      params.set('topics', topics.join(','))
+    }
+    const wsUrl = `ws://${window.location.host}/ws?${params.toString()}`
     ws.value = new WebSocket(wsUrl)
 
     ws.value.onopen = () => {
@@ -34,16 +51,46 @@ export const useWebSocketStore = defineStore('websocket', () => {
 
     ws.value.onmessage = (event) => {
       try {
-        const message = JSON.parse(event.data)
-        handleMessage(message)
+        const data = JSON.parse(event.data)
+        handleMessages(Array.isArray(data) ? data : [data])
       } catch (error) {
         console.error('Error parsing message:', error)
       }
     }
   }
 
+  function handleMessages(messages: any[]) {
+    // A burst of detections becomes one notification instead of one each
+    const detections = messages.filter(m => m.type === 'detection')
+    for (const message of messages) {
+      if (message.type !== 'detection' || detections.length === 1) {
+        handleMessage(message)
+      } else if (typeof message.seq === 'number') {
+        lastSeq = Math.max(lastSeq ?? 0, message.seq)
+      }
+    }
+    if (detections.length > 1) {
+      addNotification({
+        message: `${detections.length} new detections: ${[...new Set(detections.map(m => m.data.common_name))].join(', ')}`,
+        type: 'info'
+      })
+    }
+  }
+
   function handleMessage(message: any) {
+    if (message.type !== 'hello' && typeof message.seq === 'number') {
+      lastSeq = Math.max(lastSeq ?? 0, message.seq)
+    }
     switch (message.type) {
+      case 'hello':
+        // Missed messages follow the hello, so after them we are caught up to its seq.
+        // resync means they could not be replayed (server restart or too long offline).
+        if (message.resync) {
+          lastResync.value = Date.now()
+        }
+        epoch = message.epoch
+        lastSeq = message.seq
+        break
       case 'status':
         status.value.connections = message.data.connections
         break
@@ -53,18 +100,52 @@ export const useWebSocketStore = defineStore('websocket', () => {
           type: 'info'
         })
         break
+      case 'special':
+        addNotification({
+          message: `Special detection: ${message.data.common_name}`,
+          type: 'success'
+        })
+        break
+      case 'error':
+        console.error('WebSocket server error:', message.error)
+        break
+      case 'enhancement':
+        if (message.data.status === 'completed' && message.data.enhanced) {
+          addNotification({
+            message: `Enhanced image ready for detection ${message.data.detection_id}`,
+            type: 'success'
+          })
+        } else if (message.data.status === 'failed') {
+          addNotification({
+            message: `Enhancement failed for detection ${message.data.detection_id}`,
+            type: 'error'
+          })
+        }
+        break
       case 'pong':
         status.value.lastPing = Date.now()
         break
     }
   }
 
+  function sendControl(message: Record<string, unknown>) {
+    if (ws.value?.readyState === WebSocket.OPEN) {
+      ws.value.send(JSON.stringify(message))
+    }
+  }
+
+  function subscribe(newTopics: string[] | null) {
+    if (topics) {
+      sendControl({ type: 'unsubscribe', topics })
+    }
+    topics = newTopics
+    sendControl({ type: 'subscribe', topics: topics ?? ['*'] })
+  }
+
   function startPingInterval() {
     clearPingInterval()
     pingInterval = window.setInterval(() => {
-      if (ws.value?.readyState === WebSocket.OPEN) {
-        ws.value.send(JSON.stringify({ type: 'ping' }))
-      }
+      sendControl({ type: 'ping' })
     }, 30000)
   }
 
@@ -115,10 +196,12 @@ export const useWebSocketStore = defineStore('websocket', () => {
   return {
     status,
     notifications,
+    lastResync,
     isConnected,
     activeConnections,
     connect,
     disconnect,
+    subscribe,
     addNotification,
     removeNotification
   }
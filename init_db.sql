@@ -21,10 +21,21 @@ CREATE TABLE IF NOT EXISTS image_quality (
     enhancement_status TEXT CHECK(enhancement_status IN ('pending', 'completed', 'failed')),
     quality_improvement REAL,
     visibility_score REAL,
+    image_hash TEXT,
+    quality_scores TEXT,  -- JSON of every score the quality model returned
+    enhanced_quality_scores TEXT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (detection_id) REFERENCES detections(id)
 );
 
+-- Fused top-k classification across all frames of each Frigate event
+CREATE TABLE IF NOT EXISTS event_classifications (
+    frigate_event TEXT PRIMARY KEY,
+    frames INTEGER NOT NULL,
+    top_k TEXT NOT NULL,  -- JSON list of {index, display_name, score, votes}
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
 CREATE TABLE IF NOT EXISTS birdnames (
     scientific_name TEXT PRIMARY KEY,
     common_name TEXT NOT NULL,
@@ -16,6 +16,9 @@ CREATE TABLE image_quality (
     enhancement_status TEXT CHECK(enhancement_status IN ('pending', 'completed', 'failed')),
     quality_improvement REAL,
     visibility_score REAL,
+    image_hash TEXT,
+    quality_scores TEXT,
+    enhanced_quality_scores TEXT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (detection_id) REFERENCES detections(id)
 );
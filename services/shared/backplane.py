@@ -0,0 +1,215 @@
+import asyncio
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from sqlalchemy import text
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (seq, topics, message with its seq) as kept in the websocket server's history
+Entry = Tuple[int, Set[str], str]
+Deliver = Callable[[int, Set[str], str], Awaitable[None]]
+ConnectionCount = Callable[[], int]
+
+def with_seq(payload: str, seq: int) -> str:
+    """Splice a sequence number into a serialized JSON object before its closing brace."""
+    body = payload.rstrip()[:-1].rstrip()
+    separator = ', ' if body != '{' else ''
+    return f'{body}{separator}"seq": {seq}}}'
+
+
+class InProcessBackplane:
+    """Numbers messages and hands them straight to this process's clients.
+
+    Only correct with a single server process; use SQLiteBackplane for more.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._deliver: Optional[Deliver] = None
+        self._connections: Optional[ConnectionCount] = None
+
+    async def start(self, deliver: Deliver, connections: ConnectionCount) -> List[Entry]:
+        """Start delivering published messages to ``deliver``.
+
+        ``connections`` returns this worker's client count. Returns the recent
+        history to seed replay with.
+        """
+        self._deliver = deliver
+        self._connections = connections
+        return []
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, payload: str, topics: Set[str]) -> int:
+        """Publish a serialized JSON object to every worker. Returns its sequence number."""
+        self.seq += 1
+        await self._deliver(self.seq, topics, with_seq(payload, self.seq))
+        return self.seq
+
+    async def stats(self) -> Dict:
+        """Worker and connection counts across all workers."""
+        return {"workers": 1, "connections": self._connections()}
+
+
+class SQLiteBackplane:
+    """Shares published messages between server processes through the SQLite database.
+
+    Publishing appends a row to websocket_messages, whose AUTOINCREMENT key is
+    the sequence number, so every worker agrees on the numbering. Each worker
+    polls for rows past the last one it delivered and sends them to its own
+    clients, including the messages it published itself. The last
+    ``history_size`` rows are kept, so replay also works across restarts and
+    the epoch only changes when the table is recreated.
+
+    Every worker records its connection count in websocket_workers each
+    ``heartbeat_interval`` seconds. Rows older than three heartbeats are
+    treated as dead workers and left out of the totals.
+    """
+
+    def __init__(self, poll_interval: float = 0.05, history_size: int = 500,
+                 heartbeat_interval: float = 5.0):
+        from .database import db
+        self.db = db
+        self.poll_interval = poll_interval
+        self.history_size = history_size
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.epoch = None
+        self.seq = 0
+        self._deliver: Optional[Deliver] = None
+        self._connections: Optional[ConnectionCount] = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+
+    async def start(self, deliver: Deliver, connections: ConnectionCount) -> List[Entry]:
+        self._deliver = deliver
+        self._connections = connections
+        self.epoch, history = await asyncio.to_thread(self.db.execute_write, self._setup)
+        self.seq = history[-1][0] if history else 0
+        self._task = asyncio.create_task(self._poll())
+        logger.info(f"SQLite backplane started for worker {self.worker_id} at seq {self.seq}")
+        return history
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        def do_delete(session):
+            session.execute(text("DELETE FROM websocket_workers WHERE worker_id = :worker_id"),
+                            {"worker_id": self.worker_id})
+        await asyncio.to_thread(self.db.execute_write, do_delete)
+
+    async def publish(self, payload: str, topics: Set[str]) -> int:
+        def do_insert(session):
+            seq = session.execute(text("""
+                INSERT INTO websocket_messages (topics, payload) VALUES (:topics, :payload)
+                RETURNING seq
+            """), {"topics": ','.join(sorted(topics)), "payload": payload}).scalar()
+            session.execute(text("DELETE FROM websocket_messages WHERE seq <= :oldest"),
+                            {"oldest": seq - self.history_size})
+            return seq
+        seq = await asyncio.to_thread(self.db.execute_write, do_insert)
+        # Deliver locally without waiting for the next poll
+        self._wakeup.set()
+        return seq
+
+    async def stats(self) -> Dict:
+        def do_query(session):
+            return session.execute(text("""
+                SELECT COUNT(*), COALESCE(SUM(connections), 0) FROM websocket_workers
+                WHERE worker_id != :worker_id AND updated_at > :cutoff
+            """), {"worker_id": self.worker_id,
+                   "cutoff": time.time() - 3 * self.heartbeat_interval}).fetchone()
+        workers, others = await asyncio.to_thread(self.db.execute_read, do_query)
+        return {"workers": workers + 1, "connections": self._connections() + others}
+
+    def _setup(self, session) -> Tuple[str, List[Entry]]:
+        session.execute(text("""
+            CREATE TABLE IF NOT EXISTS websocket_messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                topics TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        session.execute(text("""
+            CREATE TABLE IF NOT EXISTS websocket_workers (
+                worker_id TEXT PRIMARY KEY,
+                connections INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+        """))
+        # One row holding the epoch shared by all workers
+        session.execute(text("""
+            CREATE TABLE IF NOT EXISTS websocket_epoch (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                epoch TEXT NOT NULL
+            )
+        """))
+        session.execute(text("INSERT OR IGNORE INTO websocket_epoch (id, epoch) VALUES (1, :epoch)"),
+                        {"epoch": uuid.uuid4().hex[:8]})
+        epoch = session.execute(text("SELECT epoch FROM websocket_epoch WHERE id = 1")).scalar()
+        self._heartbeat(session)
+        rows = session.execute(text("""
+            SELECT seq, topics, payload FROM websocket_messages
+            ORDER BY seq DESC LIMIT :limit
+        """), {"limit": self.history_size}).fetchall()
+        return epoch, [self._entry(row) for row in reversed(rows)]
+
+    def _heartbeat(self, session) -> None:
+        session.execute(text("""
+            INSERT INTO websocket_workers (worker_id, connections, updated_at)
+            VALUES (:worker_id, :connections, :updated_at)
+            ON CONFLICT(worker_id) DO UPDATE SET
+                connections = excluded.connections,
+                updated_at = excluded.updated_at
+        """), {"worker_id": self.worker_id, "connections": self._connections(), "updated_at": time.time()})
+
+    def _fetch(self, session, since: int) -> List[Entry]:
+        rows = session.execute(text("""
+            SELECT seq, topics, payload FROM websocket_messages
+            WHERE seq > :since ORDER BY seq
+        """), {"since": since}).fetchall()
+        return [self._entry(row) for row in rows]
+
+    @staticmethod
+    def _entry(row) -> Entry:
+        seq, topics, payload = row
+        return seq, {t for t in topics.split(',') if t}, with_seq(payload, seq)
+
+    async def _poll(self) -> None:
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # SQLite commits writes one at a time, so rows appear in seq order
+                for seq, topics, message in await asyncio.to_thread(self.db.execute_read, self._fetch, self.seq):
+                    self.seq = seq
+                    await self._deliver(seq, topics, message)
+                if time.monotonic() >= next_heartbeat:
+                    await asyncio.to_thread(self.db.execute_write, self._heartbeat)
+                    next_heartbeat = time.monotonic() + self.heartbeat_interval
+            except Exception as e:
+                logger.error(f"Backplane poll failed: {e}")
+
+
+BACKPLANES = {
+    'memory': InProcessBackplane,
+    'sqlite': SQLiteBackplane,
+}
+
+def create_backplane(name: str = 'memory', **kwargs):
+    """Build a backplane by name, falling back to the in-process one for unknown names."""
+    if name not in BACKPLANES:
+        logger.warning(f"Unknown websocket backplane '{name}', using 'memory'")
+        name = 'memory'
+    return BACKPLANES[name](**kwargs)
@@ -3,19 +3,26 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.pool import QueuePool
 from contextlib import contextmanager
 import os
+from typing import Optional
+
+DEFAULT_DB_PATH = os.path.join('/data', 'speciesid.db')
 
 class DatabaseManager:
     _instance = None
     
-    def __new__(cls):
+    def __new__(cls, db_path: Optional[str] = None):
+        """The shared manager for /data/speciesid.db, or a separate one for another ``db_path``."""
+        if db_path is not None and os.path.abspath(db_path) != DEFAULT_DB_PATH:
+            instance = super(DatabaseManager, cls).__new__(cls)
+            instance._initialize(db_path)
+            return instance
         if cls._instance is None:
             cls._instance = super(DatabaseManager, cls).__new__(cls)
-            cls._instance._initialize()
+            cls._instance._initialize(DEFAULT_DB_PATH)
         return cls._instance
     
-    def _initialize(self):
+    def _initialize(self, db_path: str):
         """Initialize the database connection pool"""
-        db_path = os.path.join('/data', 'speciesid.db')
         
         # Create engine with connection pooling
         self.engine = create_engine(
@@ -49,6 +56,17 @@ class DatabaseManager:
         finally:
             session.close()
     
+    @contextmanager
+    def snapshot(self):
+        """Provide a session whose reads all see one consistent database snapshot.
+
+        pysqlite does not open a transaction for SELECTs on its own, so each query
+        would otherwise see whatever was committed in between.
+        """
+        with self.session() as session:
+            session.connection().exec_driver_sql("BEGIN")
+            yield session
+    
     def execute_write(self, operation, *args, **kwargs):
         """Execute a write operation within a transaction"""
         with self.session() as session:
@@ -58,6 +76,11 @@ class DatabaseManager:
         """Execute a read operation"""
         with self.session() as session:
             return operation(session, *args, **kwargs)
+    
+    def execute_snapshot(self, operation, *args, **kwargs):
+        """Execute several reads against a single transaction snapshot"""
+        with self.snapshot() as session:
+            return operation(session, *args, **kwargs)
 
 # Global instance
 db = DatabaseManager()
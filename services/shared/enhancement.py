@@ -0,0 +1,220 @@
+import math
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+class EnhancementError(Exception):
+    """Enhancement did not produce an image: the backend failed or the queue was full."""
+
+
+class RealESRGANEnhancer:
+    """RealESRGAN x4 upscaler running in-process with PyTorch.
+
+    The model is loaded once and reused for every image. With ``tile`` > 0 the
+    image is processed in overlapping tiles, which keeps memory bounded on CPU.
+    """
+
+    def __init__(self, model_path: str, scale: int = 4, tile: int = 256, tile_pad: int = 10,
+                 threads: Optional[int] = None):
+        # Imported here so the stub and docker backends work without torch installed
+        import torch
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+
+        self.torch = torch
+        self.scale = scale
+        self.tile = tile
+        self.tile_pad = tile_pad
+        if threads:
+            torch.set_num_threads(threads)
+
+        self.model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23,
+                             num_grow_ch=32, scale=scale)
+        state = torch.load(model_path, map_location='cpu')
+        self.model.load_state_dict(state.get('params_ema', state.get('params', state)), strict=True)
+        self.model.eval()
+        logger.info(f"Loaded RealESRGAN model from {model_path} (tile={tile})")
+
+    def enhance(self, image: np.ndarray) -> np.ndarray:
+        """Upscale a BGR uint8 image."""
+        torch = self.torch
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+        tensor = torch.from_numpy(np.transpose(rgb, (2, 0, 1))).unsqueeze(0)
+
+        with torch.no_grad():
+            if self.tile > 0:
+                output = self._infer_tiled(tensor)
+            else:
+                output = self.model(tensor)
+
+        output = output.squeeze(0).clamp_(0, 1).numpy()
+        output = (np.transpose(output, (1, 2, 0)) * 255.0).round().astype(np.uint8)
+        return cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
+
+    def _infer_tiled(self, tensor):
+        """Run the model tile by tile, cropping the padded borders off each result."""
+        _, channels, height, width = tensor.shape
+        scale = self.scale
+        output = tensor.new_zeros((1, channels, height * scale, width * scale))
+
+        for tile_y in range(math.ceil(height / self.tile)):
+            for tile_x in range(math.ceil(width / self.tile)):
+                # Tile area in the input, and the same area with padding for context
+                x0, y0 = tile_x * self.tile, tile_y * self.tile
+                x1, y1 = min(x0 + self.tile, width), min(y0 + self.tile, height)
+                px0, py0 = max(x0 - self.tile_pad, 0), max(y0 - self.tile_pad, 0)
+                px1, py1 = min(x1 + self.tile_pad, width), min(y1 + self.tile_pad, height)
+
+                result = self.model(tensor[:, :, py0:py1, px0:px1])
+
+                # Drop the padding from the upscaled tile
+                ox0, oy0 = (x0 - px0) * scale, (y0 - py0) * scale
+                ox1, oy1 = ox0 + (x1 - x0) * scale, oy0 + (y1 - y0) * scale
+                output[:, :, y0 * scale:y1 * scale, x0 * scale:x1 * scale] = result[:, :, oy0:oy1, ox0:ox1]
+
+        return output
+
+
+class DockerRealESRGANEnhancer:
+    """RealESRGAN through the kociolek/real-esrgan container.
+
+    Used when the model weights or PyTorch are not available. Every job runs in
+    its own temporary input/output directories so concurrent jobs cannot clobber
+    each other's files.
+    """
+
+    def __init__(self, image: str = 'docker.io/kociolek/real-esrgan', work_dir: Optional[str] = None):
+        self.image = image
+        self.work_dir = work_dir
+
+    def enhance(self, image: np.ndarray) -> np.ndarray:
+        job_dir = tempfile.mkdtemp(prefix='enhance-', dir=self.work_dir)
+        input_dir = os.path.join(job_dir, 'input')
+        output_dir = os.path.join(job_dir, 'output')
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+        try:
+            cv2.imwrite(os.path.join(input_dir, 'image.png'), image)
+            cmd = [
+                'docker', 'run', '--rm',
+                '-v', f"{input_dir}:/app/input",
+                '-v', f"{output_dir}:/app/output",
+                self.image
+            ]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"Enhancement failed: {result.stderr}")
+
+            enhanced = cv2.imread(os.path.join(output_dir, 'image_out.png'))
+            if enhanced is None:
+                raise ValueError("Could not read enhanced image")
+            return enhanced
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+class StubEnhancer:
+    """Bicubic upscale with light sharpening, for tests and machines without a model."""
+
+    def __init__(self, scale: int = 4):
+        self.scale = scale
+
+    def enhance(self, image: np.ndarray) -> np.ndarray:
+        upscaled = cv2.resize(image, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_CUBIC)
+        blurred = cv2.GaussianBlur(upscaled, (0, 0), 1.0)
+        return cv2.addWeighted(upscaled, 1.5, blurred, -0.5, 0)
+
+
+class EnhancementWorker:
+    """Long-lived worker threads that run enhancement jobs from a bounded queue.
+
+    The backend is created once and shared by the workers, so model load cost
+    is paid at startup rather than per image. ``submit`` raises ``queue.Full``
+    when the queue is at capacity instead of piling up work. ``enhance`` raises
+    ``EnhancementError`` for both that and backend failures.
+    """
+
+    def __init__(self, backend, workers: int = 1, queue_size: int = 8):
+        self.backend = backend
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f"enhancement-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, image: np.ndarray) -> Future:
+        """Queue an image for enhancement and return a future for the result."""
+        future = Future()
+        self._jobs.put_nowait((image, future))
+        return future
+
+    def enhance(self, image: np.ndarray, timeout: Optional[float] = None) -> np.ndarray:
+        """Enhance an image and wait for the result."""
+        try:
+            return self.submit(image).result(timeout=timeout)
+        except queue.Full:
+            raise EnhancementError("Enhancement queue is full")
+        except Exception as e:
+            raise EnhancementError(f"Enhancement error: {e}") from e
+
+    def queue_depth(self) -> int:
+        return self._jobs.qsize()
+
+    def shutdown(self) -> None:
+        for _ in self._threads:
+            self._jobs.put((None, None))
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            image, future = self._jobs.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.backend.enhance(image))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def create_enhancer(config: Dict) -> EnhancementWorker:
+    """Build the enhancement worker described by image_processing.local_models.enhancement."""
+    settings = config.get('image_processing', {}).get('local_models', {}).get('enhancement', {})
+    enhancer_type = settings.get('type', 'real-esrgan')
+    workers = settings.get('workers', 1)
+    queue_size = settings.get('queue_size', 8)
+
+    if enhancer_type == 'stub':
+        backend = StubEnhancer()
+    elif enhancer_type == 'real-esrgan':
+        model_path = settings.get('model_path', 'models/enhancement/RealESRGAN_x4plus/RealESRGAN_x4plus.pth')
+        backend = None
+        if os.path.exists(model_path):
+            try:
+                backend = RealESRGANEnhancer(
+                    model_path,
+                    tile=settings.get('tile', 256),
+                    threads=settings.get('threads')
+                )
+            except ImportError as e:
+                logger.warning(f"PyTorch RealESRGAN unavailable ({e}), falling back to docker")
+        else:
+            logger.warning(f"RealESRGAN weights not found at {model_path}, falling back to docker")
+        if backend is None:
+            backend = DockerRealESRGANEnhancer()
+    else:
+        raise ValueError(f"Unknown enhancement type: {enhancer_type}")
+
+    return EnhancementWorker(backend, workers=workers, queue_size=queue_size)
@@ -0,0 +1,271 @@
+import threading
+from typing import Dict, List, Optional
+from sqlalchemy import text
+from .database import db
+from .notifications import NotificationPublisher
+import logging
+
+logger = logging.getLogger(__name__)
+
+class EnhancementJobQueue:
+    """Durable queue of image enhancement jobs stored in SQLite.
+
+    Jobs live in the enhancement_jobs table, so queued work survives a restart.
+    image_quality.enhancement_status mirrors each detection's state: 'pending'
+    while a job is queued or running, then 'completed' or 'failed'. Background
+    workers claim the highest-priority job atomically and retry failures with
+    exponential backoff. Progress is published to websocket clients through
+    ``publisher``, when one is given.
+    """
+
+    def __init__(self, processor, frigate_url: str, workers: int = 2, max_attempts: int = 3,
+                 retry_delay: int = 30, publisher: Optional[NotificationPublisher] = None,
+                 poll_interval: float = 5.0, database=None):
+        self.processor = processor
+        # The shared database unless another is given, e.g. in tests
+        self.db = database or db
+        self.frigate_url = frigate_url
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.publisher = publisher
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._setup_database()
+
+    def _setup_database(self) -> None:
+        def do_setup(session):
+            session.execute(text("""
+                CREATE TABLE IF NOT EXISTS enhancement_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    detection_id INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending'
+                        CHECK(status IN ('pending', 'processing', 'completed', 'failed')),
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 3,
+                    available_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    error TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (detection_id) REFERENCES detections(id)
+                )
+            """))
+            # Workers pick the next job with this index
+            session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_enhancement_jobs_next
+                ON enhancement_jobs(status, priority DESC, id)
+            """))
+            session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_enhancement_jobs_detection
+                ON enhancement_jobs(detection_id, status)
+            """))
+
+        self.db.execute_write(do_setup)
+
+    def start(self) -> None:
+        """Requeue jobs interrupted by a restart and start the worker threads."""
+        def do_recover(session):
+            return session.execute(text("""
+                UPDATE enhancement_jobs
+                SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+                WHERE status = 'processing'
+            """)).rowcount
+
+        recovered = self.db.execute_write(do_recover)
+        if recovered:
+            logger.info(f"Requeued {recovered} interrupted enhancement jobs")
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"enhancement-job-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def enqueue(self, detection_id: int, priority: int = 0) -> int:
+        """Queue a detection for enhancement and return the job id.
+
+        A detection that already has a queued or running job keeps that job,
+        raised to the higher of the two priorities.
+        """
+        def do_enqueue(session):
+            existing = session.execute(text("""
+                SELECT id FROM enhancement_jobs
+                WHERE detection_id = :detection_id AND status IN ('pending', 'processing')
+                ORDER BY id DESC LIMIT 1
+            """), {"detection_id": detection_id}).scalar()
+            if existing:
+                session.execute(text("""
+                    UPDATE enhancement_jobs SET priority = MAX(priority, :priority)
+                    WHERE id = :id
+                """), {"id": existing, "priority": priority})
+                return existing, False
+
+            job_id = session.execute(text("""
+                INSERT INTO enhancement_jobs (detection_id, priority, max_attempts)
+                VALUES (:detection_id, :priority, :max_attempts)
+            """), {"detection_id": detection_id, "priority": priority,
+                   "max_attempts": self.max_attempts}).lastrowid
+            self._set_quality_status(session, detection_id, 'pending')
+            return job_id, True
+
+        job_id, created = self.db.execute_write(do_enqueue)
+        if created:
+            self._notify(job_id, detection_id, 'queued')
+        self._wakeup.set()
+        return job_id
+
+    def enqueue_many(self, detection_ids: List[int], priority: int = 0) -> List[int]:
+        return [self.enqueue(detection_id, priority) for detection_id in detection_ids]
+
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        def do_query(session):
+            row = session.execute(text("""
+                SELECT j.id, j.detection_id, j.status, j.priority, j.attempts, j.max_attempts,
+                    j.error, j.created_at, j.updated_at,
+                    iq.enhanced_path, iq.enhanced_thumbnail_path, iq.quality_improvement
+                FROM enhancement_jobs j
+                LEFT JOIN image_quality iq ON iq.detection_id = j.detection_id
+                WHERE j.id = :id
+            """), {"id": job_id}).fetchone()
+            return dict(row._mapping) if row else None
+
+        return self.db.execute_read(do_query)
+
+    def _set_quality_status(self, session, detection_id: int, status: str) -> None:
+        session.execute(text("""
+            INSERT INTO image_quality (detection_id, enhancement_status)
+            VALUES (:id, :status)
+            ON CONFLICT(detection_id) DO UPDATE SET enhancement_status = excluded.enhancement_status
+        """), {"id": detection_id, "status": status})
+
+    def _claim(self) -> Optional[Dict]:
+        """Atomically mark the next runnable job as processing and return it."""
+        def do_claim(session):
+            row = session.execute(text("""
+                UPDATE enhancement_jobs
+                SET status = 'processing', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT id FROM enhancement_jobs
+                    WHERE status = 'pending' AND available_at <= CURRENT_TIMESTAMP
+                    ORDER BY priority DESC, id
+                    LIMIT 1
+                )
+                RETURNING id, detection_id, attempts, max_attempts
+            """)).fetchone()
+            return dict(row._mapping) if row else None
+
+        return self.db.execute_write(do_claim)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming enhancement job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._process(job)
+
+    def _process(self, job: Dict) -> None:
+        job_id, detection_id = job['id'], job['detection_id']
+        self._notify(job_id, detection_id, 'processing', attempt=job['attempts'])
+        try:
+            frigate_event = self.db.execute_read(lambda session: session.execute(
+                text("SELECT frigate_event FROM detections WHERE id = :id"), {"id": detection_id}
+            ).scalar())
+            if frigate_event is None:
+                raise ValueError("Detection not found")
+
+            image_path = f"{self.frigate_url}/api/events/{frigate_event}/snapshot.jpg"
+            # Enhancement failures raise here so the job is retried or failed
+            result = self.processor.process_image(image_path, detection_id, raise_enhancement_errors=True)
+            self._complete(job_id, detection_id, result)
+            self._notify(job_id, detection_id, 'completed',
+                         enhanced=result['enhanced'], enhanced_path=result['enhanced_path'])
+        except Exception as e:
+            logger.error(f"Enhancement job {job_id} failed: {e}")
+            final = job['attempts'] >= job['max_attempts']
+            self._fail(job_id, detection_id, str(e), final, job['attempts'])
+            self._notify(job_id, detection_id, 'failed' if final else 'retrying',
+                         attempt=job['attempts'], error=str(e))
+
+    def _complete(self, job_id: int, detection_id: int, result: Dict) -> None:
+        scores = result['quality_scores']
+
+        def do_complete(session):
+            session.execute(text("""
+                INSERT INTO image_quality (
+                    detection_id, clarity_score, composition_score, enhanced_path,
+                    enhanced_thumbnail_path, enhancement_status, quality_improvement
+                ) VALUES (:id, :clarity, :composition, :path, :thumb, 'completed', :improvement)
+                ON CONFLICT(detection_id) DO UPDATE SET
+                    clarity_score = COALESCE(image_quality.clarity_score, excluded.clarity_score),
+                    composition_score = COALESCE(image_quality.composition_score, excluded.composition_score),
+                    enhanced_path = excluded.enhanced_path,
+                    enhanced_thumbnail_path = excluded.enhanced_thumbnail_path,
+                    enhancement_status = 'completed',
+                    quality_improvement = excluded.quality_improvement
+            """), {
+                "id": detection_id,
+                "clarity": float(scores['clarity']),
+                "composition": float(scores['composition']),
+                "path": result['enhanced_path'],
+                "thumb": result['enhanced_thumbnail_path'],
+                "improvement": result.get('quality_improvement')
+            })
+            session.execute(text("""
+                UPDATE enhancement_jobs
+                SET status = 'completed', error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = :id
+            """), {"id": job_id})
+
+        self.db.execute_write(do_complete)
+
+    def _fail(self, job_id: int, detection_id: int, error: str, final: bool, attempts: int) -> None:
+        def do_fail(session):
+            if final:
+                session.execute(text("""
+                    UPDATE enhancement_jobs
+                    SET status = 'failed', error = :error, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = :id
+                """), {"id": job_id, "error": error})
+                self._set_quality_status(session, detection_id, 'failed')
+            else:
+                # Back off exponentially before the next attempt
+                session.execute(text("""
+                    UPDATE enhancement_jobs
+                    SET status = 'pending', error = :error, updated_at = CURRENT_TIMESTAMP,
+                        available_at = datetime('now', '+' || :delay || ' seconds')
+                    WHERE id = :id
+                """), {"id": job_id, "error": error, "delay": self.retry_delay * 2 ** (attempts - 1)})
+
+        try:
+            self.db.execute_write(do_fail)
+        except Exception as e:
+            logger.error(f"Error recording failure of enhancement job {job_id}: {e}")
+
+    def _notify(self, job_id: int, detection_id: int, status: str, **extra) -> None:
+        """Push job progress to websocket clients. Failures are logged and ignored."""
+        if self.publisher is None:
+            return
+        message = {
+            "type": "enhancement",
+            "data": {"job_id": job_id, "detection_id": detection_id, "status": status, **extra}
+        }
+        try:
+            self.publisher.publish(message)
+        except Exception as e:
+            logger.debug(f"Enhancement progress notification failed: {e}")
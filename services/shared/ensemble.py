@@ -0,0 +1,115 @@
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence
+from .inference import Category
+
+@dataclass
+class FusedCategory:
+    """A class's evidence across all frames of an event."""
+    index: int
+    display_name: str
+    category_name: str
+    score: float  # geometric mean probability across frames
+    votes: int    # frames where this class was the top result
+
+    def to_dict(self) -> Dict:
+        return {
+            'index': self.index,
+            'display_name': self.display_name,
+            'score': round(self.score, 4),
+            'votes': self.votes
+        }
+
+
+@dataclass
+class _EventState:
+    frames: int = 0
+    # Per class, the sum of (log p - log floor) over the frames where it was in the top-k
+    log_prob: Dict[int, float] = field(default_factory=dict)
+    # Sum of the log floor probability assumed for classes outside each frame's top-k
+    floor_log_prob: float = 0.0
+    votes: Dict[int, int] = field(default_factory=dict)
+    names: Dict[int, Category] = field(default_factory=dict)
+
+
+class EventEnsemble:
+    """Fuses top-k classifications of every frame of a Frigate event.
+
+    Each class is ranked by its mean log-probability over the event's frames.
+    When a class is outside a frame's top-k, its probability in that frame is
+    taken as the leftover probability mass spread evenly over the classes
+    that were not returned, capped at the lowest top-k score. Only the top-k
+    of each frame is stored, so each event costs O(frames x k) memory at most.
+    Events are forgotten with ``finish`` or, past ``max_events``, least
+    recently updated first.
+    """
+
+    def __init__(self, num_classes: int, max_events: int = 256):
+        self.num_classes = num_classes
+        self.max_events = max_events
+        self._events: 'OrderedDict[str, _EventState]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, event_id: str, categories: Sequence[Category]) -> List[FusedCategory]:
+        """Add one frame's top-k categories and return the fused ranking."""
+        with self._lock:
+            state = self._events.get(event_id)
+            if state is None:
+                state = self._events[event_id] = _EventState()
+            self._events.move_to_end(event_id)
+            while len(self._events) > self.max_events:
+                self._events.popitem(last=False)
+
+            if categories:
+                remaining = max(0.0, 1.0 - sum(c.score for c in categories))
+                others = max(1, self.num_classes - len(categories))
+                floor = min(remaining / others, min(c.score for c in categories))
+                floor_log = math.log(max(floor, 1e-6))
+
+                state.frames += 1
+                state.floor_log_prob += floor_log
+                for c in categories:
+                    state.log_prob[c.index] = (state.log_prob.get(c.index, 0.0)
+                                               + math.log(max(c.score, 1e-6)) - floor_log)
+                    state.names[c.index] = c
+                top = categories[0].index
+                state.votes[top] = state.votes.get(top, 0) + 1
+
+            return self._ranking(state)
+
+    def ranking(self, event_id: str) -> List[FusedCategory]:
+        with self._lock:
+            state = self._events.get(event_id)
+            return self._ranking(state) if state else []
+
+    def frames(self, event_id: str) -> int:
+        with self._lock:
+            state = self._events.get(event_id)
+            return state.frames if state else 0
+
+    def finish(self, event_id: str) -> None:
+        """Forget an event once Frigate reports it has ended."""
+        with self._lock:
+            self._events.pop(event_id, None)
+
+    def _ranking(self, state: _EventState) -> List[FusedCategory]:
+        # Caller must hold self._lock
+        if not state.frames:
+            return []
+        fused = []
+        for index, extra in state.log_prob.items():
+            # log_prob holds each class's excess over that frame's floor, so adding
+            # every frame's floor gives the class's total log-probability
+            mean_log_prob = (state.floor_log_prob + extra) / state.frames
+            category = state.names[index]
+            fused.append(FusedCategory(
+                index=index,
+                display_name=category.display_name,
+                category_name=category.category_name,
+                score=math.exp(mean_log_prob),
+                votes=state.votes.get(index, 0)
+            ))
+        fused.sort(key=lambda c: (c.score, c.votes), reverse=True)
+        return fused
@@ -0,0 +1,53 @@
+import hashlib
+from io import BytesIO
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+from PIL import Image
+
+class DecodedFrame:
+    """An encoded snapshot decoded once, at reduced size when that is enough.
+
+    With ``draft_size`` set, JPEGs are decoded with libjpeg's DCT scaling straight
+    to the smallest 1/2, 1/4 or 1/8 scale that is still at least that size on both
+    sides, which is much cheaper than decoding full resolution and resizing.
+    ``rgb`` is the decoded image as a read-only RGB array.
+    """
+
+    def __init__(self, content: bytes, draft_size: Optional[int] = None):
+        self.content = content
+        self.draft_size = draft_size
+        self._hash = None
+
+        image = Image.open(BytesIO(content))
+        if draft_size:
+            image.draft('RGB', (draft_size, draft_size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        self.rgb = np.asarray(image)
+        self.rgb.flags.writeable = False
+
+    @classmethod
+    def from_file(cls, path: str, draft_size: Optional[int] = None) -> 'DecodedFrame':
+        with open(path, 'rb') as f:
+            return cls(f.read(), draft_size)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.rgb.shape
+
+    @property
+    def hash(self) -> str:
+        """SHA-1 of the encoded bytes, used as a content cache key."""
+        if self._hash is None:
+            self._hash = hashlib.sha1(self.content).hexdigest()
+        return self._hash
+
+    def full_resolution_bgr(self) -> np.ndarray:
+        """Decode the original bytes at full size in BGR, for enhancement and saving."""
+        if not self.draft_size:
+            return cv2.cvtColor(self.rgb, cv2.COLOR_RGB2BGR)
+        image = cv2.imdecode(np.frombuffer(self.content, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image")
+        return image
@@ -1,117 +1,153 @@
+import json
 import os
+import threading
+from collections import OrderedDict
 import cv2
-import numpy as np
 import requests
-import subprocess
 import yaml
-from typing import Dict
+from datetime import timedelta
+from typing import Dict, Optional
+from sqlalchemy import text
+from .database import db
+from .enhancement import EnhancementError, create_enhancer
+from .frame import DecodedFrame
+from .perceptual_hash import PerceptualHashIndex, dhash
+from .quality import DEFAULT_ANALYSIS_SIZE, create_quality_model
 import logging
 
 logger = logging.getLogger(__name__)
 
+class QualityCache:
+    """Size-bounded, thread-safe LRU cache of processing results."""
+
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result: Dict) -> None:
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
 class ImageProcessingService:
-    def __init__(self, config_path):
+    def __init__(self, config_path, database=None):
+        # The shared database unless another is given, e.g. in tests
+        self.db = database or db
+        
         # Load config from file
         with open(config_path, 'r') as f:
             self.config = yaml.safe_load(f)
             
-        # Basic quality model that uses clarity threshold from config
-        self.quality_model = self.BasicQualityModel(
-            self.config['image_processing']['local_models']['quality_assessment']['threshold']
-        )
-        
-        # Docker-based enhancer using real-esrgan
-        self.enhancer = self.RealESRGANEnhancer()
-        self._cache = {}
-
-    class BasicQualityModel:
-        def __init__(self, threshold):
-            self.threshold = threshold
-            
-        def assess_quality(self, image: np.ndarray) -> Dict[str, float]:
-            """Basic quality assessment using image statistics."""
-            # Convert to grayscale for analysis
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            
-            # Calculate clarity score using Laplacian variance (focus measure)
-            laplacian = cv2.Laplacian(gray, cv2.CV_64F)
-            clarity = np.var(laplacian) / 10000  # Normalize to roughly 0-1 range
-            
-            # Calculate composition score using rule of thirds
-            height, width = gray.shape
-            center_roi = gray[height//3:2*height//3, width//3:2*width//3]
-            composition = np.mean(center_roi) / 255  # Normalize to 0-1
-            
-            return {
-                'clarity': min(clarity, 1.0),  # Cap at 1.0
-                'composition': composition
-            }
-            
-    class RealESRGANEnhancer:
-        def enhance(self, image: np.ndarray) -> np.ndarray:
-            """Enhance image using real-esrgan docker container."""
-            # Save input image
-            os.makedirs('input', exist_ok=True)
-            os.makedirs('output', exist_ok=True)
-            input_path = os.path.join('input', 'temp.png')
-            cv2.imwrite(input_path, image)
-            
-            try:
-                # Run real-esrgan docker container
-                cmd = [
-                    'docker', 'run', '--rm',
-                    '-v', f"{os.path.abspath('input')}:/app/input",
-                    '-v', f"{os.path.abspath('output')}:/app/output",
-                    'docker.io/kociolek/real-esrgan'
-                ]
-                
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                if result.returncode != 0:
-                    raise RuntimeError(f"Enhancement failed: {result.stderr}")
-                
-                # Read enhanced image
-                output_path = os.path.join('output', 'temp_out.png')
-                enhanced = cv2.imread(output_path)
-                if enhanced is None:
-                    raise ValueError("Could not read enhanced image")
-                
-                # Cleanup
-                os.remove(input_path)
-                os.remove(output_path)
-                
-                return enhanced
-            except Exception as e:
-                logger.error(f"Enhancement error: {e}")
-                # Return original image if enhancement fails
-                return image
-                
-    def process_image(self, image_path: str) -> Dict:
-        """Process an image through the quality assessment and enhancement pipeline."""
-        logger.info(f"Processing image: {image_path}")
+        # Quality model selected by quality_assessment.type, falling back to the basic model
+        self.quality_model = create_quality_model(self.config)
+        self.decode_size = self.config['image_processing']['local_models']['quality_assessment'].get('analysis_size', DEFAULT_ANALYSIS_SIZE)
+        
+        # Long-lived RealESRGAN worker with a bounded job queue
+        self.enhancer = create_enhancer(self.config)
         
+        # Results are cached in memory by detection id and by image content hash,
+        # and persisted in image_quality so they survive restarts
+        self._cache = QualityCache(self.config['image_processing'].get('cache_size', 512))
+        self._setup_database()
+        
+        # Near-identical snapshots of the same visit reuse each other's quality scores
+        dedup = self.config['image_processing'].get('dedup', {})
+        self.phash_index = PerceptualHashIndex(
+            max_distance=dedup.get('max_distance', 6),
+            window=timedelta(minutes=dedup.get('window_minutes', 30)),
+            refresh_interval=dedup.get('refresh_interval', 5),
+            database=self.db
+        ) if dedup.get('enabled', True) else None
+
+    def _setup_database(self) -> None:
+        """Add the result cache columns to image_quality if they are missing."""
+        def do_setup(session):
+            columns = [row[1] for row in session.execute(text("PRAGMA table_info(image_quality)")).fetchall()]
+            for column in ('image_hash', 'quality_scores', 'enhanced_quality_scores'):
+                if columns and column not in columns:
+                    session.execute(text(f"ALTER TABLE image_quality ADD COLUMN {column} TEXT"))
+        
+        try:
+            self.db.execute_write(do_setup)
+        except Exception as e:
+            logger.error(f"Could not add result cache columns to image_quality: {e}")
+
+    @property
+    def threshold(self) -> float:
+        return self.config['image_processing']['local_models']['quality_assessment']['threshold']
+
+    def _load_image(self, image_path: str) -> DecodedFrame:
+        """Read and decode an image from the test image or a URL."""
         # Handle test events differently
         if 'test_event' in image_path:
             test_image_path = '/app/screenshot.jpg'
-            image = cv2.imread(test_image_path)
-            if image is None:
+            try:
+                with open(test_image_path, 'rb') as f:
+                    content = f.read()
+            except OSError:
                 raise ValueError(f"Could not read test image from: {test_image_path}")
         else:
             # Read image from URL for real events
             try:
-                response = requests.get(image_path, stream=True)
+                response = requests.get(image_path)
                 response.raise_for_status()
-                
-                # Convert response content to numpy array
-                nparr = np.frombuffer(response.content, np.uint8)
-                image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                
-                if image is None:
-                    raise ValueError(f"Could not decode image from: {image_path}")
+                content = response.content
             except Exception as e:
                 raise ValueError(f"Could not read image from {image_path}: {str(e)}")
         
-        # Assess quality
-        quality_scores = self.quality_model.assess_quality(image)
+        # Decode at reduced size for scoring; full resolution is only decoded for enhancement
+        try:
+            return DecodedFrame(content, draft_size=self.decode_size)
+        except Exception:
+            raise ValueError(f"Could not decode image from: {image_path}")
+
+    def _is_final(self, result: Dict) -> bool:
+        """A cached result can be reused unless the image still needs enhancing."""
+        return result['enhanced'] or result['quality_scores']['clarity'] >= self.threshold
+
+    def process_image(self, image_path: str, detection_id: Optional[int] = None,
+                      raise_enhancement_errors: bool = False) -> Dict:
+        """Process an image through the quality assessment and enhancement pipeline.
+
+        With a detection id, cached results are checked in memory and then in
+        image_quality before anything is downloaded.
+
+        If enhancement fails the result is returned unenhanced, or with
+        ``raise_enhancement_errors`` the EnhancementError is raised instead.
+        """
+        if detection_id is not None:
+            cached = self.get_cached_results(detection_id)
+            if cached and self._is_final(cached):
+                return cached
+        
+        logger.info(f"Processing image: {image_path}")
+        frame = self._load_image(image_path)
+        image_hash = frame.hash
+        
+        # The same snapshot content may already have been assessed for another request
+        cached = self._cache.get(('hash', image_hash))
+        if cached and self._is_final(cached):
+            result = {**cached, 'original_path': image_path}
+            self._cache_results(detection_id, image_hash, result)
+            return result
+        
+        # Assess quality, unless a near-duplicate snapshot already has been
+        quality_scores = self._duplicate_quality_scores(detection_id, frame)
+        if quality_scores is None:
+            quality_scores = self.quality_model.assess_quality(frame.rgb, rgb=True)
         logger.info(f"Quality scores: {quality_scores}")
         
         result = {
@@ -119,53 +155,165 @@ class ImageProcessingService:
             'quality_scores': quality_scores,
             'enhanced': False,
             'enhanced_path': None,
-            'enhanced_thumbnail_path': None
+            'enhanced_thumbnail_path': None,
+            'quality_improvement': None
         }
         
         # Enhance if needed
-        if quality_scores['clarity'] < self.config['image_processing']['local_models']['quality_assessment']['threshold']:
+        if quality_scores['clarity'] < self.threshold:
             logger.info("Image quality below threshold, enhancing...")
-            enhanced_image = self.enhancer.enhance(image)
-            # Extract event ID from path
-            event_id = image_path.split('/events/')[-1].split('/')[0]
-            
-            # Save enhanced image
-            enhanced_path = f"/data/images/enhanced/{event_id}/snapshot.jpg"
-            logger.info(f"Saving enhanced image to: {enhanced_path}")
-            os.makedirs(os.path.dirname(enhanced_path), exist_ok=True)
-            if not cv2.imwrite(enhanced_path, enhanced_image):
-                logger.error(f"Failed to save enhanced image to: {enhanced_path}")
-                return result
-            
-            # Save enhanced thumbnail
-            thumbnail_size = (320, 240)
-            enhanced_thumbnail = cv2.resize(enhanced_image, thumbnail_size)
-            thumbnail_path = f"/data/images/enhanced/{event_id}/thumbnail.jpg"
-            logger.info(f"Saving enhanced thumbnail to: {thumbnail_path}")
-            if not cv2.imwrite(thumbnail_path, enhanced_thumbnail):
-                logger.error(f"Failed to save enhanced thumbnail to: {thumbnail_path}")
-                return result
-            
-            # Assess enhanced image quality
-            enhanced_scores = self.quality_model.assess_quality(enhanced_image)
-            logger.info(f"Enhanced quality scores: {enhanced_scores}")
-            
-            result.update({
-                'enhanced': True,
-                'enhanced_path': enhanced_path,
-                'enhanced_thumbnail_path': thumbnail_path,
-                'enhanced_quality_scores': enhanced_scores
-            })
+            try:
+                result.update(self._enhance(frame, image_path))
+                result['quality_improvement'] = (result['enhanced_quality_scores']['clarity']
+                                                 - quality_scores['clarity'])
+            except EnhancementError as e:
+                if raise_enhancement_errors:
+                    raise
+                # Keep the original, unenhanced result; it is retried on the next request
+                logger.error(f"Enhancement failed for {image_path}: {e}")
         
         # Cache results
-        self._cache_results(image_path, result)
+        self._cache_results(detection_id, image_hash, result)
         
         return result
 
-    def _cache_results(self, image_path: str, result: Dict) -> None:
-        """Cache the processing results for an image."""
-        self._cache[image_path] = result
+    def _enhance(self, frame: DecodedFrame, image_path: str) -> Dict:
+        """Enhance and save a frame, returning the enhanced fields of the result.
 
-    def get_cached_results(self, image_path: str) -> Dict:
-        """Get cached processing results for an image if available."""
-        return self._cache.get(image_path)
+        Raises EnhancementError if enhancement or saving fails, so nothing is
+        recorded as enhanced that was not.
+        """
+        original = frame.full_resolution_bgr()
+        enhanced_image = self.enhancer.enhance(original)
+        # Extract event ID from path
+        event_id = image_path.split('/events/')[-1].split('/')[0]
+        
+        # Save enhanced image
+        enhanced_path = f"/data/images/enhanced/{event_id}/snapshot.jpg"
+        logger.info(f"Saving enhanced image to: {enhanced_path}")
+        os.makedirs(os.path.dirname(enhanced_path), exist_ok=True)
+        if not cv2.imwrite(enhanced_path, enhanced_image):
+            raise EnhancementError(f"Failed to save enhanced image to: {enhanced_path}")
+        
+        # Save enhanced thumbnail
+        thumbnail_size = (320, 240)
+        enhanced_thumbnail = cv2.resize(enhanced_image, thumbnail_size)
+        thumbnail_path = f"/data/images/enhanced/{event_id}/thumbnail.jpg"
+        logger.info(f"Saving enhanced thumbnail to: {thumbnail_path}")
+        if not cv2.imwrite(thumbnail_path, enhanced_thumbnail):
+            raise EnhancementError(f"Failed to save enhanced thumbnail to: {thumbnail_path}")
+        
+        # Assess the enhanced image at the original's size, so its clarity is on the
+        # same scale as the original's and quality_improvement compares like with like
+        height, width = original.shape[:2]
+        enhanced_scores = self.quality_model.assess_quality(
+            cv2.resize(enhanced_image, (width, height), interpolation=cv2.INTER_AREA))
+        logger.info(f"Enhanced quality scores: {enhanced_scores}")
+        
+        return {
+            'enhanced': True,
+            'enhanced_path': enhanced_path,
+            'enhanced_thumbnail_path': thumbnail_path,
+            'enhanced_quality_scores': enhanced_scores
+        }
+
+    def _duplicate_quality_scores(self, detection_id: Optional[int], frame: DecodedFrame) -> Optional[Dict]:
+        """Index the frame's perceptual hash and return the scores of a scored near-duplicate, if any."""
+        if self.phash_index is None or detection_id is None:
+            return None
+        try:
+            phash = dhash(frame.rgb, rgb=True)
+            self.phash_index.add(detection_id, phash)
+            for other_id in self.phash_index.near_duplicates(detection_id, phash):
+                other = self.get_cached_results(other_id)
+                if other is not None:
+                    logger.info(f"Reusing quality scores of near-duplicate detection {other_id}")
+                    return dict(other['quality_scores'])
+        except Exception as e:
+            logger.error(f"Perceptual hash lookup failed for detection {detection_id}: {e}")
+        return None
+
+    def _cache_results(self, detection_id: Optional[int], image_hash: str, result: Dict) -> None:
+        """Cache the processing results in memory and persist them to image_quality."""
+        self._cache.put(('hash', image_hash), result)
+        if detection_id is None:
+            return
+        self._cache.put(('detection', detection_id), result)
+        
+        def do_store(session):
+            session.execute(text("""
+                INSERT INTO image_quality (
+                    detection_id, clarity_score, composition_score, enhanced_path,
+                    enhanced_thumbnail_path, quality_improvement, image_hash,
+                    quality_scores, enhanced_quality_scores
+                ) VALUES (:id, :clarity, :composition, :path, :thumb, :improvement, :hash,
+                    :scores, :enhanced_scores)
+                ON CONFLICT(detection_id) DO UPDATE SET
+                    clarity_score = excluded.clarity_score,
+                    composition_score = excluded.composition_score,
+                    enhanced_path = COALESCE(excluded.enhanced_path, image_quality.enhanced_path),
+                    enhanced_thumbnail_path = COALESCE(excluded.enhanced_thumbnail_path,
+                                                       image_quality.enhanced_thumbnail_path),
+                    quality_improvement = COALESCE(excluded.quality_improvement,
+                                                   image_quality.quality_improvement),
+                    image_hash = excluded.image_hash,
+                    quality_scores = excluded.quality_scores,
+                    enhanced_quality_scores = COALESCE(excluded.enhanced_quality_scores,
+                                                       image_quality.enhanced_quality_scores)
+            """), {
+                "id": detection_id,
+                "clarity": float(result['quality_scores']['clarity']),
+                "composition": float(result['quality_scores']['composition']),
+                "path": result['enhanced_path'],
+                "thumb": result['enhanced_thumbnail_path'],
+                "improvement": result.get('quality_improvement'),
+                "hash": image_hash,
+                "scores": json.dumps(result['quality_scores'], default=float),
+                "enhanced_scores": (json.dumps(result['enhanced_quality_scores'], default=float)
+                                    if result.get('enhanced_quality_scores') else None)
+            })
+        
+        try:
+            self.db.execute_write(do_store)
+        except Exception as e:
+            logger.error(f"Error persisting quality results for detection {detection_id}: {e}")
+
+    def get_cached_results(self, detection_id: int) -> Optional[Dict]:
+        """Get cached processing results for a detection from memory or image_quality.
+
+        Rows stored before the full score dicts were kept are treated as misses,
+        so the image is assessed again rather than returned with partial scores.
+        """
+        result = self._cache.get(('detection', detection_id))
+        if result is not None:
+            return result
+        
+        def do_query(session):
+            return session.execute(text("""
+                SELECT d.frigate_event, iq.quality_scores, iq.enhanced_quality_scores, iq.enhanced_path,
+                    iq.enhanced_thumbnail_path, iq.quality_improvement, iq.image_hash
+                FROM image_quality iq
+                JOIN detections d ON d.id = iq.detection_id
+                WHERE iq.detection_id = :id
+                AND iq.image_hash IS NOT NULL AND iq.quality_scores IS NOT NULL
+            """), {"id": detection_id}).fetchone()
+        
+        row = self.db.execute_read(do_query)
+        if row is None:
+            return None
+        
+        frigate_event, scores, enhanced_scores, enhanced_path, thumbnail_path, improvement, image_hash = row
+        result = {
+            'original_path': f"{self.config['frigate']['frigate_url']}/api/events/{frigate_event}/snapshot.jpg"
+                             if 'frigate' in self.config else None,
+            'quality_scores': json.loads(scores),
+            'enhanced': enhanced_path is not None,
+            'enhanced_path': enhanced_path,
+            'enhanced_thumbnail_path': thumbnail_path,
+            'quality_improvement': improvement if enhanced_path is not None else None
+        }
+        if enhanced_path is not None and enhanced_scores is not None:
+            result['enhanced_quality_scores'] = json.loads(enhanced_scores)
+        self._cache.put(('detection', detection_id), result)
+        self._cache.put(('hash', image_hash), result)
+        return result
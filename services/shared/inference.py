@@ -0,0 +1,170 @@
+import queue
+import threading
+import zipfile
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Category:
+    """One classification result, with the same fields tflite_support returns."""
+    index: int
+    score: float
+    display_name: str
+    category_name: str
+
+
+def _interpreter_class():
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    return Interpreter
+
+def load_labels(model_path: str) -> Dict[str, List[str]]:
+    """Read the label files packed into the model's metadata (a zip appended to the flatbuffer)."""
+    labels = {}
+    try:
+        with zipfile.ZipFile(model_path) as archive:
+            for name in archive.namelist():
+                if name.endswith('.txt'):
+                    labels[name] = archive.read(name).decode('utf-8').splitlines()
+    except zipfile.BadZipFile:
+        logger.warning(f"No label metadata in {model_path}, using class indexes as names")
+    return labels
+
+
+class Classifier:
+    """A single TFLite interpreter running the image classifier.
+
+    The interpreter uses the XNNPACK CPU delegate with ``threads`` threads. It
+    is not thread-safe, so each instance must only be used by one thread.
+    """
+
+    def __init__(self, model_path: str, threads: int = 4, labels: Optional[Dict[str, List[str]]] = None):
+        Interpreter = _interpreter_class()
+        self.interpreter = Interpreter(model_path=model_path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        _, self.height, self.width, _ = self._input['shape']
+        self.num_classes = int(self._output['shape'][-1])
+
+        labels = labels if labels is not None else load_labels(model_path)
+        # Display names are the English (scientific) labels, category names the raw label ids
+        self.category_names = labels.get('probability-labels.txt')
+        self.display_names = labels.get('probability-labels-en.txt', self.category_names)
+
+    def classify(self, image: np.ndarray, top_k: int = 5) -> List[Category]:
+        """Classify a height x width x 3 RGB uint8 image. Returns the top_k categories by score."""
+        tensor = image[np.newaxis]
+        if self._input['dtype'] == np.float32:
+            tensor = tensor.astype(np.float32) / 255.0
+        self.interpreter.set_tensor(self._input['index'], tensor)
+        self.interpreter.invoke()
+        scores = self.interpreter.get_tensor(self._output['index'])[0].astype(np.float32)
+        scale, zero_point = self._output['quantization']
+        if scale:
+            scores = (scores - zero_point) * scale
+
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            Category(
+                index=int(i),
+                score=float(scores[i]),
+                display_name=self.display_names[i] if self.display_names else str(i),
+                category_name=self.category_names[i] if self.category_names else str(i)
+            )
+            for i in top
+        ]
+
+
+class ClassifierPool:
+    """A pool of interpreters, each owned by its own worker thread.
+
+    ``threads`` is the XNNPACK thread count per interpreter. A few interpreters
+    with fewer threads each gives more throughput when several images are
+    waiting, while one interpreter with many threads gives the lowest latency
+    for a single image. ``submit`` raises ``queue.Full`` when ``queue_size``
+    jobs are already waiting.
+    """
+
+    def __init__(self, model_path: str, pool_size: int = 1, threads: int = 4,
+                 top_k: int = 5, queue_size: int = 32):
+        self.model_path = model_path
+        self.top_k = top_k
+        self._labels = load_labels(model_path)
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._ready = threading.Barrier(pool_size + 1)
+        self._errors = []
+        self.num_classes = None
+        for i in range(pool_size):
+            thread = threading.Thread(target=self._run, args=(threads,), name=f"classifier-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        # Wait for every worker to load its interpreter so model errors surface here
+        self._ready.wait()
+        if self._errors:
+            self.shutdown()
+            raise self._errors[0]
+        logger.info(f"Loaded {pool_size} classifier interpreter(s) from {model_path} with {threads} thread(s) each")
+
+    def submit(self, image: np.ndarray, top_k: Optional[int] = None) -> Future:
+        """Queue an image for classification and return a future for its categories.
+
+        The image is read by a worker thread later, so pass a copy if the
+        caller's buffer will be reused before the future completes.
+        """
+        future = Future()
+        self._jobs.put_nowait((image, top_k or self.top_k, future))
+        return future
+
+    def classify(self, image: np.ndarray, top_k: Optional[int] = None) -> List[Category]:
+        """Classify an image and wait for the result."""
+        return self.submit(image, top_k).result()
+
+    def shutdown(self) -> None:
+        for _ in self._threads:
+            self._jobs.put((None, None, None))
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, threads: int) -> None:
+        try:
+            classifier = Classifier(self.model_path, threads, self._labels)
+        except Exception as e:
+            self._errors.append(e)
+            self._ready.wait()
+            return
+        self.num_classes = classifier.num_classes
+        self._ready.wait()
+
+        while True:
+            image, top_k, future = self._jobs.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(classifier.classify(image, top_k))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def create_classifier(config: Dict) -> ClassifierPool:
+    """Build the classifier pool described by the classification section of config.yml."""
+    settings = config['classification']
+    return ClassifierPool(
+        settings['model'],
+        pool_size=settings.get('interpreters', 1),
+        threads=settings.get('threads', 4),
+        top_k=settings.get('top_k', 5),
+        queue_size=settings.get('queue_size', 32)
+    )
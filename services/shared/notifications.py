@@ -0,0 +1,116 @@
+import json
+import queue
+import threading
+from typing import Dict, List, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+def message_topics(data: Dict) -> Set[str]:
+    """Topics a notification belongs to.
+
+    Every message has its type as a topic ('detection', 'special',
+    'enhancement', ...). Detections and special detections also have
+    'camera:<name>' and 'species:<scientific name>'.
+    """
+    message_type = data.get('type', 'detection')
+    payload = data.get('data') or {}
+    topics = {message_type}
+    if message_type in ('detection', 'special'):
+        if payload.get('camera'):
+            topics.add(f"camera:{payload['camera']}")
+        if payload.get('scientific_name'):
+            topics.add(f"species:{payload['scientific_name']}")
+    return topics
+
+def encode_entry(data: Dict) -> str:
+    """Serialize a notification for the /publish channel: "<topic,topic>\\t<json>"."""
+    return f"{','.join(sorted(message_topics(data)))}\t{json.dumps(data)}"
+
+def decode_entry(entry: str) -> Tuple[Set[str], str]:
+    """Split a /publish entry into its topics and its still-serialized JSON payload."""
+    topics, payload = entry.split('\t', 1)
+    return {t for t in topics.split(',') if t}, payload
+
+
+class NotificationPublisher:
+    """Sends notifications to the websocket service over one long-lived websocket.
+
+    ``publish`` serializes the message in the caller's thread and returns
+    immediately. A background thread keeps the connection to ``url`` open,
+    sends whatever is waiting as one newline-separated frame, and reconnects
+    with backoff if the service goes away. Up to ``queue_size`` messages are
+    held while disconnected; beyond that the oldest are dropped.
+    """
+
+    def __init__(self, url: str = 'ws://websocket:8765/publish', queue_size: int = 1000,
+                 max_batch: int = 100):
+        self.url = url
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, data: Dict) -> None:
+        entry = encode_entry(data)
+        while True:
+            try:
+                self._queue.put_nowait(entry)
+                break
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    logger.warning("Notification queue full, dropping the oldest notification")
+                except queue.Empty:
+                    pass
+        self._ensure_started()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="notification-publisher", daemon=True)
+            self._thread.start()
+
+    def _next_batch(self, timeout: float) -> List[str]:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        # Imported here so the rest of this module has no dependency on websockets
+        from websockets.sync.client import connect
+
+        delay = 1.0
+        batch: List[str] = []
+        while not self._stop.is_set():
+            try:
+                with connect(self.url, open_timeout=5, compression=None) as websocket:
+                    logger.info(f"Connected to notification channel at {self.url}")
+                    delay = 1.0
+                    while not self._stop.is_set():
+                        if not batch:
+                            batch = self._next_batch(timeout=1.0)
+                        if batch:
+                            websocket.send('\n'.join(batch))
+                            batch = []
+            except Exception as e:
+                # The unsent batch is kept and sent after reconnecting
+                logger.warning(f"Notification channel error: {e}, reconnecting in {delay:.0f}s")
+                self._stop.wait(delay)
+                delay = min(delay * 2, 30.0)
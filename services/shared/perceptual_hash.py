@@ -0,0 +1,201 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import cv2
+import numpy as np
+from sqlalchemy import text
+from .database import db
+import logging
+
+logger = logging.getLogger(__name__)
+
+def dhash(image: np.ndarray, rgb: bool = False, size: int = 8) -> int:
+    """64-bit difference hash of a BGR (or RGB with rgb=True) or grayscale image.
+
+    The image is shrunk to (size + 1) x size grey pixels and each bit records
+    whether a pixel is brighter than its left neighbour. Re-encoding, small
+    shifts and lighting changes flip only a few bits, so near-identical
+    snapshots are a small Hamming distance apart.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+def to_signed(value: int) -> int:
+    """Map a 64-bit hash onto SQLite's signed INTEGER range."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class HashBuckets:
+    """Bit-sliced index for Hamming-distance lookups of 64-bit hashes.
+
+    Each hash is split into ``bands`` slices and filed in one bucket per
+    slice. Two hashes that differ in d < bands bits must have at least one
+    identical slice, so a search within ``max_distance`` < bands only has to
+    check the hashes sharing a bucket with the key. Larger distances fall
+    back to a full scan.
+    """
+
+    def __init__(self, bands: int = 8):
+        self.bands = bands
+        self.width = 64 // bands
+        self._mask = (1 << self.width) - 1
+        self._keys: List[int] = []
+        self._items: List[Any] = []
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _slices(self, key: int):
+        for band in range(self.bands):
+            yield band, (key >> (band * self.width)) & self._mask
+
+    def add(self, key: int, item: Any) -> None:
+        position = len(self._keys)
+        self._keys.append(key)
+        self._items.append(item)
+        for band, value in self._slices(key):
+            self._buckets[band].setdefault(value, []).append(position)
+
+    def search(self, key: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """All (distance, item) pairs within max_distance of key, closest first."""
+        if max_distance >= self.bands:
+            candidates = range(len(self._keys))
+        else:
+            candidates = set()
+            for band, value in self._slices(key):
+                candidates.update(self._buckets[band].get(value, ()))
+        results = []
+        for position in candidates:
+            distance = hamming(key, self._keys[position])
+            if distance <= max_distance:
+                results.append((distance, self._items[position]))
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+class PerceptualHashIndex:
+    """Perceptual hashes of detection snapshots, stored in detection_phashes.
+
+    The hashes are also held in memory in ``HashBuckets``. Hashes added here are
+    indexed at once, and rows that other processes have added are picked up
+    at most every ``refresh_interval`` seconds, so every service sees the same
+    index. ``near_duplicates`` finds detections whose snapshots are within
+    ``max_distance`` bits of a hash and, by default, taken within ``window``
+    of each other. ``database`` defaults to the shared /data database.
+    """
+
+    def __init__(self, max_distance: int = 6, window: Optional[timedelta] = timedelta(minutes=30),
+                 refresh_interval: float = 5.0, database=None):
+        self.max_distance = max_distance
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.db = database or db
+        self._hashes = HashBuckets()
+        self._times: Dict[int, Optional[datetime]] = {}
+        self._last_row = 0
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._setup_database()
+
+    def _setup_database(self) -> None:
+        def do_setup(session):
+            session.execute(text("""
+                CREATE TABLE IF NOT EXISTS detection_phashes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    detection_id INTEGER NOT NULL UNIQUE,
+                    phash INTEGER NOT NULL,
+                    detection_time DATETIME,
+                    FOREIGN KEY (detection_id) REFERENCES detections(id)
+                )
+            """))
+        self.db.execute_write(do_setup)
+
+    def add(self, detection_id: int, phash: int) -> None:
+        """Record a detection's hash. The first hash stored for a detection is kept."""
+        def do_insert(session):
+            session.execute(text("""
+                INSERT OR IGNORE INTO detection_phashes (detection_id, phash, detection_time)
+                SELECT id, :phash, detection_time FROM detections WHERE id = :id
+            """), {"id": detection_id, "phash": to_signed(phash)})
+            # The stored hash, which is an earlier one if the detection was already indexed
+            return session.execute(text("""
+                SELECT phash, detection_time FROM detection_phashes WHERE detection_id = :id
+            """), {"id": detection_id}).fetchone()
+
+        row = self.db.execute_write(do_insert)
+        if row is not None:
+            with self._lock:
+                self._index(detection_id, row[0], row[1])
+
+    def near_duplicates(self, detection_id: Optional[int], phash: int,
+                        max_distance: Optional[int] = None,
+                        window: Optional[timedelta] = None, any_time: bool = False) -> List[int]:
+        """Other detections with a similar snapshot, closest first.
+
+        Unless ``any_time`` is set, only detections within the time window of
+        ``detection_id`` are returned, which requires its hash to be indexed.
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        window = window or self.window
+        self.refresh()
+        with self._lock:
+            matches = self._hashes.search(phash, max_distance)
+            around = self._times.get(detection_id)
+
+        duplicates = []
+        for _, (other_id, other_time) in matches:
+            if other_id == detection_id:
+                continue
+            if not any_time and window is not None:
+                if around is None or other_time is None or abs(other_time - around) > window:
+                    continue
+            duplicates.append(other_id)
+        return duplicates
+
+    def refresh(self, force: bool = False) -> None:
+        """Index rows added to detection_phashes since the last refresh."""
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return
+
+            def do_query(session):
+                return session.execute(text("""
+                    SELECT id, detection_id, phash, detection_time
+                    FROM detection_phashes
+                    WHERE id > :last
+                    ORDER BY id
+                """), {"last": self._last_row}).fetchall()
+
+            for row_id, detection_id, phash, detection_time in self.db.execute_read(do_query):
+                self._index(detection_id, phash, detection_time)
+                self._last_row = row_id
+            self._last_refresh = time.monotonic()
+
+    def _index(self, detection_id: int, phash: int, detection_time) -> None:
+        # Caller must hold self._lock. Hashes added here come back in the next refresh
+        if detection_id in self._times:
+            return
+        when = _parse_time(detection_time)
+        self._hashes.add(to_unsigned(phash), (detection_id, when))
+        self._times[detection_id] = when
+
+
+def _parse_time(value) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        logger.warning(f"Unparseable detection time: {value}")
+        return None
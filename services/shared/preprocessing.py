@@ -0,0 +1,60 @@
+import threading
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+
+def letterbox(image: np.ndarray, size: Tuple[int, int] = (224, 224),
+              out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Scale an image to fit size (width, height) and centre it on a black canvas.
+
+    Scaling, centring and padding are done by a single warpAffine call that
+    writes every pixel of ``out``, so a buffer can be reused between images
+    without clearing it. The output is always exactly height x width.
+    Images shrunk by more than 2x are first reduced with area averaging.
+    """
+    width, height = size
+    src_h, src_w = image.shape[:2]
+    scale = min(width / src_w, height / src_h)
+    if scale < 0.5:
+        # Linear filtering aliases when shrinking by more than 2x, and draft decoding
+        # does not prevent that for long, thin crops, as it scales by the smaller ratio.
+        # Average whole blocks of pixels first, leaving less than 2x for warpAffine
+        factor = int(1 / scale)
+        image = cv2.resize(image, (max(1, round(src_w / factor)), max(1, round(src_h / factor))),
+                           interpolation=cv2.INTER_AREA)
+        src_h, src_w = image.shape[:2]
+        scale = min(width / src_w, height / src_h)
+    # Offsets that centre the scaled image, in pixel-centre coordinates as cv2.resize uses
+    tx = (width - src_w * scale) / 2 + 0.5 * scale - 0.5
+    ty = (height - src_h * scale) / 2 + 0.5 * scale - 0.5
+    matrix = np.array([[scale, 0, tx], [0, scale, ty]], dtype=np.float32)
+
+    if out is None:
+        out = np.empty((height, width, image.shape[2]), dtype=image.dtype)
+    cv2.warpAffine(image, matrix, (width, height), dst=out, flags=cv2.INTER_LINEAR,
+                   borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return out
+
+
+class Letterbox:
+    """Letterboxes images into a preallocated model-input buffer.
+
+    Each thread gets its own height x width x 3 uint8 buffer, which is
+    overwritten by the next call on that thread. Copy the result if it has
+    to outlive that.
+    """
+
+    def __init__(self, size: Tuple[int, int] = (224, 224)):
+        self.size = size
+        self._local = threading.local()
+
+    def buffer(self) -> np.ndarray:
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            width, height = self.size
+            buffer = np.zeros((height, width, 3), dtype=np.uint8)
+            self._local.buffer = buffer
+        return buffer
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        return letterbox(image, self.size, out=self.buffer())
@@ -0,0 +1,271 @@
+import argparse
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Snapshots up to this size are scored at full resolution, on the same clarity
+# scale that quality_assessment.threshold was tuned on
+DEFAULT_ANALYSIS_SIZE = 1280
+
+# Immerkær's noise estimation kernel: responds to noise but not to edges or gradients
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+class BasicQualityModel:
+    """Image statistics quality model working on a downscaled copy of the image.
+
+    Every image is first reduced so its long side is at most ``analysis_size``
+    pixels, so a 4x-upscaled enhanced image costs no more to assess than a
+    large snapshot. Images within that size are scored at full resolution.
+    Laplacian variance depends on scale, so clarity of a reduced image is not
+    on the same scale as at full resolution; there is no fixed factor between
+    the two. Clarity, composition, exposure and noise are computed
+    from that one grayscale image using float32 buffers that are kept per
+    thread and reused while the image size stays the same.
+    """
+
+    def __init__(self, threshold: float, analysis_size: int = DEFAULT_ANALYSIS_SIZE):
+        self.threshold = threshold
+        self.analysis_size = analysis_size
+        self._local = threading.local()
+
+    def _buffers(self, height: int, width: int) -> Dict[str, np.ndarray]:
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers['gray'].shape != (height, width):
+            buffers = {
+                'small': np.empty((height, width, 3), dtype=np.uint8),
+                'gray': np.empty((height, width), dtype=np.uint8),
+                'laplacian': np.empty((height, width), dtype=np.float32),
+                'noise': np.empty((height, width), dtype=np.float32)
+            }
+            self._local.buffers = buffers
+        return buffers
+
+    def _analysis_shape(self, image: np.ndarray):
+        height, width = image.shape[:2]
+        scale = min(1.0, self.analysis_size / max(height, width))
+        return max(3, round(height * scale)), max(3, round(width * scale))
+
+    def assess_quality(self, image: np.ndarray, rgb: bool = False) -> Dict[str, float]:
+        """Score a BGR image, or RGB with rgb=True. All scores are in the 0-1 range."""
+        height, width = self._analysis_shape(image)
+        buffers = self._buffers(height, width)
+        gray = buffers['gray']
+        to_gray = cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY
+
+        if image.shape[:2] == (height, width):
+            cv2.cvtColor(image, to_gray, dst=gray)
+        else:
+            # INTER_AREA averages pixel blocks, so this is a proper pyramid level
+            cv2.resize(image, (width, height), dst=buffers['small'], interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(buffers['small'], to_gray, dst=gray)
+
+        # Clarity: Laplacian variance (focus measure)
+        cv2.Laplacian(gray, cv2.CV_32F, dst=buffers['laplacian'])
+        _, std = cv2.meanStdDev(buffers['laplacian'])
+        clarity = float(std[0, 0]) ** 2 / 10000  # Normalize to roughly 0-1 range
+
+        # Composition: brightness of the centre third (rule of thirds)
+        center_roi = gray[height//3:2*height//3, width//3:2*width//3]
+        composition = cv2.mean(center_roi)[0] / 255
+
+        # Exposure: penalise a mean far from mid-grey and clipped shadows or highlights
+        histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+        total = float(histogram.sum())
+        mean = float(np.dot(histogram, np.arange(256, dtype=np.float32)) / total) / 255
+        clipped = float(histogram[:5].sum() + histogram[-5:].sum()) / total
+        exposure = max(0.0, 1.0 - 2 * abs(mean - 0.5) - clipped)
+
+        # Noise: Immerkær sigma estimate in grey levels, 20 or more counts as fully noisy
+        cv2.filter2D(gray, cv2.CV_32F, _NOISE_KERNEL, dst=buffers['noise'],
+                     borderType=cv2.BORDER_REFLECT)
+        inner = buffers['noise'][1:-1, 1:-1]
+        sigma = math.sqrt(math.pi / 2) * cv2.norm(inner, cv2.NORM_L1) / (6 * inner.size)
+        noise = sigma / 20
+
+        return {
+            'clarity': min(clarity, 1.0),  # Cap at 1.0
+            'composition': composition,
+            'exposure': exposure,
+            'noise': min(noise, 1.0)
+        }
+
+    def assess_many(self, images: Sequence[np.ndarray], rgb: bool = False) -> List[Dict[str, float]]:
+        """Score several images, reusing the same buffers for each."""
+        return [self.assess_quality(image, rgb) for image in images]
+
+
+class TFLiteQualityModel:
+    """Learned IQA model (such as the TF-IQA network) converted to TensorFlow Lite.
+
+    The network's score is reported as 'overall' and used as 'clarity', the
+    value the enhancement threshold is checked against. Composition, exposure
+    and noise come from the image statistics of ``BasicQualityModel``. Images
+    are scored in batches of up to ``batch_size`` per interpreter call, and
+    ``threads`` sets the XNNPACK CPU thread count.
+    """
+
+    def __init__(self, model_path: str, threshold: float, threads: Optional[int] = None,
+                 batch_size: int = 8, analysis_size: int = DEFAULT_ANALYSIS_SIZE):
+        # Imported here so the basic model works without a TFLite runtime installed
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.statistics = BasicQualityModel(threshold, analysis_size=analysis_size)
+        # Interpreters are not thread-safe, so calls are serialised
+        self._lock = threading.Lock()
+        self.interpreter = Interpreter(model_path=model_path, num_threads=threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        _, self.height, self.width, _ = self._input['shape']
+        self._batch = None
+        self._resize(1)
+        logger.info(f"Loaded TFLite quality model from {model_path} (threads={threads})")
+
+    def _resize(self, batch: int) -> None:
+        # Caller must hold self._lock, except during __init__
+        if batch == self._batch:
+            return
+        self.interpreter.resize_tensor_input(self._input['index'], [batch, self.height, self.width, 3])
+        self.interpreter.allocate_tensors()
+        self._batch = batch
+
+    def _prepare(self, image: np.ndarray, rgb: bool) -> np.ndarray:
+        resized = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        rgb = resized if rgb else cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+        if self._input['dtype'] == np.float32:
+            return rgb.astype(np.float32) / 255.0
+        return rgb.astype(self._input['dtype'])
+
+    def _scores(self, images: Sequence[np.ndarray], rgb: bool) -> np.ndarray:
+        batch = np.stack([self._prepare(image, rgb) for image in images])
+        with self._lock:
+            self._resize(len(images))
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self._output['index'])
+        scores = output.reshape(len(images), -1)[:, 0].astype(np.float32)
+        scale, zero_point = self._output['quantization']
+        if scale:
+            scores = (scores - zero_point) * scale
+        return scores
+
+    def assess_quality(self, image: np.ndarray, rgb: bool = False) -> Dict[str, float]:
+        return self.assess_many([image], rgb)[0]
+
+    def assess_many(self, images: Sequence[np.ndarray], rgb: bool = False) -> List[Dict[str, float]]:
+        results = []
+        for start in range(0, len(images), self.batch_size):
+            chunk = images[start:start + self.batch_size]
+            for image, score in zip(chunk, self._scores(chunk, rgb)):
+                scores = self.statistics.assess_quality(image, rgb)
+                scores['clarity'] = scores['overall'] = float(np.clip(score, 0.0, 1.0))
+                results.append(scores)
+        return results
+
+
+def _create_basic(settings: Dict) -> BasicQualityModel:
+    return BasicQualityModel(settings['threshold'], analysis_size=settings.get('analysis_size', DEFAULT_ANALYSIS_SIZE))
+
+def _create_tflite(settings: Dict) -> TFLiteQualityModel:
+    return TFLiteQualityModel(
+        settings.get('model_path', 'models/quality/tf-iqa-model/model.tflite'),
+        settings['threshold'],
+        threads=settings.get('threads'),
+        batch_size=settings.get('batch_size', 8),
+        analysis_size=settings.get('analysis_size', DEFAULT_ANALYSIS_SIZE)
+    )
+
+# Quality model factories, keyed by image_processing.local_models.quality_assessment.type
+QUALITY_MODELS: Dict[str, Callable[[Dict], object]] = {
+    'basic': _create_basic,
+    'tflite': _create_tflite,
+    'tf-iqa': _create_tflite
+}
+
+def create_quality_model(config: Dict):
+    """Build the quality model described by image_processing.local_models.quality_assessment.
+
+    Model types that cannot be loaded fall back to the basic model.
+    """
+    settings = config['image_processing']['local_models']['quality_assessment']
+    model_type = settings.get('type', 'basic')
+    factory = QUALITY_MODELS.get(model_type)
+    if factory is None:
+        logger.warning(f"Unknown quality model type {model_type}, using basic model")
+        return _create_basic(settings)
+
+    try:
+        return factory(settings)
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning(f"Could not load {model_type} quality model ({e}), using basic model")
+        return _create_basic(settings)
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    return np.argsort(np.argsort(values)).astype(np.float64)
+
+def benchmark(models: Dict[str, object], images: Sequence[np.ndarray], repeats: int = 3) -> Dict:
+    """Compare latency and clarity-score agreement of several quality models.
+
+    Agreement is measured against the first model: Spearman rank correlation and
+    mean absolute difference of the clarity scores over the image set.
+    """
+    results = {}
+    reference = None
+    for name, model in models.items():
+        model.assess_many(images[:1])  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            scores = model.assess_many(images)
+        elapsed = (time.perf_counter() - start) / repeats
+        clarity = np.array([s['clarity'] for s in scores], dtype=np.float64)
+
+        result = {'ms_per_image': round(elapsed * 1000 / len(images), 2)}
+        if reference is None:
+            reference = clarity
+        elif len(images) > 2:
+            result['spearman'] = round(float(np.corrcoef(_ranks(reference), _ranks(clarity))[0, 1]), 3)
+            result['mean_abs_diff'] = round(float(np.abs(reference - clarity).mean()), 3)
+        results[name] = result
+    return results
+
+def _load_images(directory: str) -> List[np.ndarray]:
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            image = cv2.imread(os.path.join(directory, name))
+            if image is not None:
+                images.append(image)
+    return images
+
+if __name__ == '__main__':
+    import yaml
+
+    parser = argparse.ArgumentParser(description="Benchmark quality models on a directory of images")
+    parser.add_argument('images', help="directory of .jpg/.png images")
+    parser.add_argument('--config', default='/config/config.yml')
+    parser.add_argument('--types', nargs='+', default=['basic', 'tf-iqa'],
+                        help="quality model types to compare, the first is the reference")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        settings = yaml.safe_load(f)['image_processing']['local_models']['quality_assessment']
+
+    images = _load_images(args.images)
+    if not images:
+        raise SystemExit(f"No images found in {args.images}")
+    models = {model_type: QUALITY_MODELS[model_type](settings) for model_type in args.types}
+    for name, result in benchmark(models, images, args.repeats).items():
+        print(f"{name}: {result}")
@@ -3,11 +3,12 @@ import json
 from typing import Dict, List, Optional, Tuple
 from sqlalchemy import text
 from .database import db
+from .vote_aggregator import VoteAggregator
 
 class SpecialDetectionService:
-    def __init__(self, db_path: str = "/data/speciesid.db"):
+    def __init__(self, db_path: str = "/data/speciesid.db", vote_flush_interval: float = 2.0):
         # db_path kept for compatibility but not used since we use the shared db manager
-        pass
+        self.votes = VoteAggregator(flush_interval=vote_flush_interval)
 
     def update_rarity_scores(self) -> None:
         """Update rarity scores for all species based on detection history."""
@@ -189,13 +190,17 @@ class SpecialDetectionService:
             # Use raw frequency score for rare birds, detection score for quality birds
             final_score = float(frequency_score if highlight_type == 'rare' else detection['score'])
 
-            # Only create special detection if score is significant
+            # Only create special detection if score is significant. A reprocessed
+            # detection updates its existing entry, keeping its votes and featured status
             if final_score > 0.7:  # Threshold for special detection
                 result = session.execute(
                     text("""
                         INSERT INTO special_detections 
                         (detection_id, highlight_type, score, created_at)
                         VALUES (:id, :type, :score, CURRENT_TIMESTAMP)
+                        ON CONFLICT(detection_id) DO UPDATE SET
+                            highlight_type = excluded.highlight_type,
+                            score = excluded.score
                         RETURNING id
                     """),
                     {"id": detection_id, "type": highlight_type, "score": final_score}
@@ -247,21 +252,23 @@ class SpecialDetectionService:
                       'local_created_at']
             return [dict(zip(columns, row)) for row in rows]
         
-        return db.execute_read(do_query)
+        generation = self.votes.generation
+        detections = db.execute_read(do_query)
+        self.votes.merge_rows(detections, generation)
+        return detections
 
-    def update_community_votes(self, special_detection_id: int, increment: bool = True) -> None:
-        """Update the community vote count for a special detection."""
-        def do_update(session):
-            session.execute(
-                text("""
-                    UPDATE special_detections
-                    SET community_votes = community_votes + :change
-                    WHERE id = :id
-                """),
-                {"change": 1 if increment else -1, "id": special_detection_id}
-            )
-        
-        db.execute_write(do_update)
+    def update_community_votes(self, special_detection_id: int, increment: bool = True) -> Optional[int]:
+        """Record a community vote for a special detection.
+
+        The vote is buffered and written to the database in the next batched flush.
+        Returns the vote count including pending votes, or None if the special
+        detection does not exist.
+        """
+        return self.votes.record(special_detection_id, increment)
+
+    def get_community_votes(self, special_detection_id: int) -> Optional[int]:
+        """Get the community vote count for a special detection, including pending votes."""
+        return self.votes.get_votes(special_detection_id)
 
     def toggle_featured_status(self, special_detection_id: int) -> bool:
         """Toggle the featured status of a special detection."""
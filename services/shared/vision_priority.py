@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from sqlalchemy import text
+from .database import db
+import logging
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class VisionCandidate:
+    """A detection that has no vision analysis yet, with the evidence it is ranked on."""
+    detection_id: int
+    frigate_event: str
+    scientific_name: str
+    confidence: float  # classifier score
+    clarity: float     # quality model clarity, or the prior when not measured
+    rarity: float      # 1 - visits / visits of the most common species
+    value: float
+    clarity_measured: bool
+
+    def to_dict(self) -> Dict:
+        return {
+            'detection_id': self.detection_id,
+            'frigate_event': self.frigate_event,
+            'scientific_name': self.scientific_name,
+            'confidence': round(self.confidence, 4),
+            'clarity': round(self.clarity, 4),
+            'rarity': round(self.rarity, 4),
+            'value': round(self.value, 4),
+            'clarity_measured': self.clarity_measured
+        }
+
+
+def expected_value(rarity: float, confidence: float, clarity: float, rarity_floor: float = 0.2) -> float:
+    """How much a vision analysis of this detection is expected to be worth.
+
+    Confidence and clarity estimate the chance the analysis is of a correctly
+    identified, usable photo; rarity is what that photo is worth. The floor
+    keeps common species ranked by quality instead of all tying at zero.
+    """
+    return (rarity_floor + rarity) * confidence * clarity
+
+
+class VisionPriorityScheduler:
+    """Ranks unanalysed detections so the daily vision budget goes to the most valuable first.
+
+    Clarity comes from image_quality, where the configured quality model
+    (BasicQualityModel by default) stores it. Detections without a stored
+    score are measured with ``load_image`` when one is given, and otherwise
+    get ``default_clarity``. ``database`` defaults to the shared /data database.
+    """
+
+    def __init__(self, rarity_floor: float = 0.2, default_clarity: float = 0.5,
+                 cost_per_1k_tokens: float = 0.01, default_cost: float = 0.01,
+                 load_image: Optional[Callable[[str], Optional[np.ndarray]]] = None,
+                 database=None):
+        self.rarity_floor = rarity_floor
+        self.default_clarity = default_clarity
+        self.cost_per_1k_tokens = cost_per_1k_tokens
+        self.default_cost = default_cost
+        # Returns the BGR snapshot of a Frigate event, or None if unavailable
+        self.load_image = load_image
+        self._quality_model = None
+        self.db = database or db
+
+    def rank(self, days: int = 7, limit: Optional[int] = None) -> List[VisionCandidate]:
+        """Unanalysed detections from the last ``days`` days, highest expected value first."""
+        def do_query(session):
+            return session.execute(text("""
+                WITH species_counts AS (
+                    SELECT display_name, COUNT(*) AS visits
+                    FROM detections
+                    GROUP BY display_name
+                ),
+                most_visits AS (
+                    SELECT MAX(visits) AS visits FROM species_counts
+                )
+                SELECT
+                    d.id,
+                    d.frigate_event,
+                    d.display_name,
+                    d.score,
+                    iq.clarity_score,
+                    1.0 - CAST(sc.visits AS REAL) / m.visits AS rarity
+                FROM detections d
+                JOIN species_counts sc ON sc.display_name = d.display_name
+                CROSS JOIN most_visits m
+                LEFT JOIN image_quality iq ON iq.detection_id = d.id
+                WHERE d.detection_time >= :since
+                AND NOT EXISTS (
+                    SELECT 1 FROM vision_analysis_cache v WHERE v.detection_id = d.id
+                )
+            """), {"since": (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')}).fetchall()
+
+        candidates = []
+        for detection_id, frigate_event, scientific_name, score, clarity, rarity in self.db.execute_read(do_query):
+            measured = clarity is not None
+            if not measured:
+                clarity = self._measure_clarity(frigate_event)
+                measured = clarity is not None
+            clarity = clarity if clarity is not None else self.default_clarity
+            confidence = float(score or 0.0)
+            rarity = float(rarity or 0.0)
+            candidates.append(VisionCandidate(
+                detection_id=detection_id,
+                frigate_event=frigate_event,
+                scientific_name=scientific_name,
+                confidence=confidence,
+                clarity=float(clarity),
+                rarity=rarity,
+                value=expected_value(rarity, confidence, float(clarity), self.rarity_floor),
+                clarity_measured=measured
+            ))
+        candidates.sort(key=lambda c: c.value, reverse=True)
+        return candidates[:limit] if limit else candidates
+
+    def budget(self, cost_limit: float) -> Dict[str, float]:
+        """Today's spend from vision_api_costs and the expected cost of one analysis."""
+        def do_query(session):
+            spent = session.execute(text("""
+                SELECT COALESCE(SUM(total_cost), 0) FROM vision_api_costs WHERE date = :today
+            """), {"today": datetime.now().date().isoformat()}).scalar()
+            # Average over recent analyses, as prompt and image sizes change over time
+            tokens = session.execute(text("""
+                SELECT AVG(cost_tokens) FROM (
+                    SELECT cost_tokens FROM vision_analysis_cache
+                    WHERE cost_tokens IS NOT NULL
+                    ORDER BY created_at DESC LIMIT 100
+                )
+            """)).scalar()
+            return float(spent or 0.0), tokens
+
+        spent, tokens = self.db.execute_read(do_query)
+        cost_estimate = tokens / 1000 * self.cost_per_1k_tokens if tokens else self.default_cost
+        return {
+            'cost_limit': cost_limit,
+            'spent': round(spent, 4),
+            'remaining': round(max(0.0, cost_limit - spent), 4),
+            'cost_estimate': round(cost_estimate, 4)
+        }
+
+    def plan(self, cost_limit: float, days: int = 7, limit: Optional[int] = 100) -> Dict:
+        """The ranking, with the candidates that fit in what is left of today's budget marked."""
+        budget = self.budget(cost_limit)
+        return {'budget': budget, 'candidates': fill_budget(self.rank(days, limit), budget)}
+
+    def _measure_clarity(self, frigate_event: str) -> Optional[float]:
+        if self.load_image is None:
+            return None
+        try:
+            image = self.load_image(frigate_event)
+        except Exception as e:
+            logger.warning(f"Could not load snapshot for {frigate_event}: {e}")
+            return None
+        if image is None:
+            return None
+        if self._quality_model is None:
+            from .quality import BasicQualityModel
+            self._quality_model = BasicQualityModel(threshold=0.0)
+        return self._quality_model.assess_quality(image)['clarity']
+
+
+def fill_budget(candidates: List[VisionCandidate], budget: Dict[str, float]) -> List[Dict]:
+    """Mark the highest-value candidates that the remaining budget pays for, in ranking order."""
+    if budget['cost_estimate'] > 0:
+        # Small tolerance so a remaining budget of exactly n estimates pays for n
+        affordable = int(budget['remaining'] / budget['cost_estimate'] + 1e-9)
+    else:
+        affordable = len(candidates)
+    return [
+        {**candidate.to_dict(), 'rank': rank + 1, 'within_budget': rank < affordable}
+        for rank, candidate in enumerate(candidates)
+    ]
@@ -0,0 +1,182 @@
+import atexit
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Optional
+from sqlalchemy import bindparam, text
+from .database import db
+
+class VoteAggregator:
+    """Accumulates community vote deltas in memory and flushes them in batches.
+
+    Votes are recorded without touching SQLite. A background thread applies the
+    pending deltas every ``flush_interval`` seconds in a single write transaction.
+
+    Rows read elsewhere are merged with ``merge_rows``. A flush that commits
+    between reading a row and merging it would make the row's count stale or
+    make the delta count twice, so readers take ``generation`` before the
+    query. Counts of detections flushed since then are ignored in favour of
+    the count the flush read back.
+    """
+
+    def __init__(self, flush_interval: float = 2.0):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[int, int] = defaultdict(int)
+        # Deltas taken by a flush that has not committed yet
+        self._inflight: Dict[int, int] = {}
+        # Last persisted vote count seen for each special detection
+        self._persisted: Dict[int, int] = {}
+        # Incremented by every completed flush; _flushed_at holds the value set by
+        # the last flush that wrote each special detection
+        self._generation = 0
+        self._flushed_at: Dict[int, int] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def generation(self) -> int:
+        """Take before reading rows that will be passed to merge_rows."""
+        with self._lock:
+            return self._generation
+
+    def record(self, special_detection_id: int, increment: bool = True) -> Optional[int]:
+        """Record a vote and return the merged count, or None if the special detection does not exist."""
+        with self._lock:
+            known = special_detection_id in self._persisted
+        if not known and not self._load(special_detection_id):
+            return None
+        with self._lock:
+            self._pending[special_detection_id] += 1 if increment else -1
+            count = self._merged(special_detection_id)
+        self._ensure_started()
+        return count
+
+    def get_votes(self, special_detection_id: int) -> Optional[int]:
+        """Get the vote count including pending deltas, or None if never loaded."""
+        with self._lock:
+            return self._merged(special_detection_id)
+
+    def merge_rows(self, rows: Iterable[Dict], generation: int, id_key: str = 'id',
+                   votes_key: str = 'community_votes') -> None:
+        """Remember persisted counts from query rows and add pending deltas in place.
+
+        ``generation`` is the value of ``self.generation`` taken before the rows were read.
+        """
+        with self._lock:
+            for row in rows:
+                special_detection_id = row[id_key]
+                if self._is_stale(special_detection_id, generation):
+                    # Every flushed detection has a known count, read back by the flush
+                    row[votes_key] = self._merged(special_detection_id)
+                    continue
+                persisted = row[votes_key] or 0
+                self._persisted[special_detection_id] = persisted
+                row[votes_key] = persisted + self._unflushed(special_detection_id)
+
+    def _load(self, special_detection_id: int) -> bool:
+        """Read a persisted count on a cache miss. Returns False if the row does not exist."""
+        def do_query(session):
+            return session.execute(
+                text("SELECT community_votes FROM special_detections WHERE id = :id"),
+                {"id": special_detection_id}
+            ).fetchone()
+
+        # Holding the flush lock means no flush can commit between the read and storing it
+        with self._flush_lock:
+            row = db.execute_read(do_query)
+            if row is None:
+                return False
+            with self._lock:
+                self._persisted.setdefault(special_detection_id, row[0] or 0)
+        return True
+
+    def flush(self) -> int:
+        """Apply all pending deltas in one transaction. Returns the number of rows updated."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            pending = {k: v for k, v in self._pending.items() if v != 0}
+            self._pending.clear()
+            self._inflight = pending
+
+        if not pending:
+            return 0
+
+        def do_flush(session):
+            session.execute(
+                text("""
+                    UPDATE special_detections
+                    SET community_votes = community_votes + :change
+                    WHERE id = :id
+                """),
+                [{"id": k, "change": v} for k, v in pending.items()]
+            )
+            return session.execute(
+                text("""
+                    SELECT id, community_votes
+                    FROM special_detections
+                    WHERE id IN :ids
+                """).bindparams(bindparam("ids", expanding=True)),
+                {"ids": list(pending)}
+            ).fetchall()
+
+        try:
+            rows = db.execute_write(do_flush)
+        except Exception as e:
+            # Put the deltas back so they are retried on the next flush
+            with self._lock:
+                for k, v in pending.items():
+                    self._pending[k] += v
+                self._inflight = {}
+            print(f"Error flushing community votes: {e}", flush=True)
+            return 0
+
+        with self._lock:
+            self._generation += 1
+            for special_detection_id, votes in rows:
+                self._persisted[special_detection_id] = votes
+                self._flushed_at[special_detection_id] = self._generation
+            self._inflight = {}
+        return len(rows)
+
+    def stop(self) -> None:
+        """Stop the flush thread and write out anything still pending."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval * 2)
+        self.flush()
+
+    def _merged(self, special_detection_id: int) -> Optional[int]:
+        # Caller must hold self._lock
+        persisted = self._persisted.get(special_detection_id)
+        if persisted is None:
+            return None
+        return persisted + self._unflushed(special_detection_id)
+
+    def _is_stale(self, special_detection_id: int, generation: int) -> bool:
+        # Caller must hold self._lock. A row is stale if a flush of it was in progress
+        # or completed after the reader took the generation.
+        return (special_detection_id in self._inflight
+                or self._flushed_at.get(special_detection_id, 0) > generation)
+
+    def _unflushed(self, special_detection_id: int) -> int:
+        # Caller must hold self._lock
+        return (self._pending.get(special_detection_id, 0)
+                + self._inflight.get(special_detection_id, 0))
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="vote-flush", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,270 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+import numpy as np
+from sqlalchemy import text
+from .database import db
+import logging
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('temperature', 'humidity', 'wind_speed', 'precipitation', 'cloud_cover', 'pressure')
+
+def _to_hours(values) -> np.ndarray:
+    """Convert 'YYYY-MM-DD HH:...' strings to integer hours since the epoch."""
+    return np.array([v[:13].replace(' ', 'T') for v in values], dtype='datetime64[h]').astype(np.int64)
+
+def _hour_label(hour: int) -> str:
+    return str(np.datetime64(int(hour), 'h')).replace('T', ' ') + ':00:00'
+
+def _local_to_utc(value):
+    """Convert a naive local time, as detection_time is stored, to naive UTC."""
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _utc_to_local(value):
+    """Convert a naive UTC time, as weather_data.timestamp is stored, to naive local time."""
+    return value.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+def _local_hour_label(hour: int) -> str:
+    """Label a UTC hour of the grid in local time, like the rest of the UI."""
+    utc = datetime(1970, 1, 1) + timedelta(hours=int(hour))
+    return _utc_to_local(utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _rankdata(values: np.ndarray) -> np.ndarray:
+    """Average ranks, matching scipy.stats.rankdata's default tie handling."""
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    # Start index of each run of equal values
+    starts = np.concatenate(([True], sorted_values[1:] != sorted_values[:-1]))
+    run_ids = np.cumsum(starts) - 1
+    run_starts = np.flatnonzero(starts)
+    run_ends = np.concatenate((run_starts[1:], [len(values)]))
+    avg_rank = (run_starts + run_ends + 1) / 2.0
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[order] = avg_rank[run_ids]
+    return ranks
+
+def pearson(x: np.ndarray, y: np.ndarray) -> Optional[float]:
+    """Pearson correlation over the pairs where both values are finite."""
+    mask = np.isfinite(x) & np.isfinite(y)
+    if mask.sum() < 3:
+        return None
+    x = x[mask] - x[mask].mean()
+    y = y[mask] - y[mask].mean()
+    denom = np.sqrt(np.dot(x, x) * np.dot(y, y))
+    if denom == 0:
+        return None
+    return float(np.dot(x, y) / denom)
+
+def spearman(x: np.ndarray, y: np.ndarray) -> Optional[float]:
+    """Spearman rank correlation over the pairs where both values are finite."""
+    mask = np.isfinite(x) & np.isfinite(y)
+    if mask.sum() < 3:
+        return None
+    return pearson(_rankdata(x[mask]), _rankdata(y[mask]))
+
+def cross_correlation(x: np.ndarray, y: np.ndarray, max_lag: int) -> Dict:
+    """Pearson correlation of x[t] against y[t + lag] for lag in [-max_lag, max_lag].
+
+    A positive best lag means changes in x (weather) precede changes in y (activity).
+    """
+    lags = list(range(-max_lag, max_lag + 1))
+    correlations = []
+    for lag in lags:
+        if lag >= 0:
+            r = pearson(x[:len(x) - lag], y[lag:])
+        else:
+            r = pearson(x[-lag:], y[:len(y) + lag])
+        correlations.append(r)
+
+    valid = [(abs(r), lag, r) for lag, r in zip(lags, correlations) if r is not None]
+    best = max(valid) if valid else None
+    return {
+        'lags': lags,
+        'correlations': correlations,
+        'best_lag': best[1] if best else None,
+        'best_correlation': best[2] if best else None
+    }
+
+def activity_histogram(x: np.ndarray, counts: np.ndarray, bins: int) -> List[Dict]:
+    """Detections and observed hours per metric bin, with detections per hour."""
+    mask = np.isfinite(x) & np.isfinite(counts)
+    if not mask.any():
+        return []
+    x = x[mask]
+    counts = counts[mask]
+    low, high = float(x.min()), float(x.max())
+    if low == high:
+        high = low + 1.0
+    edges = np.linspace(low, high, bins + 1)
+    detections, _ = np.histogram(x, bins=edges, weights=counts)
+    hours, _ = np.histogram(x, bins=edges)
+    rates = np.divide(detections, hours, out=np.zeros_like(detections), where=hours > 0)
+    return [
+        {
+            'bin_start': round(float(edges[i]), 1),
+            'bin_end': round(float(edges[i + 1]), 1),
+            'detections': int(detections[i]),
+            'hours': int(hours[i]),
+            'rate': round(float(rates[i]), 2)
+        }
+        for i in range(bins)
+    ]
+
+
+class WeatherAnalytics:
+    """Hourly weather and detection-count series held in NumPy arrays.
+
+    The series cover a dense hourly grid so lags line up with real hours; hours
+    without a weather observation are NaN. Data is loaded once and afterwards
+    only the hours since the last refresh are re-read and appended.
+    """
+
+    def __init__(self, history_days: int = 90, refresh_interval: float = 60.0):
+        self.history_days = history_days
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._last_refresh = 0.0
+        self.hours = np.empty(0, dtype=np.int64)
+        self.metrics = {m: np.empty(0, dtype=np.float32) for m in METRICS}
+        # One row of hourly detection counts per species, NaN where there was no weather
+        self.species_index: Dict[str, int] = {}
+        self.counts = np.empty((0, 0), dtype=np.float32)
+
+    def refresh(self, force: bool = False) -> None:
+        """Load hours newer than the last refresh into the cached arrays."""
+        with self._lock:
+            if not force and time.monotonic() - self._last_refresh < self.refresh_interval:
+                return
+
+            if len(self.hours):
+                # The last hour may have been partial, so load it again
+                since = _hour_label(self.hours[-1])
+            else:
+                since = (datetime.utcnow() - timedelta(days=self.history_days)).strftime('%Y-%m-%d %H:00:00')
+
+            def do_load(session):
+                weather = session.execute(text(f"""
+                    SELECT strftime('%Y-%m-%d %H:00:00', timestamp) as hour,
+                        {', '.join(f'AVG({m})' for m in METRICS)}
+                    FROM weather_data
+                    WHERE timestamp >= :since
+                    GROUP BY hour
+                    ORDER BY hour
+                """), {"since": since}).fetchall()
+                activity = session.execute(text("""
+                    SELECT hour, display_name, SUM(detection_count)
+                    FROM weather_activity
+                    WHERE hour >= :since
+                    GROUP BY hour, display_name
+                """), {"since": since}).fetchall()
+                return weather, activity
+
+            weather, activity = db.execute_snapshot(do_load)
+            self._append(weather, activity)
+            self._last_refresh = time.monotonic()
+
+    def _append(self, weather, activity) -> None:
+        # Caller must hold self._lock
+        if not weather:
+            return
+        new_hours = _to_hours([row[0] for row in weather])
+        values = np.array([row[1:] for row in weather], dtype=np.float64).astype(np.float32)
+
+        start = int(self.hours[0]) if len(self.hours) else int(new_hours[0])
+        end = max(int(new_hours[-1]), int(self.hours[-1]) if len(self.hours) else start)
+        grid = np.arange(start, end + 1, dtype=np.int64)
+        keep = len(self.hours) - 1 if len(self.hours) else 0
+
+        metrics = {}
+        for i, m in enumerate(METRICS):
+            column = np.full(len(grid), np.nan, dtype=np.float32)
+            column[:keep] = self.metrics[m][:keep]
+            column[new_hours - start] = values[:, i]
+            metrics[m] = column
+
+        for _, species, _ in activity:
+            if species not in self.species_index:
+                self.species_index[species] = len(self.species_index)
+        counts = np.full((len(self.species_index), len(grid)), np.nan, dtype=np.float32)
+        counts[:self.counts.shape[0], :keep] = self.counts[:, :keep]
+        # Every hour with weather starts at zero detections for every species
+        counts[:, new_hours - start] = 0
+        if activity:
+            rows = np.array([self.species_index[a[1]] for a in activity])
+            cols = _to_hours([a[0] for a in activity]) - start
+            in_grid = (cols >= 0) & (cols < len(grid))
+            counts[rows[in_grid], cols[in_grid]] = np.array([a[2] for a in activity], dtype=np.float32)[in_grid]
+
+        # Trim anything older than the history window
+        cutoff = max(0, len(grid) - self.history_days * 24)
+        self.hours = grid[cutoff:]
+        self.metrics = {m: v[cutoff:] for m, v in metrics.items()}
+        self.counts = counts[:, cutoff:]
+
+    def window(self, days: int, species: Optional[str] = None, end: Optional[datetime] = None):
+        """Return hours, metric arrays and detection counts for the last `days` days before `end` (UTC)."""
+        self.refresh()
+        with self._lock:
+            if not len(self.hours):
+                return np.empty(0, dtype=np.int64), {m: np.empty(0, dtype=np.float32) for m in METRICS}, np.empty(0, dtype=np.float32)
+            end_hour = int(self.hours[-1]) if end is None else int(np.datetime64(end, 'h').astype(np.int64))
+            start_hour = end_hour - days * 24 + 1
+            lo = int(np.searchsorted(self.hours, start_hour))
+            hi = int(np.searchsorted(self.hours, end_hour, side='right'))
+            hours = self.hours[lo:hi]
+            metrics = {m: v[lo:hi] for m, v in self.metrics.items()}
+            if species is None:
+                counts = self.counts[:, lo:hi].sum(axis=0) if len(self.species_index) else np.zeros(hi - lo, dtype=np.float32)
+                # Keep hours without weather as NaN rather than summing to zero
+                counts = np.where(np.isfinite(metrics['temperature']), counts, np.nan)
+            elif species in self.species_index:
+                counts = self.counts[self.species_index[species], lo:hi]
+            else:
+                counts = np.where(np.isfinite(metrics['temperature']), 0, np.nan).astype(np.float32)
+            return hours, metrics, counts
+
+    def correlation(self, metric: str, days: int = 7, species: Optional[str] = None,
+                    end: Optional[datetime] = None, max_lag: int = 6, bins: int = 8) -> Dict:
+        """Correlation statistics and the hourly series for one weather metric.
+
+        ``end`` and the series timestamps are naive local times, like detection
+        times; the hourly grid itself is bucketed in UTC.
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown weather metric: {metric}")
+        if end is not None:
+            end = _local_to_utc(end)
+        hours, metrics, counts = self.window(days, species, end)
+        x = metrics[metric].astype(np.float64)
+        y = counts.astype(np.float64)
+        observed = np.isfinite(x) & np.isfinite(y)
+        return {
+            'metric': metric,
+            'hours': int(observed.sum()),
+            'pearson': pearson(x, y),
+            'spearman': spearman(x, y),
+            'lag': cross_correlation(x, y, max_lag),
+            'histogram': activity_histogram(x, y, bins),
+            'series': [
+                {
+                    'timestamp': _local_hour_label(h),
+                    'metric_value': round(float(v), 1),
+                    'detection_count': int(c)
+                }
+                for h, v, c in zip(hours[observed], x[observed], y[observed])
+            ]
+        }
+
+    def summary(self, days: int = 30, species: Optional[str] = None) -> Dict:
+        """Pearson and Spearman correlations of every metric against activity."""
+        _, metrics, counts = self.window(days, species)
+        y = counts.astype(np.float64)
+        return {
+            m: {
+                'pearson': pearson(metrics[m].astype(np.float64), y),
+                'spearman': spearman(metrics[m].astype(np.float64), y)
+            }
+            for m in METRICS
+        }
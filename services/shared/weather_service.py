@@ -1,125 +1,399 @@
-import sqlite3
 from datetime import datetime, timedelta
+import math
+import threading
 import yaml
 from pyowm import OWM
-from pyowm.utils import timestamps
+from sqlalchemy import text
+from .database import db
+from .weather_analytics import WeatherAnalytics, _local_to_utc, _utc_to_local
 import logging
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Detections are linked to the nearest weather observation within this window
+WEATHER_LINK_WINDOW = timedelta(hours=1)
+
+def _format_time(value):
+    """Format a datetime the way detection_time is stored, passing strings through."""
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+def link_detection_to_weather(session, detection_id, detection_time, window=WEATHER_LINK_WINDOW):
+    """Link a detection to the nearest weather observation within the window.
+
+    Used at detection ingest time. detection_time is local time, like the
+    detections table, and is converted to UTC to match weather_data. Both
+    lookups are range scans on idx_weather_timestamp, returning at most one
+    row each.
+    """
+    if isinstance(detection_time, str):
+        detection_time = datetime.strptime(detection_time[:19], '%Y-%m-%d %H:%M:%S')
+    detection_time = _local_to_utc(detection_time)
+    params = {
+        "id": detection_id,
+        "time": _format_time(detection_time),
+        "lo": _format_time(detection_time - window),
+        "hi": _format_time(detection_time + window)
+    }
+    nearest = session.execute(text("""
+        SELECT id FROM (
+            SELECT * FROM (
+                SELECT id, timestamp FROM weather_data
+                WHERE timestamp <= :time AND timestamp >= :lo
+                ORDER BY timestamp DESC LIMIT 1
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT id, timestamp FROM weather_data
+                WHERE timestamp > :time AND timestamp <= :hi
+                ORDER BY timestamp ASC LIMIT 1
+            )
+        )
+        ORDER BY ABS(julianday(timestamp) - julianday(:time))
+        LIMIT 1
+    """), params).scalar()
+
+    if nearest is None:
+        return None
+
+    session.execute(text("""
+        INSERT INTO detection_weather (detection_id, weather_id)
+        VALUES (:id, :weather_id)
+        ON CONFLICT(detection_id) DO UPDATE SET weather_id = excluded.weather_id
+    """), {"id": detection_id, "weather_id": nearest})
+    return nearest
+
+class OpenWeatherMapProvider:
+    """Current conditions from the OpenWeatherMap API."""
+
+    def __init__(self, api_key, lat, lon, units):
+        self.mgr = OWM(api_key).weather_manager()
+        self.lat = lat
+        self.lon = lon
+        self.units = units
+
+    def current(self):
+        observation = self.mgr.weather_at_coords(self.lat, self.lon)
+        weather = observation.weather
+        temp_unit = 'fahrenheit' if self.units == 'imperial' else 'celsius'
+        return {
+            'temperature': weather.temperature(temp_unit).get('temp'),
+            'feels_like': weather.temperature(temp_unit).get('feels_like'),
+            'humidity': weather.humidity,
+            'pressure': weather.pressure['press'],
+            'wind_speed': weather.wind()['speed'],
+            'wind_direction': weather.wind().get('deg', 0),
+            'precipitation': weather.rain.get('1h', 0.0),
+            'cloud_cover': weather.clouds,
+            'visibility': weather.visibility_distance,
+            'weather_condition': weather.status.lower()
+        }
+
+
+class StubWeatherProvider:
+    """Local provider that generates a plausible daily cycle without network access.
+
+    Selected with ``weather.provider: "stub"`` for development and testing.
+    """
+
+    def __init__(self, units='metric'):
+        self.units = units
+
+    def current(self):
+        now = datetime.now()
+        # Warmest mid-afternoon, coolest before dawn
+        phase = math.cos((now.hour + now.minute / 60 - 15) / 24 * 2 * math.pi)
+        temperature = 15 + 7 * phase
+        wind_speed = 3 + 2 * (1 - phase)
+        if self.units == 'imperial':
+            temperature = temperature * 9 / 5 + 32
+            wind_speed = wind_speed * 2.237
+        return {
+            'temperature': round(temperature, 1),
+            'feels_like': round(temperature, 1),
+            'humidity': 60,
+            'pressure': 1013,
+            'wind_speed': round(wind_speed, 1),
+            'wind_direction': 180,
+            'precipitation': 0.0,
+            'cloud_cover': 40,
+            'visibility': 10000,
+            'weather_condition': 'clouds'
+        }
+
+
 class WeatherService:
     def __init__(self, config_path='config/config.yml', db_path='data/speciesid.db'):
+        # db_path kept for compatibility but not used since we use the shared db manager
         self.db_path = db_path
         self.config = self._load_config(config_path)
-        self.owm = OWM(self.config['weather']['api_key'])
-        self.mgr = self.owm.weather_manager()
         self.lat = self.config['weather']['location']['lat']
         self.lon = self.config['weather']['location']['lon']
         self.units = self.config['weather'].get('units', 'metric')  # Default to metric if not specified
+        self.update_interval = self.config['weather'].get('update_interval', 300)
+        self.provider = self._create_provider()
+        self._latest = None
+        self._latest_lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._stop_polling = threading.Event()
+        self._poller = None
         self._verify_database()
+        self.analytics = WeatherAnalytics()
+
+    def _create_provider(self):
+        """Create the upstream weather provider named in the config."""
+        provider = self.config['weather'].get('provider', 'openweathermap')
+        if provider == 'stub':
+            return StubWeatherProvider(self.units)
+        if provider == 'openweathermap':
+            return OpenWeatherMapProvider(self.config['weather']['api_key'], self.lat, self.lon, self.units)
+        raise ValueError(f"Unknown weather provider: {provider}")
 
     def _verify_database(self):
         """Verify that the database exists and has the required tables, creating them if needed."""
+        def do_verify(session):
+            # Check and create weather_data table if needed
+            session.execute(text("""
+                CREATE TABLE IF NOT EXISTS weather_data (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp DATETIME NOT NULL,
+                    temperature REAL,
+                    feels_like REAL,
+                    humidity INTEGER,
+                    pressure INTEGER,
+                    wind_speed REAL,
+                    wind_direction INTEGER,
+                    precipitation REAL,
+                    cloud_cover INTEGER,
+                    visibility INTEGER,
+                    weather_condition TEXT,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """))
+            
+            # Create index on weather timestamp
+            session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_weather_timestamp 
+                ON weather_data(timestamp)
+            """))
+            
+            # Check and create detection_weather table if needed
+            session.execute(text("""
+                CREATE TABLE IF NOT EXISTS detection_weather (
+                    detection_id INTEGER PRIMARY KEY,
+                    weather_id INTEGER,
+                    FOREIGN KEY (detection_id) REFERENCES detections(id),
+                    FOREIGN KEY (weather_id) REFERENCES weather_data(id)
+                )
+            """))
+            
+            # Older databases created detection_weather without a key, so drop
+            # duplicate links before enforcing one link per detection
+            session.execute(text("""
+                DELETE FROM detection_weather
+                WHERE rowid NOT IN (
+                    SELECT MIN(rowid) FROM detection_weather GROUP BY detection_id
+                )
+            """))
+            session.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_detection_weather_detection
+                ON detection_weather(detection_id)
+            """))
+            session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_detection_weather_weather
+                ON detection_weather(weather_id)
+            """))
+            session.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_detections_time
+                ON detections(detection_time)
+            """))
+            
+            self._setup_weather_activity(session)
+
         try:
-            with self._get_db_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Check and create weather_data table if needed
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS weather_data (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        timestamp DATETIME NOT NULL,
-                        temperature REAL,
-                        feels_like REAL,
-                        humidity INTEGER,
-                        pressure INTEGER,
-                        wind_speed REAL,
-                        wind_direction INTEGER,
-                        precipitation REAL,
-                        cloud_cover INTEGER,
-                        visibility INTEGER,
-                        weather_condition TEXT,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Create index on weather timestamp
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_weather_timestamp 
-                    ON weather_data(timestamp)
-                """)
-                
-                # Check and create detection_weather table if needed
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS detection_weather (
-                        detection_id INTEGER,
-                        weather_id INTEGER,
-                        FOREIGN KEY (detection_id) REFERENCES detections(id),
-                        FOREIGN KEY (weather_id) REFERENCES weather_data(id)
-                    )
-                """)
-                
-                conn.commit()
-                logger.info("Database verification successful - all required tables exist or were created")
+            db.execute_write(do_verify)
+            logger.info("Database verification successful - all required tables exist or were created")
         except Exception as e:
             logger.error(f"Database verification failed: {str(e)}")
             raise
 
+    def _setup_weather_activity(self, session):
+        """Create the weather_activity aggregate and the triggers that maintain it.
+
+        weather_activity holds one row per weather observation and species with the
+        number of linked detections, plus a copy of the observation's conditions.
+        Triggers on detection_weather and detections keep the counts current, so
+        the correlation and pattern analyses never join the raw tables.
+        Species are keyed by detections.display_name, as in the detections table.
+        """
+        session.execute(text("""
+            CREATE TABLE IF NOT EXISTS weather_activity (
+                weather_id INTEGER NOT NULL,
+                display_name TEXT NOT NULL,
+                hour DATETIME NOT NULL,
+                weather_condition TEXT,
+                temperature REAL,
+                wind_speed REAL,
+                precipitation REAL,
+                cloud_cover INTEGER,
+                temp_bucket REAL,
+                detection_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (weather_id, display_name),
+                FOREIGN KEY (weather_id) REFERENCES weather_data(id)
+            )
+        """))
+        session.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_weather_activity_hour
+            ON weather_activity(hour)
+        """))
+        session.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_weather_activity_species_hour
+            ON weather_activity(display_name, hour)
+        """))
+
+        add_activity = """
+            INSERT INTO weather_activity (
+                weather_id, display_name, hour, weather_condition, temperature,
+                wind_speed, precipitation, cloud_cover, temp_bucket, detection_count
+            )
+            SELECT w.id, {species}, strftime('%Y-%m-%d %H:00:00', w.timestamp),
+                w.weather_condition, w.temperature, w.wind_speed, w.precipitation,
+                w.cloud_cover, ROUND((w.temperature - 5) / 10) * 10, 1
+            FROM weather_data w
+            WHERE w.id = {weather_id} AND {species} IS NOT NULL
+            ON CONFLICT(weather_id, display_name)
+            DO UPDATE SET detection_count = detection_count + 1;
+        """
+        remove_activity = """
+            UPDATE weather_activity SET detection_count = detection_count - 1
+            WHERE weather_id = {weather_id} AND display_name = {species};
+            DELETE FROM weather_activity
+            WHERE weather_id = {weather_id} AND display_name = {species}
+            AND detection_count <= 0;
+        """
+        link_species = "(SELECT display_name FROM detections WHERE id = {}.detection_id)"
+        triggers = {
+            "trg_weather_activity_link_insert": (
+                "AFTER INSERT ON detection_weather",
+                add_activity.format(weather_id="NEW.weather_id", species=link_species.format("NEW"))
+            ),
+            "trg_weather_activity_link_delete": (
+                "AFTER DELETE ON detection_weather",
+                remove_activity.format(weather_id="OLD.weather_id", species=link_species.format("OLD"))
+            ),
+            "trg_weather_activity_link_update": (
+                "AFTER UPDATE OF weather_id ON detection_weather",
+                remove_activity.format(weather_id="OLD.weather_id", species=link_species.format("OLD"))
+                + add_activity.format(weather_id="NEW.weather_id", species=link_species.format("NEW"))
+            ),
+            "trg_weather_activity_species_update": (
+                "AFTER UPDATE OF display_name ON detections "
+                "WHEN OLD.display_name IS NOT NEW.display_name",
+                remove_activity.format(
+                    weather_id="(SELECT weather_id FROM detection_weather WHERE detection_id = OLD.id)",
+                    species="OLD.display_name")
+                + add_activity.format(
+                    weather_id="(SELECT weather_id FROM detection_weather WHERE detection_id = NEW.id)",
+                    species="NEW.display_name")
+            )
+        }
+        for name, (event, body) in triggers.items():
+            session.execute(text(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END"))
+
+        # Backfill from links made before the aggregate existed
+        is_empty = session.execute(text("SELECT NOT EXISTS (SELECT 1 FROM weather_activity)")).scalar()
+        if is_empty:
+            session.execute(text("""
+                INSERT INTO weather_activity (
+                    weather_id, display_name, hour, weather_condition, temperature,
+                    wind_speed, precipitation, cloud_cover, temp_bucket, detection_count
+                )
+                SELECT w.id, d.display_name, strftime('%Y-%m-%d %H:00:00', w.timestamp),
+                    w.weather_condition, w.temperature, w.wind_speed, w.precipitation,
+                    w.cloud_cover, ROUND((w.temperature - 5) / 10) * 10, COUNT(*)
+                FROM detection_weather dw
+                JOIN weather_data w ON dw.weather_id = w.id
+                JOIN detections d ON dw.detection_id = d.id
+                WHERE d.display_name IS NOT NULL
+                GROUP BY w.id, d.display_name
+            """))
+
     def _load_config(self, config_path):
         """Load configuration from YAML file."""
         with open(config_path, 'r') as f:
             return yaml.safe_load(f)
 
-    def _get_db_connection(self):
-        """Create a database connection."""
-        try:
-            logger.info(f"Attempting to connect to database at: {self.db_path}")
-            conn = sqlite3.connect(self.db_path)
-            logger.info("Database connection successful")
-            return conn
-        except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            logger.error(f"Database connection error: {str(e)}\nTraceback:\n{error_details}")
-            raise
-
     def fetch_current_weather(self):
         """Fetch current weather data and store it in the database."""
+        with self._fetch_lock:
+            return self._fetch_and_store()
+
+    def _fetch_and_store(self):
+        # Caller must hold self._fetch_lock
         try:
-            observation = self.mgr.weather_at_coords(self.lat, self.lon)
-            weather = observation.weather
-            
-            # Extract weather data
-            temp_unit = 'fahrenheit' if self.units == 'imperial' else 'celsius'
             data = {
                 'timestamp': datetime.utcnow(),
-                'temperature': weather.temperature(temp_unit).get('temp'),
-                'feels_like': weather.temperature(temp_unit).get('feels_like'),
-                'units': self.units,  # Include units in response
-                'humidity': weather.humidity,
-                'pressure': weather.pressure['press'],
-                'wind_speed': weather.wind()['speed'],
-                'wind_direction': weather.wind().get('deg', 0),
-                'precipitation': weather.rain.get('1h', 0.0),
-                'cloud_cover': weather.clouds,
-                'visibility': weather.visibility_distance,
-                'weather_condition': weather.status.lower()
+                **self.provider.current()
             }
             
             # Store in database
             self._store_weather_data(data)
             logger.info(f"Stored weather data: {data}")
-            return {
+            result = {
                 **data,
                 'units': self.units  # Include units in response
             }
+            with self._latest_lock:
+                self._latest = result
+            return result
             
         except Exception as e:
             logger.error(f"Error fetching weather data: {e}")
             return None
 
+    def get_current_weather(self):
+        """Get the latest observation from the in-memory cache.
+
+        The background poller keeps the cache fresh. The provider is only called here
+        when nothing has been fetched yet or the poller has fallen behind.
+        """
+        max_age = timedelta(seconds=self.update_interval * 2)
+        with self._latest_lock:
+            latest = self._latest
+        if latest and datetime.utcnow() - latest['timestamp'] < max_age:
+            return latest
+
+        with self._fetch_lock:
+            # Another request may have refreshed the cache while we waited
+            with self._latest_lock:
+                latest = self._latest
+            if latest and datetime.utcnow() - latest['timestamp'] < max_age:
+                return latest
+            return self._fetch_and_store() or latest
+
+    def start_polling(self):
+        """Start the background thread that fetches weather every update_interval seconds."""
+        if self._poller and self._poller.is_alive():
+            return
+        self._stop_polling.clear()
+        self._poller = threading.Thread(target=self._poll, name="weather-poller", daemon=True)
+        self._poller.start()
+        logger.info(f"Weather poller started (interval {self.update_interval}s)")
+
+    def stop_polling(self):
+        """Stop the background weather poller."""
+        self._stop_polling.set()
+        if self._poller:
+            self._poller.join(timeout=5)
+
+    def _poll(self):
+        while not self._stop_polling.is_set():
+            self.fetch_current_weather()
+            self._stop_polling.wait(self.update_interval)
+
     def _store_weather_data(self, data):
         """Store weather data in the database."""
         query = """
@@ -134,25 +408,41 @@ class WeatherService:
         )
         """
         
-        with self._get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, data)
-            weather_id = cursor.lastrowid
+        def do_store(session):
+            weather_id = session.execute(text(query), data).lastrowid
             
             # Link to any detections in the same hour
-            self._link_weather_to_detections(cursor, weather_id, data['timestamp'])
-            conn.commit()
+            self._link_weather_to_detections(session, weather_id, data['timestamp'])
+
+        db.execute_write(do_store)
 
-    def _link_weather_to_detections(self, cursor, weather_id, timestamp):
-        """Link weather data to detections in the same hour."""
+    def _link_weather_to_detections(self, session, weather_id, timestamp, window=WEATHER_LINK_WINDOW):
+        """Link weather data to nearby detections.
+
+        Detections within the window are range-scanned on idx_detections_time.
+        Unlinked detections are linked to this observation, and linked ones are
+        moved over only if this observation is closer in time. The observation
+        is stamped in UTC and detections in local time, so the scan bounds are
+        converted to local time and detection times to UTC for the comparison.
+        """
         query = """
         INSERT INTO detection_weather (detection_id, weather_id)
-        SELECT id, ?
-        FROM detections
-        WHERE strftime('%Y-%m-%d %H', detection_time) = strftime('%Y-%m-%d %H', ?)
-        AND id NOT IN (SELECT detection_id FROM detection_weather)
+        SELECT d.id, :weather_id
+        FROM detections d
+        WHERE d.detection_time BETWEEN :lo AND :hi
+        ON CONFLICT(detection_id) DO UPDATE SET weather_id = excluded.weather_id
+        WHERE ABS(julianday(:timestamp) - julianday(
+                (SELECT d2.detection_time FROM detections d2 WHERE d2.id = detection_weather.detection_id), 'utc'))
+            < ABS(julianday(
+                (SELECT w.timestamp FROM weather_data w WHERE w.id = detection_weather.weather_id)) - julianday(
+                (SELECT d2.detection_time FROM detections d2 WHERE d2.id = detection_weather.detection_id), 'utc'))
         """
-        cursor.execute(query, (weather_id, timestamp))
+        session.execute(text(query), {
+            "weather_id": weather_id,
+            "timestamp": _format_time(timestamp),
+            "lo": _format_time(_utc_to_local(timestamp - window)),
+            "hi": _format_time(_utc_to_local(timestamp + window))
+        })
 
     def get_weather_for_detection(self, detection_id):
         """Get weather data for a specific detection."""
@@ -160,222 +450,185 @@ class WeatherService:
         SELECT w.*
         FROM weather_data w
         JOIN detection_weather dw ON w.id = dw.weather_id
-        WHERE dw.detection_id = ?
-        """
-        with self._get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, (detection_id,))
-            result = cursor.fetchone()
-            if result:
-                columns = [desc[0] for desc in cursor.description]
-                return dict(zip(columns, result))
-        return None
-
-    def get_weather_correlation(self, start_date, end_date, species=None):
-        """Get correlation between weather conditions and bird activity."""
-        species_clause = "AND d.display_name = ?" if species else ""
-        params = [start_date, end_date]
-        if species:
-            params.append(species)
-
-        query = f"""
-        SELECT 
-            w.temperature,
-            w.wind_speed,
-            w.precipitation,
-            w.cloud_cover,
-            COUNT(d.id) as detection_count,
-            strftime('%H', w.timestamp) as hour
-        FROM weather_data w
-        LEFT JOIN detection_weather dw ON w.id = dw.weather_id
-        LEFT JOIN detections d ON dw.detection_id = d.id
-        WHERE w.timestamp BETWEEN ? AND ?
-        {species_clause}
-        GROUP BY 
-            strftime('%Y-%m-%d %H', w.timestamp),
-            w.temperature,
-            w.wind_speed,
-            w.precipitation,
-            w.cloud_cover
-        ORDER BY w.timestamp
+        WHERE dw.detection_id = :id
         """
+        def do_query(session):
+            result = session.execute(text(query), {"id": detection_id}).fetchone()
+            return dict(result._mapping) if result else None
 
-        with self._get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            columns = [desc[0] for desc in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            return {
-                'results': results,
-                'units': self.units
-            }
+        return db.execute_read(do_query)
 
     def get_weather_patterns(self, species=None, days=30):
         """Analyze weather patterns during bird activity."""
-        with self._get_db_connection() as conn:
-            try:
-                cursor = conn.cursor()
-                species_clause = "AND d.display_name = ?" if species else ""
-                params = [days]
-                if species:
-                    params.append(species)
-
-                # First check if we have any weather data
-                check_query = """
-                SELECT COUNT(*) FROM weather_data w
-                WHERE datetime(w.timestamp) >= datetime('now', '-' || ? || ' days')
-                """
-                cursor.execute(check_query, [days])
-                weather_count = cursor.fetchone()[0]
-                
-                if weather_count == 0:
-                    logger.info("No weather data found for the specified period")
-                    return {
-                        'patterns': [],
-                        'insights': ["No weather data available for the specified period."],
-                        'units': self.units
-                    }
-
-                # Then check if we have any detections
-                check_query = """
-                SELECT COUNT(*) FROM detections d
-                JOIN detection_weather dw ON d.id = dw.detection_id
-                JOIN weather_data w ON dw.weather_id = w.id
-                WHERE datetime(w.timestamp) >= datetime('now', '-' || ? || ' days')
-                """
-                params = [days]
-                if species:
-                    check_query += " AND d.display_name = ?"
-                    params.append(species)
-                    
-                cursor.execute(check_query, params)
-                detection_count = cursor.fetchone()[0]
-                
-                if detection_count == 0:
-                    logger.info("No detections found for the specified period")
-                    return {
-                        'patterns': [],
-                        'insights': ["No bird activity detected during this period."],
-                        'units': self.units
-                    }
-
-                # If we have both weather data and detections, proceed with the main query
-                query = f"""
-                SELECT 
-                    w.weather_condition,
-                    ROUND(AVG(w.temperature), 1) as avg_temp,
-                    ROUND(AVG(w.wind_speed), 1) as avg_wind,
-                    COUNT(d.id) as total_detections,
-                    ROUND(COUNT(d.id) * 100.0 / SUM(COUNT(d.id)) OVER (), 1) as activity_percentage
-                FROM weather_data w
-                LEFT JOIN detection_weather dw ON w.id = dw.weather_id
-                LEFT JOIN detections d ON dw.detection_id = d.id
-                WHERE datetime(w.timestamp) >= datetime('now', '-' || ? || ' days')
-                {species_clause}
-                GROUP BY w.weather_condition
-                HAVING total_detections > 0
-                ORDER BY total_detections DESC
-                """
-
-                cursor.execute(query, params)
-                columns = [desc[0] for desc in cursor.description]
-                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                
-                if not results:
-                    return {
-                        'patterns': [],
-                        'insights': ["Not enough data to generate insights."],
-                        'units': self.units
-                    }
-
-                insights = []
-                
-                # Most active conditions
-                top_condition = results[0]
-                insights.append(
-                    f"Birds are most active during {top_condition['weather_condition']} conditions "
-                    f"({top_condition['activity_percentage']}% of activity)"
-                )
+        species_clause = "AND a.display_name = :species" if species else ""
+        params = {"days": days, "species": species}
+        query = None
 
-                # Temperature insights
-                temp_range = self._analyze_temperature_range(species)
-                if temp_range:
-                    unit = '°F' if self.units == 'imperial' else '°C'
-                    insights.append(
-                        f"Preferred temperature range: {temp_range['min_temp']}{unit} to {temp_range['max_temp']}{unit} "
-                        f"({temp_range['activity_percentage']}% of activity)"
-                    )
-
-                # Wind insights
-                wind_impact = self._analyze_wind_impact(species)
-                if wind_impact:
-                    speed_unit = 'mph' if self.units == 'imperial' else 'm/s'
-                    insights.append(
-                        f"Activity {wind_impact['trend']} when wind speeds are "
-                        f"{wind_impact['threshold']} {speed_unit}"
-                    )
+        def do_analyze(session):
+            nonlocal query
 
+            # First check if we have any weather data
+            check_query = """
+            SELECT COUNT(*) FROM weather_data w
+            WHERE w.timestamp >= datetime('now', '-' || :days || ' days')
+            """
+            weather_count = session.execute(text(check_query), params).scalar()
+            
+            if weather_count == 0:
+                logger.info("No weather data found for the specified period")
                 return {
-                    'patterns': results,
-                    'insights': insights,
+                    'patterns': [],
+                    'insights': ["No weather data available for the specified period."],
                     'units': self.units
                 }
 
-            except Exception as e:
-                import traceback
-                error_details = traceback.format_exc()
-                logger.error(f"Error getting weather patterns: {str(e)}\nTraceback:\n{error_details}")
-                # Log the query and parameters for debugging
-                logger.error(f"Failed query: {query}")
-                logger.error(f"Query parameters: {params}")
+            # Then check if we have any detections
+            check_query = f"""
+            SELECT COALESCE(SUM(a.detection_count), 0) FROM weather_activity a
+            WHERE a.hour >= strftime('%Y-%m-%d %H:00:00', 'now', '-' || :days || ' days')
+            {species_clause}
+            """
+            detection_count = session.execute(text(check_query), params).scalar()
+            
+            if detection_count == 0:
+                logger.info("No detections found for the specified period")
+                return {
+                    'patterns': [],
+                    'insights': ["No bird activity detected during this period."],
+                    'units': self.units
+                }
+
+            # If we have both weather data and detections, proceed with the main query
+            # Averages are weighted by the number of detections in each observation
+            query = f"""
+            SELECT 
+                a.weather_condition,
+                ROUND(SUM(a.temperature * a.detection_count) / SUM(a.detection_count), 1) as avg_temp,
+                ROUND(SUM(a.wind_speed * a.detection_count) / SUM(a.detection_count), 1) as avg_wind,
+                SUM(a.detection_count) as total_detections,
+                ROUND(SUM(a.detection_count) * 100.0 / SUM(SUM(a.detection_count)) OVER (), 1) as activity_percentage
+            FROM weather_activity a
+            WHERE a.hour >= strftime('%Y-%m-%d %H:00:00', 'now', '-' || :days || ' days')
+            {species_clause}
+            GROUP BY a.weather_condition
+            HAVING total_detections > 0
+            ORDER BY total_detections DESC
+            """
+
+            results = [dict(row._mapping) for row in session.execute(text(query), params).fetchall()]
+            
+            if not results:
                 return {
                     'patterns': [],
-                    'insights': [f"Error analyzing weather patterns: {str(e)}"],
+                    'insights': ["Not enough data to generate insights."],
                     'units': self.units
                 }
 
-    def _analyze_temperature_range(self, species=None):
+            insights = []
+            
+            # Most active conditions
+            top_condition = results[0]
+            insights.append(
+                f"Birds are most active during {top_condition['weather_condition']} conditions "
+                f"({top_condition['activity_percentage']}% of activity)"
+            )
+
+            # Temperature insights
+            temp_range = self._analyze_temperature_range(session, species)
+            if temp_range:
+                unit = '°F' if self.units == 'imperial' else '°C'
+                insights.append(
+                    f"Preferred temperature range: {temp_range['min_temp']}{unit} to {temp_range['max_temp']}{unit} "
+                    f"({temp_range['activity_percentage']}% of activity)"
+                )
+
+            # Wind insights
+            wind_impact = self._analyze_wind_impact(session, species)
+            if wind_impact:
+                speed_unit = 'mph' if self.units == 'imperial' else 'm/s'
+                insights.append(
+                    f"Activity {wind_impact['trend']} when wind speeds are "
+                    f"{wind_impact['threshold']} {speed_unit}"
+                )
+
+            return {
+                'patterns': results,
+                'insights': insights,
+                'units': self.units
+            }
+
+        try:
+            # All queries share one connection and see the same snapshot
+            result = db.execute_snapshot(do_analyze)
+            if result['patterns']:
+                result['statistics'] = self.analytics.summary(days, species)
+                insight = self._correlation_insight(result['statistics'])
+                if insight:
+                    result['insights'].append(insight)
+            return result
+        except Exception as e:
+            import traceback
+            error_details = traceback.format_exc()
+            logger.error(f"Error getting weather patterns: {str(e)}\nTraceback:\n{error_details}")
+            # Log the query and parameters for debugging
+            logger.error(f"Failed query: {query}")
+            logger.error(f"Query parameters: {params}")
+            return {
+                'patterns': [],
+                'insights': [f"Error analyzing weather patterns: {str(e)}"],
+                'units': self.units
+            }
+
+    def _correlation_insight(self, statistics):
+        """Describe the weather metric most strongly correlated with activity."""
+        ranked = [
+            (abs(stats['spearman']), metric, stats['spearman'])
+            for metric, stats in statistics.items()
+            if stats['spearman'] is not None
+        ]
+        if not ranked:
+            return None
+        strength, metric, rho = max(ranked)
+        if strength < 0.3:
+            return "No weather factor shows a strong link to activity"
+        direction = 'rises' if rho > 0 else 'falls'
+        return (
+            f"Activity {direction} with {metric.replace('_', ' ')} "
+            f"(Spearman correlation {rho:.2f})"
+        )
+
+    def _analyze_temperature_range(self, session, species=None):
         """Analyze preferred temperature ranges."""
-        species_clause = "AND d.display_name = ?" if species else ""
-        params = [30]  # Last 30 days
-        if species:
-            params.append(species)
+        species_clause = "AND a.display_name = :species" if species else ""
+        params = {"days": 30, "species": species}  # Last 30 days
 
         query = f"""
         SELECT 
-            MIN(temperature) as min_temp,
-            MAX(temperature) as max_temp,
-            COUNT(d.id) as detection_count,
-            COUNT(d.id) * 100.0 / SUM(COUNT(d.id)) OVER () as percentage
-        FROM weather_data w
-        JOIN detection_weather dw ON w.id = dw.weather_id
-        JOIN detections d ON dw.detection_id = d.id
-        WHERE datetime(w.timestamp) >= datetime('now', '-' || ? || ' days')
+            MIN(a.temperature) as min_temp,
+            MAX(a.temperature) as max_temp,
+            SUM(a.detection_count) as detection_count,
+            SUM(a.detection_count) * 100.0 / SUM(SUM(a.detection_count)) OVER () as percentage
+        FROM weather_activity a
+        WHERE a.hour >= strftime('%Y-%m-%d %H:00:00', 'now', '-' || :days || ' days')
         {species_clause}
-        GROUP BY 
-            ROUND((temperature - 5) / 10) * 10
+        GROUP BY a.temp_bucket
         ORDER BY detection_count DESC
         LIMIT 1
         """
 
-        with self._get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            result = cursor.fetchone()
-            if result:
-                return {
-                    'min_temp': round(result[0], 1),
-                    'max_temp': round(result[1], 1),
-                    'activity_percentage': round(result[3], 1)
-                }
+        result = session.execute(text(query), params).fetchone()
+        if result:
+            return {
+                'min_temp': round(result[0], 1),
+                'max_temp': round(result[1], 1),
+                'activity_percentage': round(result[3], 1)
+            }
         return None
 
-    def _analyze_wind_impact(self, species=None):
+    def _analyze_wind_impact(self, session, species=None):
         """Analyze impact of wind speed on activity."""
-        species_clause = "AND d.display_name = ?" if species else ""
-        params = [30]  # Last 30 days
-        if species:
-            params.append(species)
+        species_clause = "AND a.display_name = :species" if species else ""
+        params = {"days": 30, "species": species}  # Last 30 days
 
         # Wind speed thresholds (m/s for metric, mph for imperial)
         low_threshold = 11 if self.units == 'imperial' else 5
@@ -389,11 +642,9 @@ class WeatherService:
                     WHEN wind_speed <= {moderate_threshold} THEN 'moderate'
                     ELSE 'high'
                 END as wind_category,
-                COUNT(d.id) as detection_count
-            FROM weather_data w
-            JOIN detection_weather dw ON w.id = dw.weather_id
-            JOIN detections d ON dw.detection_id = d.id
-            WHERE datetime(w.timestamp) >= datetime('now', '-' || ? || ' days')
+                SUM(a.detection_count) as detection_count
+            FROM weather_activity a
+            WHERE a.hour >= strftime('%Y-%m-%d %H:00:00', 'now', '-' || :days || ' days')
             {species_clause}
             GROUP BY wind_category
         )
@@ -405,17 +656,14 @@ class WeatherService:
         ORDER BY detection_count DESC
         """
 
-        with self._get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            results = cursor.fetchall()
-            if results:
-                top_category = results[0]
-                speed_unit = 'mph' if self.units == 'imperial' else 'm/s'
-                if top_category[0] == 'low':
-                    return {'trend': 'peaks', 'threshold': f'below {low_threshold} {speed_unit}'}
-                elif top_category[0] == 'moderate':
-                    return {'trend': 'is optimal', 'threshold': f'between {low_threshold} and {moderate_threshold} {speed_unit}'}
-                else:
-                    return {'trend': 'continues', 'threshold': f'above {moderate_threshold} {speed_unit}'}
+        results = session.execute(text(query), params).fetchall()
+        if results:
+            top_category = results[0]
+            speed_unit = 'mph' if self.units == 'imperial' else 'm/s'
+            if top_category[0] == 'low':
+                return {'trend': 'peaks', 'threshold': f'below {low_threshold} {speed_unit}'}
+            elif top_category[0] == 'moderate':
+                return {'trend': 'is optimal', 'threshold': f'between {low_threshold} and {moderate_threshold} {speed_unit}'}
+            else:
+                return {'trend': 'continues', 'threshold': f'above {moderate_threshold} {speed_unit}'}
         return None
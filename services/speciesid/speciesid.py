@@ -2,48 +2,49 @@ import os
 os.environ['FLASK_ENV'] = 'production'
 os.environ['FLASK_DEBUG'] = '0'
 
-import numpy as np
 from datetime import datetime
 import time
-import multiprocessing
-import cv2
-from tflite_support.task import core
-from tflite_support.task import processor
-from tflite_support.task import vision
 import paho.mqtt.client as mqtt
-import hashlib
 import yaml
 import sys
 import json
 import requests
-import aiohttp
 import asyncio
-from PIL import Image, ImageOps
-from io import BytesIO
+import threading
 from sqlalchemy import text
 from shared.queries import get_common_name
 from concurrent.futures import ThreadPoolExecutor
 from shared.special_detection_service import SpecialDetectionService
+from shared.weather_service import link_detection_to_weather
 from shared.database import db
+from shared.frame import DecodedFrame
+from shared.preprocessing import Letterbox
+from shared.inference import create_classifier
+from shared.ensemble import EventEnsemble
+from shared.notifications import NotificationPublisher
 
 classifier = None
 config = None
 firstmessage = True
 special_detection_service = None
+ensemble = None
+# Long-lived channel to the websocket service
+publisher = NotificationPublisher()
+# One single-threaded executor per interpreter. Every frame of an event goes to
+# the same executor, so frames are fused and stored in the order they arrived
+handlers = []
+# Snapshots handed off but not yet processed, bounded by classification.queue_size
+pending = None
+# Each handler thread reuses its own 224x224x3 input buffer for the classifier
+preprocess = Letterbox((224, 224))
+
+def dispatch(frigate_event, fn, *args):
+    handlers[hash(frigate_event) % len(handlers)].submit(fn, *args)
 
 def classify(image):
+    """Classify a 224x224 RGB uint8 array, as produced by Letterbox."""
     try:
-        # Convert to RGB if needed
-        if len(image.shape) == 3 and image.shape[2] == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        tensor_image = vision.TensorImage.create_from_array(image)
-        result = classifier.classify(tensor_image)
-        
-        if not result.classifications:
-            return []
-        
-        return result.classifications[0].categories
+        return classifier.classify(image)
     except Exception as e:
         print(f"Error in classify function: {str(e)}", flush=True)
         return []
@@ -83,7 +84,7 @@ def set_sublabel(frigate_url, frigate_event, sublabel):
     except Exception as e:
         print(f"Error setting sublabel: {str(e)}", flush=True)
 
-async def process_special_detection(detection_id, score):
+async def process_special_detection(detection_id, score, detection_data):
     """Process special detection asynchronously"""
     try:
         special_detection_service.update_rarity_scores()
@@ -94,27 +95,22 @@ async def process_special_detection(detection_id, score):
             'behaviors': []
         }
         special_detection_service.evaluate_image_quality(detection_id, image_data)
-        special_detection_service.create_special_detection(detection_id)
+        special_id = special_detection_service.create_special_detection(detection_id)
+        if special_id:
+            await notify_websocket({
+                "type": "special",
+                "data": {**detection_data, "special_detection_id": special_id}
+            })
     except Exception as e:
         print(f"Error in special detection processing: {str(e)}", flush=True)
 
 async def notify_websocket(detection_data):
+    # Queued for the publisher thread, which keeps one websocket open and reconnects as needed
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post('http://websocket:8765/notify', json=detection_data) as response:
-                if response.status != 200:
-                    print(f"WebSocket notification failed: {response.status}", flush=True)
+        publisher.publish(detection_data)
     except Exception as e:
         print(f"WebSocket error: {str(e)}", flush=True)
 
-def process_image(image):
-    max_size = (224, 224)
-    image.thumbnail(max_size)
-    return ImageOps.expand(image, 
-        border=((max_size[0] - image.size[0]) // 2,
-                (max_size[1] - image.size[1]) // 2),
-        fill='black')
-
 def handle_detection(session, frigate_event, formatted_start_time, index, score, display_name, category_name, camera_name):
     """Handle database operations for a detection within a transaction"""
     # Check if detection exists
@@ -142,9 +138,9 @@ def handle_detection(session, frigate_event, formatted_start_time, index, score,
         detection_id = result.lastrowid
         return detection_id, True
     else:
-        existing_score = result[3]
-        if score > existing_score:
-            # Update existing detection
+        existing_index, existing_score = result[2], result[3]
+        if index != existing_index or score != existing_score:
+            # Update existing detection with the latest fused classification
             stmt = text("""
                 UPDATE detections
                 SET detection_time = :time, detection_index = :index,
@@ -159,11 +155,120 @@ def handle_detection(session, frigate_event, formatted_start_time, index, score,
                 "category": category_name,
                 "event": frigate_event
             })
-            return result[0], True
+            # Only a change of species needs the sublabel and notifications redone
+            return result[0], index != existing_index
     return None, False
 
-def on_message(client, userdata, message):
+def store_event_classification(session, frigate_event, frames, ranking, top_k=5):
+    """Keep the fused top-k for an event as a compact JSON list."""
+    session.execute(text("""
+        INSERT INTO event_classifications (frigate_event, frames, top_k, updated_at)
+        VALUES (:event, :frames, :top_k, CURRENT_TIMESTAMP)
+        ON CONFLICT(frigate_event) DO UPDATE SET
+            frames = excluded.frames,
+            top_k = excluded.top_k,
+            updated_at = excluded.updated_at
+    """), {
+        "event": frigate_event,
+        "frames": frames,
+        "top_k": json.dumps([c.to_dict() for c in ranking[:top_k]])
+    })
+
+def handle_event(payload_dict):
+    """Classify one event snapshot and store the result. Runs on a handler thread."""
     loop = None
+    try:
+        after_data = payload_dict['after']
+        frigate_event = after_data['id']
+        frigate_url = config['frigate']['frigate_url']
+        snapshot_url = frigate_url + "/api/events/" + frigate_event + "/snapshot.jpg"
+
+        params = {"crop": 1, "quality": 95}
+        response = requests.get(snapshot_url, params=params)
+
+        if response.status_code == 200:
+            # Decoded straight to classifier size
+            frame = DecodedFrame(response.content, draft_size=224)
+            categories = classify(preprocess(frame.rgb))
+            if not categories:
+                return
+
+            # Fuse this frame with the earlier frames of the same event
+            ranking = ensemble.add(frigate_event, categories)
+            frames = ensemble.frames(frigate_event)
+            if payload_dict.get('type') == 'end':
+                ensemble.finish(frigate_event)
+
+            category = ranking[0]
+            index = category.index
+            score = category.score
+            display_name = category.display_name
+            category_name = category.category_name
+
+            start_time = datetime.fromtimestamp(after_data['start_time'])
+            formatted_start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
+
+            if index == 964 or score <= config['classification']['threshold']:
+                return
+
+            def process_db(session):
+                detection_id, should_process = handle_detection(
+                    session, frigate_event, formatted_start_time,
+                    index, score, display_name, category_name,
+                    after_data['camera']
+                )
+                store_event_classification(session, frigate_event, frames, ranking,
+                                           config['classification'].get('top_k', 5))
+                return detection_id, should_process
+
+            try:
+                detection_id, should_process = db.execute_write(process_db)
+                
+                if should_process:
+                    # Attach the nearest weather observation, if any
+                    try:
+                        db.execute_write(link_detection_to_weather, detection_id, formatted_start_time)
+                    except Exception as e:
+                        print(f"Weather linkage error: {str(e)}", flush=True)
+
+                    common_name = get_common_name(display_name)
+                    set_sublabel(frigate_url, frigate_event, common_name)
+
+                    # Process special detection and WebSocket notification asynchronously
+                    try:
+                        loop = asyncio.new_event_loop()
+                        asyncio.set_event_loop(loop)
+                        
+                        detection_data = {
+                            "common_name": common_name,
+                            "scientific_name": display_name,
+                            "score": score,
+                            "frigate_event": frigate_event,
+                            "timestamp": formatted_start_time,
+                            "camera": after_data['camera'],
+                            "detection_id": detection_id
+                        }
+                        
+                        tasks = [
+                            process_special_detection(detection_id, score, detection_data),
+                            notify_websocket({"type": "detection", "data": detection_data})
+                        ]
+                        loop.run_until_complete(asyncio.gather(*tasks))
+                    except Exception as e:
+                        print(f"Async processing error: {str(e)}", flush=True)
+                    finally:
+                        if loop:
+                            loop.close()
+
+            except Exception as e:
+                print(f"Database operation error: {str(e)}", flush=True)
+
+    except Exception as e:
+        print(f"Message processing error: {str(e)}", flush=True)
+    finally:
+        pending.release()
+
+def on_message(client, userdata, message):
     global firstmessage
 
     if not firstmessage:
@@ -173,76 +278,13 @@ def on_message(client, userdata, message):
 
             if (after_data['camera'] in config['frigate']['camera'] and
                     after_data['label'] == 'bird'):
-
-                frigate_event = after_data['id']
-                frigate_url = config['frigate']['frigate_url']
-                snapshot_url = frigate_url + "/api/events/" + frigate_event + "/snapshot.jpg"
-
-                params = {"crop": 1, "quality": 95}
-                response = requests.get(snapshot_url, params=params)
-
-                if response.status_code == 200:
-                    image = Image.open(BytesIO(response.content))
-                    padded_image = process_image(image)
-                    np_arr = np.array(padded_image)
-
-                    categories = classify(np_arr)
-                    if not categories:
-                        return
-
-                    category = categories[0]
-                    index = category.index
-                    score = category.score
-                    display_name = category.display_name
-                    category_name = category.category_name
-
-                    start_time = datetime.fromtimestamp(after_data['start_time'])
-                    formatted_start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
-
-                    if index == 964 or score <= config['classification']['threshold']:
-                        return
-
-                    def process_db(session):
-                        detection_id, should_process = handle_detection(
-                            session, frigate_event, formatted_start_time,
-                            index, score, display_name, category_name,
-                            after_data['camera']
-                        )
-                        return detection_id, should_process
-
-                    try:
-                        detection_id, should_process = db.execute_write(process_db)
-                        
-                        if should_process:
-                            common_name = get_common_name(display_name)
-                            set_sublabel(frigate_url, frigate_event, common_name)
-
-                            # Process special detection and WebSocket notification asynchronously
-                            try:
-                                loop = asyncio.new_event_loop()
-                                asyncio.set_event_loop(loop)
-                                
-                                detection_data = {
-                                    "common_name": common_name,
-                                    "scientific_name": display_name,
-                                    "score": score,
-                                    "frigate_event": frigate_event,
-                                    "timestamp": formatted_start_time
-                                }
-                                
-                                tasks = [
-                                    process_special_detection(detection_id, score),
-                                    notify_websocket(detection_data)
-                                ]
-                                loop.run_until_complete(asyncio.gather(*tasks))
-                            except Exception as e:
-                                print(f"Async processing error: {str(e)}", flush=True)
-                            finally:
-                                if loop:
-                                    loop.close()
-
-                    except Exception as e:
-                        print(f"Database operation error: {str(e)}", flush=True)
+                # Hand off, so this thread only waits once queue_size snapshots are pending
+                pending.acquire()
+                try:
+                    dispatch(after_data['id'], handle_event, payload_dict)
+                except Exception:
+                    pending.release()
+                    raise
 
         except Exception as e:
             print(f"Message processing error: {str(e)}", flush=True)
@@ -265,6 +307,15 @@ def setupdb():
                 camera_name TEXT NOT NULL 
             )    
         """))
+        # Fused top-k classification across all frames of each event
+        session.execute(text("""
+            CREATE TABLE IF NOT EXISTS event_classifications (
+                frigate_event TEXT PRIMARY KEY,
+                frames INTEGER NOT NULL,
+                top_k TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
     
     db.execute_write(do_setup)
 
@@ -295,22 +346,21 @@ def main():
         global special_detection_service
         special_detection_service = SpecialDetectionService('/data/speciesid.db')
 
-        # Initialize TFLite model
-        base_options = core.BaseOptions(
-            file_name=config['classification']['model'], 
-            use_coral=False, 
-            num_threads=4)
-        classification_options = processor.ClassificationOptions(
-            max_results=1, 
-            score_threshold=0)
-        options = vision.ImageClassifierOptions(
-            base_options=base_options, 
-            classification_options=classification_options)
-
+        # Initialize TFLite interpreter pool
         global classifier
-        classifier = vision.ImageClassifier.create_from_options(options)
+        classifier = create_classifier(config)
         print("TFLite model initialized successfully", flush=True)
 
+        global ensemble
+        ensemble = EventEnsemble(classifier.num_classes)
+
+        # One handler per interpreter keeps every interpreter busy while the MQTT thread reads on
+        global handlers, pending
+        interpreters = config['classification'].get('interpreters', 1)
+        handlers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"event-handler-{i}")
+                    for i in range(interpreters)]
+        pending = threading.BoundedSemaphore(config['classification'].get('queue_size', 32))
+
         setupdb()
         
         # Start MQTT client
@@ -1,8 +1,13 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from typing import List
+from collections import deque
+from typing import Dict, List, Optional, Set
+import asyncio
 import json
 import logging
+import os
 import socket
+from shared.backplane import create_backplane
+from shared.notifications import decode_entry, message_topics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -10,52 +15,294 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+class Client:
+    """A connected websocket with its own bounded outbound queue and writer task.
+
+    ``topics`` is None until the client subscribes, and then it receives every
+    message. After subscribing, it only receives messages that share at least
+    one topic with its subscriptions.
+
+    With a ``batch_window`` (in seconds), the writer waits that long after the
+    first queued message and sends everything that arrived as one JSON array
+    frame. Without one, every message is its own frame.
+    """
+
+    def __init__(self, websocket: WebSocket, queue_size: int, batch_window: float = 0.0):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_window = batch_window
+        self.writer = None
+        self.topics: Optional[Set[str]] = None
+        # Missed messages sent ahead of the queue when resuming
+        self.replay: List[str] = []
+
+    def wants(self, topics: Optional[Set[str]]) -> bool:
+        return self.topics is None or topics is None or not self.topics.isdisjoint(topics)
+
+def batch_frame(messages: List[str]) -> str:
+    """Join already serialized JSON messages into one JSON array."""
+    return f"[{','.join(messages)}]"
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """Tracks websocket clients and fans messages out to them.
+
+    Broadcasting only puts the message on each client's queue, so one slow
+    client cannot hold up the others. A client whose queue fills up, or whose
+    send takes longer than ``send_timeout``, is disconnected.
+
+    Published messages get a sequence number and the last ``history_size`` are
+    kept in a ring buffer. A reconnecting client passes the last sequence
+    number it saw, with the server ``epoch`` it came from, and is sent only the
+    messages it missed. If the epoch changed (server restart) or the gap is
+    older than the buffer, the client is told to resync over REST instead.
+
+    Clients can ask for batched delivery with a window of up to
+    ``max_batch_window`` seconds; each batch holds at most ``max_batch`` messages.
+
+    Sequence numbers and the epoch come from the ``backplane``, which carries
+    published messages to every server process (see shared.backplane). Each
+    process delivers them to its own clients in ``deliver``.
+    """
 
-    async def connect(self, websocket: WebSocket):
+    def __init__(self, backplane, queue_size: int = 100, send_timeout: float = 10.0,
+                 history_size: int = 500, max_batch: int = 100, max_batch_window: float = 1.0):
+        self.backplane = backplane
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.max_batch = max_batch
+        self.max_batch_window = max_batch_window
+        self.active_connections: Dict[WebSocket, Client] = {}
+        self.seq = 0
+        self.history = deque(maxlen=history_size)
+
+    @property
+    def epoch(self) -> str:
+        return self.backplane.epoch
+
+    async def start(self):
+        history = await self.backplane.start(self.deliver, lambda: len(self.active_connections))
+        self.history.extend(history)
+        self.seq = self.backplane.seq
+
+    async def stop(self):
+        await self.backplane.stop()
+
+    async def connect(self, websocket: WebSocket, since: Optional[int] = None,
+                      epoch: Optional[str] = None, topics: Optional[Set[str]] = None,
+                      batch_window: float = 0.0):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = Client(websocket, self.queue_size, min(max(batch_window, 0.0), self.max_batch_window))
+        client.topics = topics
+
+        resync = False
+        if since is not None:
+            oldest = self.history[0][0] if self.history else self.seq + 1
+            if epoch != self.epoch or since > self.seq or since < oldest - 1:
+                resync = True
+            else:
+                client.replay = [message for seq, entry_topics, message in self.history
+                                 if seq > since and client.wants(entry_topics)]
+        client.replay.insert(0, json.dumps({
+            "type": "hello",
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "replayed": len(client.replay),
+            "resync": resync
+        }))
+
+        client.writer = asyncio.create_task(self._write(client))
+        self.active_connections[websocket] = client
         logger.info(f"New connection. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        if client.writer and client.writer is not asyncio.current_task():
+            client.writer.cancel()
         logger.info(f"Connection closed. Total connections: {len(self.active_connections)}")
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting message: {e}")
+    async def _write(self, client: Client):
+        try:
+            if client.batch_window:
+                for start in range(0, len(client.replay), self.max_batch):
+                    await self._send_frame(client, batch_frame(client.replay[start:start + self.max_batch]))
+            else:
+                for message in client.replay:
+                    await self._send_frame(client, message)
+            client.replay = []
+            while True:
+                message = await client.queue.get()
+                if not client.batch_window:
+                    await self._send_frame(client, message)
+                    continue
+                # Let the burst accumulate, then take everything queued so far
+                await asyncio.sleep(client.batch_window)
+                batch = [message]
+                while len(batch) < self.max_batch and not client.queue.empty():
+                    batch.append(client.queue.get_nowait())
+                await self._send_frame(client, batch_frame(batch))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Dropping client after failed send: {e}")
+            await self._close(client, code=1011)
+
+    async def _send_frame(self, client: Client, frame: str):
+        await asyncio.wait_for(client.websocket.send_text(frame), self.send_timeout)
+
+    async def _close(self, client: Client, code: int):
+        self.disconnect(client.websocket)
+        try:
+            await client.websocket.close(code=code)
+        except Exception:
+            # The socket is usually already gone
+            pass
+
+    def send(self, client: Client, message: str) -> bool:
+        """Queue a message for one client, evicting it if its queue is full."""
+        try:
+            client.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Evicting slow websocket client with a full send queue")
+            self.disconnect(client.websocket)
+            # 1013: try again later
+            asyncio.create_task(self._close(client, code=1013))
+            return False
 
-manager = ConnectionManager()
+    async def broadcast(self, message: str, topics: Optional[Set[str]] = None) -> int:
+        """Queue a message for every client subscribed to one of its topics.
+
+        Returns the number of clients it was queued for.
+        """
+        delivered = 0
+        for client in list(self.active_connections.values()):
+            if client.wants(topics) and self.send(client, message):
+                delivered += 1
+        return delivered
+
+    async def publish(self, data: dict) -> int:
+        """Publish a notification to the clients of every worker. Returns its sequence number."""
+        return await self.publish_serialized(json.dumps(data), message_topics(data))
+
+    async def publish_serialized(self, payload: str, topics: Set[str]) -> int:
+        """Publish an already serialized JSON object without decoding it again."""
+        return await self.backplane.publish(payload, topics)
+
+    async def deliver(self, seq: int, topics: Set[str], message: str) -> None:
+        """Record a numbered message from the backplane and queue it for this worker's clients."""
+        self.seq = seq
+        self.history.append((seq, topics, message))
+        await self.broadcast(message, topics)
+
+    def handle_control(self, websocket: WebSocket, data: str) -> None:
+        """Handle a control message from a client: ping, subscribe or unsubscribe."""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        try:
+            message = json.loads(data)
+            message_type = message.get('type')
+        except (ValueError, AttributeError):
+            self.send(client, json.dumps({"type": "error", "error": "Control messages must be JSON objects"}))
+            return
+
+        if message_type == 'ping':
+            self.send(client, json.dumps({"type": "pong"}))
+            return
+        if message_type not in ('subscribe', 'unsubscribe'):
+            self.send(client, json.dumps({"type": "error", "error": f"Unknown message type: {message_type}"}))
+            return
+
+        topics = message.get('topics')
+        if not isinstance(topics, list) or not all(isinstance(t, str) for t in topics):
+            self.send(client, json.dumps({"type": "error", "error": "topics must be a list of strings"}))
+            return
+
+        if message_type == 'subscribe':
+            # '*' returns the client to receiving everything
+            client.topics = None if '*' in topics else (client.topics or set()) | set(topics)
+        elif client.topics is not None:
+            client.topics -= set(topics)
+        self.send(client, json.dumps({
+            "type": "subscribed",
+            "topics": ['*'] if client.topics is None else sorted(client.topics)
+        }))
+
+# 'memory' only works with one worker; 'sqlite' shares messages between workers
+BACKPLANE = os.environ.get('WS_BACKPLANE', 'memory')
+WORKERS = int(os.environ.get('WS_WORKERS', '1'))
+if WORKERS > 1 and BACKPLANE == 'memory':
+    logger.warning("WS_WORKERS > 1 needs a shared backplane, using 'sqlite'")
+    BACKPLANE = 'sqlite'
+
+manager = ConnectionManager(create_backplane(BACKPLANE))
+
+@app.on_event("startup")
+async def startup():
+    await manager.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await manager.stop()
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, since: Optional[int] = None,
+                             epoch: Optional[str] = None, topics: Optional[str] = None,
+                             batch: Optional[int] = None):
+    # ?since=<seq>&epoch=<epoch> resumes after a reconnect, ?topics=a,b subscribes up front,
+    # ?batch=<ms> asks for messages to be sent as JSON arrays collected over that window
+    await manager.connect(websocket, since, epoch, set(topics.split(',')) if topics else None,
+                          (batch or 0) / 1000)
     try:
         while True:
             data = await websocket.receive_text()
-            # Echo received messages back to all clients
-            await manager.broadcast(data)
+            manager.handle_control(websocket, data)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(websocket)
 
+@app.websocket("/publish")
+async def publish_endpoint(websocket: WebSocket):
+    """Long-lived channel for other services to publish notifications.
+
+    Each frame holds one or more newline-separated "<topic,topic>\\t<json object>"
+    entries (see shared.notifications), so payloads are never decoded here.
+    """
+    await websocket.accept()
+    logger.info("Publisher connected")
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            for entry in frame.split('\n'):
+                if not entry:
+                    continue
+                try:
+                    topics, payload = decode_entry(entry)
+                    if not payload.rstrip().endswith('}'):
+                        raise ValueError("payload is not a JSON object")
+                except ValueError as e:
+                    logger.error(f"Ignoring malformed published entry: {e}")
+                    continue
+                await manager.publish_serialized(payload, topics)
+    except WebSocketDisconnect:
+        logger.info("Publisher disconnected")
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    # connections and workers are totals across all workers
+    stats = await manager.backplane.stats()
+    return {"status": "healthy", **stats, "worker_connections": len(manager.active_connections),
+            "epoch": manager.epoch, "seq": manager.seq}
 
 @app.post("/notify")
 async def notify_clients(data: dict):
     try:
-        message = json.dumps(data)
-        await manager.broadcast(message)
-        return {"status": "success"}
+        seq = await manager.publish(data)
+        return {"status": "success", "seq": seq}
     except Exception as e:
         logger.error(f"Error in notify_clients: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -63,10 +310,14 @@ async def notify_clients(data: dict):
 if __name__ == "__main__":
     import uvicorn
     port = 8765
-    
+    # permessage-deflate is used when the client offers it, which browsers do
+    per_message_deflate = os.environ.get('WS_PER_MESSAGE_DEFLATE', '1') != '0'
+
     logger.info("Starting WebSocket server...")
     try:
-        uvicorn.run(app, host="0.0.0.0", port=port, log_level="info")
+        # Workers import the app by name so each process builds its own manager
+        uvicorn.run("websocket_server:app", host="0.0.0.0", port=port, log_level="info",
+                    workers=WORKERS, ws_per_message_deflate=per_message_deflate)
     except Exception as e:
         logger.error(f"Failed to start WebSocket server: {e}")
         exit(1)
@@ -4,10 +4,11 @@ set -e
 # Initialize the database
 echo "Initializing database..."
 
-# Drop and recreate image_quality table to ensure correct schema
+# Create image_quality table if needed. Existing rows hold enhancement state, so
+# the table is kept across restarts; migrations/fix_image_quality_schema.sql
+# rebuilds it if an old schema needs fixing.
 sqlite3 /data/speciesid.db << 'EOF'
-DROP TABLE IF EXISTS image_quality;
-CREATE TABLE image_quality (
+CREATE TABLE IF NOT EXISTS image_quality (
     detection_id INTEGER PRIMARY KEY,
     clarity_score REAL,
     composition_score REAL,
@@ -17,6 +18,9 @@ CREATE TABLE image_quality (
     enhancement_status TEXT CHECK(enhancement_status IN ("pending", "completed", "failed")),
     quality_improvement REAL,
     visibility_score REAL,
+    image_hash TEXT,
+    quality_scores TEXT,
+    enhanced_quality_scores TEXT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (detection_id) REFERENCES detections(id)
 );
@@ -6,11 +6,17 @@ import yaml
 import requests
 from io import BytesIO
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 from shared.queries import recent_detections, get_daily_summary, get_common_name, get_records_for_date_hour
 from shared.queries import get_records_for_scientific_name_and_date, get_earliest_detection_date
 from shared.weather_service import WeatherService
+from shared.weather_analytics import METRICS as WEATHER_METRICS
 from shared.special_detection_service import SpecialDetectionService
 from shared.image_processing import ImageProcessingService
+from shared.enhancement_jobs import EnhancementJobQueue
+from shared.notifications import NotificationPublisher
+from shared.vision_priority import VisionPriorityScheduler
+from shared.database import DatabaseManager
 import os
 import json
 
@@ -21,6 +27,10 @@ DBPATH = '/data/speciesid.db'
 weather_service = None
 special_detection_service = None
 image_processing_service = None
+enhancement_jobs = None
+vision_scheduler = None
+# Long-lived channel to the websocket service
+publisher = NotificationPublisher()
 
 # Custom JSON encoder to handle SQLite Row objects
 class SQLiteJSONEncoder(json.JSONEncoder):
@@ -173,13 +183,26 @@ def serve_vue_app(path):
     return send_from_directory(dist_dir, 'index.html')
 
 def load_config():
-    global config, weather_service, special_detection_service, image_processing_service
+    global config, weather_service, special_detection_service, image_processing_service, enhancement_jobs
+    global vision_scheduler
     file_path = './config/config.yml'
     with open(file_path, 'r') as config_file:
         config = yaml.safe_load(config_file)
     weather_service = WeatherService(file_path, DBPATH)
+    weather_service.start_polling()
     special_detection_service = SpecialDetectionService(DBPATH)
     image_processing_service = ImageProcessingService(file_path)
+    queue_config = config['image_processing'].get('enhancement_queue', {})
+    enhancement_jobs = EnhancementJobQueue(
+        image_processing_service,
+        config['frigate']['frigate_url'],
+        workers=queue_config.get('workers', 2),
+        max_attempts=queue_config.get('max_attempts', 3),
+        retry_delay=queue_config.get('retry_delay', 30),
+        publisher=publisher
+    )
+    enhancement_jobs.start()
+    vision_scheduler = VisionPriorityScheduler(database=DatabaseManager(DBPATH))
 
 load_config()
 
@@ -187,7 +210,7 @@ load_config()
 @app.route('/api/weather/current')
 def api_current_weather():
     try:
-        data = weather_service.fetch_current_weather()
+        data = weather_service.get_current_weather()
         if data:
             return jsonify(data)
         abort(500, description="Failed to fetch weather data")
@@ -200,49 +223,62 @@ def api_weather_correlation():
         date = request.args.get('date', type=str)
         hour = request.args.get('hour', type=str)
         metric = request.args.get('metric', type=str, default='temperature')
+        species = request.args.get('species', type=str)
+        days = request.args.get('days', default=7, type=int)
+        if metric not in WEATHER_METRICS:
+            abort(400, description=f"Unknown metric, expected one of: {', '.join(WEATHER_METRICS)}")
         
-        if not date or hour is None:
-            abort(400, description="date and hour are required")
-        
-        # Convert hour-based request to a time range
-        try:
-            dt = datetime.strptime(f"{date} {hour}:00:00", "%Y-%m-%d %H:%M:%S")
-            start_date = dt.strftime("%Y-%m-%d %H:00:00")
-            end_date = dt.strftime("%Y-%m-%d %H:59:59")
-        except ValueError:
-            abort(400, description="Invalid date or hour format")
+        # The window ends at the requested local hour, or at the latest data when none is given
+        end = None
+        if date:
+            try:
+                end = datetime.strptime(f"{date} {hour or 23}:00:00", "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                abort(400, description="Invalid date or hour format")
             
-        data = weather_service.get_weather_correlation(start_date, end_date)
+        stats = weather_service.analytics.correlation(metric, days=days, species=species, end=end)
+        units = weather_service.units
         
-        # Format response for the chart
-        correlations = []
-        for result in data['results']:
-            correlations.append({
-                'timestamp': dt.strftime("%Y-%m-%d %H:%M:%S"),
-                'metric_value': result.get(metric, 0),
-                'detection_count': result['detection_count'],
-                'weather_condition': result.get('weather_condition', '')
-            })
-            
-        # Generate insight based on the correlation
-        total_detections = sum(r['detection_count'] for r in correlations)
-        if total_detections > 0:
-            max_period = max(correlations, key=lambda x: x['detection_count'])
-            insight = f"Peak activity occurred when {metric} was {max_period['metric_value']}"
+        # Generate insight from the statistics
+        if any(bin['detections'] for bin in stats['histogram']):
+            unit = ''
             if metric == 'temperature':
-                insight += f"°{'F' if data['units'] == 'imperial' else 'C'}"
+                unit = f"°{'F' if units == 'imperial' else 'C'}"
             elif metric == 'wind_speed':
-                insight += f" {'mph' if data['units'] == 'imperial' else 'm/s'}"
+                unit = f" {'mph' if units == 'imperial' else 'm/s'}"
             elif metric in ['humidity', 'cloud_cover']:
-                insight += "%"
+                unit = "%"
+            peak = max(stats['histogram'], key=lambda b: b['rate'])
+            insight = (
+                f"Activity peaks when {metric.replace('_', ' ')} is "
+                f"{peak['bin_start']}{unit} to {peak['bin_end']}{unit} "
+                f"({peak['rate']} detections/hour)"
+            )
+            if stats['pearson'] is not None:
+                insight += f". Correlation r = {stats['pearson']:.2f}"
+                lag = stats['lag']
+                if lag['best_lag']:
+                    insight += (
+                        f", strongest when activity {'lags' if lag['best_lag'] > 0 else 'leads'} "
+                        f"{metric.replace('_', ' ')} by {abs(lag['best_lag'])}h"
+                    )
         else:
             insight = "No bird activity detected during this period"
             
         return jsonify({
-            'correlations': correlations,
+            'correlations': stats['series'],
             'insight': insight,
-            'units': data['units']
+            'units': units,
+            'statistics': {
+                'pearson': stats['pearson'],
+                'spearman': stats['spearman'],
+                'lag': stats['lag'],
+                'histogram': stats['histogram'],
+                'hours': stats['hours']
+            }
         })
+    except HTTPException:
+        raise
     except Exception as e:
         abort(500, description=str(e))
 
@@ -286,6 +322,7 @@ def api_special_detections_by_type(highlight_type):
         if highlight_type not in ['rare', 'quality', 'behavior']:
             abort(400, description="Invalid highlight type")
             
+        generation = special_detection_service.votes.generation
         conn = sqlite3.connect(DBPATH)
         cursor = conn.cursor()
         cursor.execute("""
@@ -312,6 +349,8 @@ def api_special_detections_by_type(highlight_type):
         results = [dict(zip(columns, row)) for row in cursor.fetchall()]
         conn.close()
         
+        # Include votes that have not been flushed to the database yet
+        special_detection_service.votes.merge_rows(results, generation)
         return jsonify(results)
     except Exception as e:
         print(f"Error fetching special detections by type: {e}", flush=True)
@@ -325,14 +364,16 @@ def api_vote_special_detection(special_detection_id):
         if not isinstance(data, dict) or 'increment' not in data:
             abort(400, description="Missing increment parameter")
             
-        special_detection_service.update_community_votes(
+        votes = special_detection_service.update_community_votes(
             special_detection_id,
             increment=data['increment']
         )
-        return jsonify({"success": True})
     except Exception as e:
         print(f"Error updating votes: {e}", flush=True)
         abort(500, description=str(e))
+    if votes is None:
+        abort(404, description="Special detection not found")
+    return jsonify({"success": True, "community_votes": votes})
 
 @app.route('/api/special-detections/<int:special_detection_id>/featured', methods=['POST'])
 def api_toggle_featured_status(special_detection_id):
@@ -368,7 +409,7 @@ def api_image_quality(detection_id):
         image_path = f"{frigate_url}/api/events/{result[0]}/snapshot.jpg"
         
         # Process image quality
-        quality_result = image_processing_service.process_image(image_path)
+        quality_result = image_processing_service.process_image(image_path, detection_id)
         return jsonify(quality_result)
     except Exception as e:
         print(f"Error assessing image quality: {e}", flush=True)
@@ -408,104 +449,95 @@ def enhanced_thumbnail(frigate_event):
 
 @app.route('/api/image/enhance/<int:detection_id>')
 def api_enhance_image(detection_id):
-    """Enhance image for a detection if needed."""
+    """Queue image enhancement for a detection."""
     try:
-        # Get image path from detection
         conn = sqlite3.connect(DBPATH)
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT frigate_event
-            FROM detections
-            WHERE id = ?
-        """, (detection_id,))
+        cursor.execute("SELECT 1 FROM detections WHERE id = ?", (detection_id,))
         result = cursor.fetchone()
         conn.close()
         
         if not result:
             abort(404, description="Detection not found")
             
-        # Construct image path
-        frigate_url = config['frigate']['frigate_url']
-        image_path = f"{frigate_url}/api/events/{result[0]}/snapshot.jpg"
-        
-        # Process and enhance image
-        enhancement_result = image_processing_service.process_image(image_path)
-        
-        # Return enhanced image path if enhancement was performed
-        if enhancement_result['enhanced']:
-            return jsonify({
-                "enhanced": True,
-                "original_path": f"/frigate/{result[0]}/snapshot.jpg",
-                "enhanced_path": enhancement_result['enhanced_path'],
-                "quality_scores": enhancement_result['quality_scores'],
-                "enhanced_quality_scores": enhancement_result.get('enhanced_quality_scores')
-            })
-        else:
-            return jsonify({
-                "enhanced": False,
-                "message": "Image quality above threshold, no enhancement needed",
-                "quality_scores": enhancement_result['quality_scores']
-            })
+        # Single requests come from someone looking at the image, so run them first
+        priority = request.args.get('priority', default=10, type=int)
+        job_id = enhancement_jobs.enqueue(detection_id, priority=priority)
+        return jsonify({
+            "job_id": job_id,
+            "detection_id": detection_id,
+            "status": "pending",
+            "status_url": f"/api/image/jobs/{job_id}"
+        }), 202
     except Exception as e:
-        print(f"Error enhancing image: {e}", flush=True)
+        print(f"Error queueing enhancement: {e}", flush=True)
         abort(500, description=str(e))
 
 @app.route('/api/image/batch-process', methods=['POST'])
 def api_batch_process_images():
-    """Process multiple images for quality assessment and enhancement."""
+    """Queue multiple images for quality assessment and enhancement."""
     try:
         data = request.get_json()
         if not isinstance(data, dict) or 'detection_ids' not in data:
             abort(400, description="Missing detection_ids parameter")
             
         detection_ids = data['detection_ids']
-        results = []
+        priority = int(data.get('priority', 0))
+        if not detection_ids:
+            return jsonify({"queued": 0, "jobs": []}), 202
+        
+        conn = sqlite3.connect(DBPATH)
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT id FROM detections WHERE id IN ({','.join('?' * len(detection_ids))})",
+            detection_ids
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        conn.close()
         
+        jobs = []
         for detection_id in detection_ids:
-            try:
-                # Get image path
-                conn = sqlite3.connect(DBPATH)
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT frigate_event
-                    FROM detections
-                    WHERE id = ?
-                """, (detection_id,))
-                result = cursor.fetchone()
-                conn.close()
-                
-                if result:
-                    frigate_url = config['frigate']['frigate_url']
-                    image_path = f"{frigate_url}/api/events/{result[0]}/snapshot.jpg"
-                    
-                    # Process image
-                    process_result = image_processing_service.process_image(image_path)
-                    results.append({
-                        "detection_id": detection_id,
-                        "success": True,
-                        "result": process_result
-                    })
-                else:
-                    results.append({
-                        "detection_id": detection_id,
-                        "success": False,
-                        "error": "Detection not found"
-                    })
-            except Exception as e:
-                results.append({
+            if detection_id in existing:
+                jobs.append({
                     "detection_id": detection_id,
-                    "success": False,
-                    "error": str(e)
+                    "job_id": enhancement_jobs.enqueue(detection_id, priority=priority)
+                })
+            else:
+                jobs.append({
+                    "detection_id": detection_id,
+                    "job_id": None,
+                    "error": "Detection not found"
                 })
         
         return jsonify({
-            "processed": len(results),
-            "results": results
-        })
+            "queued": sum(1 for job in jobs if job['job_id']),
+            "jobs": jobs
+        }), 202
     except Exception as e:
         print(f"Error in batch processing: {e}", flush=True)
         abort(500, description=str(e))
 
+@app.route('/api/vision/priorities')
+def api_vision_priorities():
+    """Unanalysed detections ranked by expected value, marking those today's vision budget covers."""
+    try:
+        openai_config = config['image_processing'].get('remote_models', {}).get('openai', {})
+        cost_limit = request.args.get('cost_limit', default=openai_config.get('cost_limit', 5.0), type=float)
+        days = request.args.get('days', default=7, type=int)
+        limit = request.args.get('limit', default=100, type=int)
+        return jsonify(vision_scheduler.plan(cost_limit, days=days, limit=limit))
+    except Exception as e:
+        print(f"Error ranking vision candidates: {e}", flush=True)
+        abort(500, description=str(e))
+
+@app.route('/api/image/jobs/<int:job_id>')
+def api_enhancement_job(job_id):
+    """Get the status of an enhancement job."""
+    job = enhancement_jobs.get_job(job_id)
+    if job:
+        return jsonify(job)
+    abort(404, description="Job not found")
+
 if __name__ == '__main__':
     # Enable debug mode in development
     debug = os.environ.get('FLASK_DEBUG', '0') == '1'
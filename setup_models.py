@@ -70,7 +70,12 @@ def setup_tf_iqa():
     model.save(model_path)
     print(f"Basic quality model saved to: {model_path}")
     
-    return model_path
+    # The quality service runs the TFLite version with the XNNPACK CPU delegate
+    tflite_path = tf_iqa_dir / 'model.tflite'
+    tflite_path.write_bytes(tf.lite.TFLiteConverter.from_keras_model(model).convert())
+    print(f"TFLite quality model saved to: {tflite_path}")
+    
+    return tflite_path
 
 def setup_real_esrgan():
     """Setup RealESRGAN model."""
@@ -114,8 +119,8 @@ def test_models(test_image_path: str = None):
     try:
         # Test TF-IQA
         print("\nTesting TF-IQA model...")
-        from image_processing import TFIQAModel
-        tf_iqa = TFIQAModel('models/quality/tf-iqa-model/model.h5')
+        from services.shared.quality import TFLiteQualityModel
+        tf_iqa = TFLiteQualityModel('models/quality/tf-iqa-model/model.tflite', threshold=0.7)
         quality_scores = tf_iqa.assess_quality(image)
         print(f"Quality scores: {quality_scores}")
         
@@ -156,7 +161,7 @@ def update_config():
     
     # Update model paths
     config['image_processing']['local_models']['quality_assessment']['model_path'] = \
-        'models/quality/tf-iqa-model/model.h5'
+        'models/quality/tf-iqa-model/model.tflite'
     config['image_processing']['local_models']['enhancement']['model_path'] = \
         'models/enhancement/RealESRGAN_x4plus/RealESRGAN_x4plus.pth'
     
@@ -0,0 +1,162 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import yaml
+from services.shared.database import DatabaseManager
+from services.shared.enhancement import EnhancementError
+from services.shared.enhancement_jobs import EnhancementJobQueue
+from services.shared.image_processing import ImageProcessingService
+
+SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'screenshot.jpg')
+
+class FakeFrigate:
+    """Serves screenshot.jpg as every event snapshot."""
+
+    def __init__(self):
+        with open(SNAPSHOT, 'rb') as f:
+            content = f.read()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def close(self):
+        self.server.shutdown()
+
+
+class FailingEnhancer:
+    def __init__(self):
+        self.calls = 0
+
+    def enhance(self, image, timeout=None):
+        self.calls += 1
+        raise EnhancementError("backend failed")
+
+
+class RecordingPublisher:
+    """Stands in for NotificationPublisher, keeping what was published."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, data):
+        self.messages.append(data)
+
+
+def make_database(tmp):
+    db_path = os.path.join(tmp, 'speciesid.db')
+    conn = sqlite3.connect(db_path)
+    with open(os.path.join(os.path.dirname(SNAPSHOT), 'init_db.sql')) as f:
+        conn.executescript(f.read())
+    conn.execute("INSERT INTO detections (id, detection_time, frigate_event) VALUES (1, '2024-01-01 12:00:00', 'event-1')")
+    conn.commit()
+    conn.close()
+    return db_path, DatabaseManager(db_path)
+
+def make_processor(tmp, database, threshold=1.01):
+    """An ImageProcessingService whose enhancer always fails.
+
+    With the default threshold every snapshot is below it, so every job enhances.
+    """
+    config_path = os.path.join(tmp, 'config.yml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump({'image_processing': {
+            'dedup': {'enabled': False},
+            'local_models': {
+                'quality_assessment': {'type': 'basic', 'threshold': threshold},
+                'enhancement': {'type': 'stub'}
+            }
+        }}, f)
+    processor = ImageProcessingService(config_path, database=database)
+    processor.enhancer = FailingEnhancer()
+    return processor
+
+def test_failing_enhancement_fails_job_after_max_attempts():
+    """Enhancement errors are retried with backoff and then fail the job, without saving an image."""
+    frigate = FakeFrigate()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path, database = make_database(tmp)
+            processor = make_processor(tmp, database)
+            publisher = RecordingPublisher()
+            jobs = EnhancementJobQueue(processor, frigate.url, workers=1, max_attempts=3, retry_delay=0,
+                                       publisher=publisher, poll_interval=0.05, database=database)
+            job_id = jobs.enqueue(1)
+            jobs.start()
+            try:
+                deadline = time.monotonic() + 20
+                while jobs.get_job(job_id)['status'] != 'failed' and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            finally:
+                jobs.stop()
+
+            job = jobs.get_job(job_id)
+            assert job['status'] == 'failed', job
+            assert job['attempts'] == 3
+            assert 'backend failed' in job['error']
+            assert job['enhanced_path'] is None
+            assert processor.enhancer.calls == 3
+            assert [m['data']['status'] for m in publisher.messages] == [
+                'queued', 'processing', 'retrying', 'processing', 'retrying', 'processing', 'failed']
+            conn = sqlite3.connect(db_path)
+            status = conn.execute("SELECT enhancement_status FROM image_quality WHERE detection_id = 1").fetchone()[0]
+            conn.close()
+            assert status == 'failed'
+    finally:
+        frigate.close()
+
+def test_failing_enhancement_leaves_result_unenhanced():
+    """Outside the job queue a failed enhancement returns the scores, not an "enhanced" original."""
+    frigate = FakeFrigate()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            _, database = make_database(tmp)
+            processor = make_processor(tmp, database)
+            result = processor.process_image(f"{frigate.url}/api/events/event-1/snapshot.jpg", 1)
+            assert result['enhanced'] is False
+            assert result['enhanced_path'] is None
+            assert 'enhanced_quality_scores' not in result
+    finally:
+        frigate.close()
+
+def test_stored_results_keep_every_score():
+    """A result read back from image_quality after a restart has the same scores as the fresh one."""
+    frigate = FakeFrigate()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            _, database = make_database(tmp)
+            fresh = make_processor(tmp, database, threshold=0.0).process_image(
+                f"{frigate.url}/api/events/event-1/snapshot.jpg", 1)
+            restarted = make_processor(tmp, database, threshold=0.0)
+            stored = restarted.get_cached_results(1)
+            assert stored['quality_scores'] == fresh['quality_scores']
+            assert stored['quality_improvement'] is None
+    finally:
+        frigate.close()
+
+def main():
+    print("Testing enhancement job failures...")
+    test_failing_enhancement_fails_job_after_max_attempts()
+    test_failing_enhancement_leaves_result_unenhanced()
+    test_stored_results_keep_every_score()
+    print("✓ Enhancement job tests passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import cv2
+import numpy as np
+from services.shared.database import DatabaseManager
+from services.shared.perceptual_hash import HashBuckets, PerceptualHashIndex, dhash, hamming, to_signed, to_unsigned
+
+def bird_frame(seed=0, size=(480, 640)):
+    """A smooth synthetic scene, standing in for a feeder snapshot."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return cv2.resize(small, (size[1], size[0]), interpolation=cv2.INTER_CUBIC)
+
+def test_dhash_survives_reencoding_and_resizing():
+    image = bird_frame()
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 60])
+    reencoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    smaller = cv2.resize(image, (320, 240), interpolation=cv2.INTER_AREA)
+    brighter = cv2.convertScaleAbs(image, alpha=1.0, beta=20)
+    base = dhash(image)
+    assert hamming(base, dhash(reencoded)) <= 4
+    assert hamming(base, dhash(smaller)) <= 4
+    assert hamming(base, dhash(brighter)) <= 4
+
+def test_dhash_separates_different_scenes():
+    assert hamming(dhash(bird_frame(1)), dhash(bird_frame(2))) > 10
+
+def test_dhash_matches_across_color_orders():
+    image = bird_frame()
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    assert dhash(image) == dhash(rgb, rgb=True) == dhash(gray)
+
+def test_signed_round_trip():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= to_signed(value) < (1 << 63)
+        assert to_unsigned(to_signed(value)) == value
+
+def test_buckets_match_brute_force():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    # Near-duplicates of the first few hashes
+    hashes += [h ^ (1 << rng.randrange(64)) for h in hashes[:50]]
+    index = HashBuckets()
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    assert len(index) == len(hashes)
+    for query in hashes[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        for max_distance in (0, 6, 12):
+            expected = sorted(i for i, h in enumerate(hashes) if hamming(query, h) <= max_distance)
+            assert sorted(i for _, i in index.search(query, max_distance)) == expected
+
+def test_index_refreshes_other_services_on_interval():
+    """Own hashes are found at once; another service's after its refresh interval."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'speciesid.db')
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE detections (id INTEGER PRIMARY KEY, detection_time DATETIME)")
+        conn.executemany("INSERT INTO detections VALUES (?, '2024-01-01 12:00:00')", [(1,), (2,), (3,)])
+        conn.commit()
+        conn.close()
+        database = DatabaseManager(db_path)
+        phash = dhash(bird_frame())
+        local = PerceptualHashIndex(refresh_interval=3600, database=database)
+        other = PerceptualHashIndex(refresh_interval=3600, database=database)
+
+        local.add(1, phash)
+        local.add(2, phash ^ 1)
+        assert local.near_duplicates(1, phash) == [2]
+        # The first hash stored for a detection is kept
+        local.add(2, phash ^ 0xFFFF)
+        assert local.near_duplicates(1, phash) == [2]
+
+        other.add(3, phash)
+        assert local.near_duplicates(1, phash) == [2]
+        local.refresh(force=True)
+        assert sorted(local.near_duplicates(1, phash)) == [2, 3]
+        assert len(local._hashes) == 3
+
+def benchmark(count=100000, queries=200):
+    """Compare bucketed lookups with a linear scan."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(count)]
+    index = HashBuckets()
+    for i, h in enumerate(hashes):
+        index.add(h, i)
+    probes = [hashes[rng.randrange(count)] ^ 0b101 for _ in range(queries)]
+
+    start = time.perf_counter()
+    for query in probes:
+        index.search(query, 6)
+    index_ms = (time.perf_counter() - start) * 1000 / queries
+
+    start = time.perf_counter()
+    for query in probes:
+        [i for i, h in enumerate(hashes) if hamming(query, h) <= 6]
+    scan_ms = (time.perf_counter() - start) * 1000 / queries
+
+    print(f"Hash buckets: {index_ms:.2f} ms/lookup over {count} hashes")
+    print(f"Linear scan:  {scan_ms:.2f} ms/lookup")
+
+def main():
+    print("Testing perceptual hashing...")
+    test_dhash_survives_reencoding_and_resizing()
+    test_dhash_separates_different_scenes()
+    test_dhash_matches_across_color_orders()
+    test_signed_round_trip()
+    test_buckets_match_brute_force()
+    test_index_refreshes_other_services_on_interval()
+    print("✓ Perceptual hash tests passed")
+
+    print("\nBenchmarking lookups...")
+    benchmark()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+from io import BytesIO
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from services.shared.frame import DecodedFrame
+from services.shared.preprocessing import Letterbox, letterbox
+
+SIZES = [(224, 224), (223, 224), (301, 157), (157, 301), (1, 1000), (1080, 1920), (100, 80)]
+
+def old_preprocess(content):
+    """The previous speciesid path: PIL thumbnail, ImageOps.expand, np.array."""
+    image = Image.open(BytesIO(content))
+    image.thumbnail((224, 224))
+    padded = ImageOps.expand(image,
+        border=((224 - image.size[0]) // 2, (224 - image.size[1]) // 2),
+        fill='black')
+    return np.array(padded)
+
+def test_letterbox_shape():
+    """Every input size produces exactly the model input shape."""
+    for height, width in SIZES:
+        image = np.full((height, width, 3), 200, dtype=np.uint8)
+        result = letterbox(image)
+        assert result.shape == (224, 224, 3), (height, width, result.shape)
+        assert result.dtype == np.uint8
+
+def test_letterbox_pads_with_black():
+    """A wide image is centred with black bars above and below."""
+    result = letterbox(np.full((100, 200, 3), 255, dtype=np.uint8))
+    assert result[:50].max() == 0
+    assert result[-50:].max() == 0
+    # The outermost columns blend slightly with the black border
+    assert result[112, 1:-1].min() == 255
+
+def test_letterbox_reuses_buffer():
+    """The buffer is reused, and the padding is rewritten for each image."""
+    preprocess = Letterbox((224, 224))
+    first = preprocess(np.full((224, 224, 3), 255, dtype=np.uint8))
+    second = preprocess(np.full((100, 200, 3), 255, dtype=np.uint8))
+    assert first is second
+    assert second[0].max() == 0
+
+def test_letterbox_matches_old_path_for_elongated_crops():
+    """A long, thin crop is shrunk about 4.5x; fine detail averages out as PIL's thumbnail did."""
+    image = np.zeros((250, 1000, 3), dtype=np.uint8)
+    image[:, ::2] = 255
+    ok, encoded = cv2.imencode('.png', image)
+    old = old_preprocess(encoded.tobytes())
+    new = letterbox(image)
+    # Rows 84-139 hold the 224x56 scaled image in both
+    difference = np.abs(old.astype(np.int16) - new.astype(np.int16))[84:140]
+    assert difference.mean() < 8, difference.mean()
+
+def test_decoded_frame_draft_size():
+    """A draft decode is reduced but stays at least the requested size."""
+    ok, encoded = cv2.imencode('.jpg', np.random.randint(0, 255, (1000, 600, 3), dtype=np.uint8))
+    frame = DecodedFrame(encoded.tobytes(), draft_size=224)
+    assert min(frame.shape[:2]) >= 224
+    assert frame.shape[:2] != (1000, 600)
+    assert Letterbox((224, 224))(frame.rgb).shape == (224, 224, 3)
+
+def benchmark(image_path='screenshot.jpg', iterations=200):
+    """Compare the old PIL path with draft decode plus letterbox."""
+    with open(image_path, 'rb') as f:
+        content = f.read()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        old = old_preprocess(content)
+    old_ms = (time.perf_counter() - start) * 1000 / iterations
+
+    preprocess = Letterbox((224, 224))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        new = preprocess(DecodedFrame(content, draft_size=224).rgb)
+    new_ms = (time.perf_counter() - start) * 1000 / iterations
+
+    print(f"Old PIL path:        {old_ms:.2f} ms/image, output {old.shape}")
+    print(f"Draft + letterbox:   {new_ms:.2f} ms/image, output {new.shape}")
+
+def main():
+    print("Testing preprocessing...")
+    test_letterbox_shape()
+    test_letterbox_pads_with_black()
+    test_letterbox_reuses_buffer()
+    test_letterbox_matches_old_path_for_elongated_crops()
+    test_decoded_frame_draft_size()
+    print("✓ Preprocessing tests passed")
+
+    print("\nBenchmarking preprocessing...")
+    benchmark()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import cv2
+import numpy as np
+from openai import AsyncOpenAI
+from vision_service import VisionService
+
+ANALYSIS = {"clarity_score": 0.9, "composition_score": 0.7, "behaviors": ["feeding"], "special_notes": ""}
+
+class FakeOpenAI:
+    """A local stand-in for the chat completions endpoint.
+
+    Each call takes ``delay`` seconds and uses ``tokens`` tokens. The first
+    ``rate_limited`` calls get a 429 with a short Retry-After.
+    """
+
+    def __init__(self, delay=0.05, tokens=1000, rate_limited=0):
+        self.delay = delay
+        self.tokens = tokens
+        self.rate_limited = rate_limited
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                with fake.lock:
+                    fake.calls += 1
+                    limited = fake.calls <= fake.rate_limited
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                try:
+                    if limited:
+                        self._reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                    {"retry-after": "0.05"})
+                        return
+                    time.sleep(fake.delay)
+                    self._reply(200, {
+                        "id": "chatcmpl-test",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": "gpt-4-vision-preview",
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": json.dumps(ANALYSIS)},
+                            "finish_reason": "stop"
+                        }],
+                        "usage": {"prompt_tokens": fake.tokens - 100, "completion_tokens": 100,
+                                  "total_tokens": fake.tokens}
+                    })
+                finally:
+                    with fake.lock:
+                        fake.active -= 1
+
+            def _reply(self, status, body, headers=None):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    def close(self):
+        self.server.shutdown()
+
+
+def make_service(fake, tmp, detections=0, **kwargs):
+    """A VisionService on a fresh database with ``detections`` detections that all have snapshots."""
+    db_path = os.path.join(tmp, 'speciesid.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE detections (id INTEGER PRIMARY KEY, frigate_event TEXT)")
+    for i in range(1, detections + 1):
+        conn.execute("INSERT INTO detections VALUES (?, ?)", (i, f"event-{i}"))
+        os.makedirs(os.path.join(tmp, f"event-{i}"))
+        with open(os.path.join(tmp, f"event-{i}", "snapshot.jpg"), 'wb') as f:
+            f.write(b'jpeg')
+    conn.commit()
+    conn.close()
+    client = AsyncOpenAI(base_url=fake.url, api_key='test', max_retries=0)
+    return VisionService(db_path, client=client, events_path=tmp, **kwargs)
+
+def daily_cost(service):
+    return service.get_daily_costs(days=1)[0]['total_cost']
+
+def test_batch_limits_concurrency():
+    """Every image is analysed, never with more calls in flight than max_concurrency."""
+    fake = FakeOpenAI(delay=0.05)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=12, max_concurrency=3, requests_per_minute=6000)
+            results = asyncio.run(service.batch_process_images(list(range(1, 13)), batch_size=8))
+            assert results == {"processed": 12, "failed": 0, "skipped": 0}, results
+            assert fake.max_active <= 3, fake.max_active
+            assert abs(daily_cost(service) - 0.12) < 1e-9
+    finally:
+        fake.close()
+
+def test_retries_rate_limited_calls():
+    """A 429 is retried after the server's Retry-After instead of failing the image."""
+    fake = FakeOpenAI(rate_limited=2)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=1)
+            image_path = os.path.join(tmp, "event-1", "snapshot.jpg")
+            assert asyncio.run(service.analyze_image(1, image_path)) == ANALYSIS
+            assert fake.calls == 3
+    finally:
+        fake.close()
+
+def test_batch_stops_at_cost_limit():
+    """In-flight calls reserve their expected cost, so the limit is not overshot."""
+    fake = FakeOpenAI(delay=0.05)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=10, max_concurrency=5, requests_per_minute=6000)
+            results = asyncio.run(service.batch_process_images(list(range(1, 11)), batch_size=5, cost_limit=0.03))
+            assert results == {"processed": 3, "failed": 0, "skipped": 7}, results
+            assert fake.calls == 3
+            assert daily_cost(service) <= 0.03 + 1e-9
+    finally:
+        fake.close()
+
+def test_token_bucket_rate():
+    """Past the initial burst, calls are spaced by the configured rate."""
+    fake = FakeOpenAI(delay=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=6, max_concurrency=2, requests_per_minute=600)
+            start = time.monotonic()
+            asyncio.run(service.batch_process_images(list(range(1, 7)), batch_size=6))
+            # 2 calls in the burst, then 4 more at 10 per second
+            assert time.monotonic() - start >= 0.35
+    finally:
+        fake.close()
+
+def test_process_by_priority_spends_budget_on_top_ranked():
+    """Only the highest ranked detections that the budget covers are analysed."""
+    class Scheduler:
+        def rank(self, days, limit):
+            return [SimpleNamespace(detection_id=i) for i in [5, 2, 7, 1, 3][:limit]]
+
+    fake = FakeOpenAI(delay=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=8, requests_per_minute=6000)
+            results = asyncio.run(service.process_by_priority(Scheduler(), batch_size=1, cost_limit=0.02))
+            assert results["processed"] == 2, results
+            conn = sqlite3.connect(os.path.join(tmp, 'speciesid.db'))
+            analysed = {row[0] for row in conn.execute("SELECT detection_id FROM vision_analysis_cache")}
+            conn.close()
+            assert analysed == {5, 2}, analysed
+    finally:
+        fake.close()
+
+def test_process_by_priority_ranks_own_database():
+    """Without a scheduler, detections are ranked from the service's db_path, not /data."""
+    fake = FakeOpenAI(delay=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=3, requests_per_minute=6000)
+            conn = sqlite3.connect(os.path.join(tmp, 'speciesid.db'))
+            conn.execute("ALTER TABLE detections ADD COLUMN display_name TEXT DEFAULT 'Turdus migratorius'")
+            conn.execute("ALTER TABLE detections ADD COLUMN score REAL")
+            conn.execute("ALTER TABLE detections ADD COLUMN detection_time TIMESTAMP")
+            conn.execute("CREATE TABLE image_quality (detection_id INTEGER PRIMARY KEY, clarity_score REAL)")
+            conn.executemany("UPDATE detections SET score = ?, detection_time = datetime('now', 'localtime') WHERE id = ?", [(0.8, 1), (0.95, 2), (0.7, 3)])
+            conn.commit()
+            results = asyncio.run(service.process_by_priority(batch_size=1, cost_limit=0.01))
+            assert results["processed"] == 1, results
+            analysed = [row[0] for row in conn.execute("SELECT detection_id FROM vision_analysis_cache")]
+            conn.close()
+            assert analysed == [2], analysed
+            # Schedulers share one database manager rather than creating an engine each
+            assert service.priority_scheduler().db is service.priority_scheduler().db
+            service.close()
+    finally:
+        fake.close()
+
+def test_near_duplicate_reuses_analysis():
+    """A snapshot close to an analysed one copies its analysis without an API call."""
+    class Index:
+        """Stands in for PerceptualHashIndex, treating every indexed detection as a duplicate."""
+        def __init__(self):
+            self.hashes = {}
+
+        def add(self, detection_id, phash):
+            self.hashes.setdefault(detection_id, phash)
+
+        def near_duplicates(self, detection_id, phash):
+            return [other for other in self.hashes if other != detection_id]
+
+    fake = FakeOpenAI(delay=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=0, phash_index=Index())
+            ok, encoded = cv2.imencode('.jpg', np.full((240, 320, 3), 128, dtype=np.uint8))
+            paths = []
+            for i in (1, 2):
+                paths.append(os.path.join(tmp, f"snapshot-{i}.jpg"))
+                with open(paths[-1], 'wb') as f:
+                    f.write(encoded.tobytes())
+            assert asyncio.run(service.analyze_image(1, paths[0])) == ANALYSIS
+            assert asyncio.run(service.analyze_image(2, paths[1])) == ANALYSIS
+            assert fake.calls == 1
+            assert abs(daily_cost(service) - 0.01) < 1e-9
+    finally:
+        fake.close()
+
+def test_batch_cache_lookup_is_one_query():
+    """Cached detections in a batch are found with a single IN query and then served from memory."""
+    fake = FakeOpenAI(delay=0)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            service = make_service(fake, tmp, detections=8, requests_per_minute=6000)
+            conn = sqlite3.connect(os.path.join(tmp, 'speciesid.db'))
+            conn.executemany("INSERT INTO vision_analysis_cache (detection_id, analysis_data) VALUES (?, ?)",
+                             [(i, json.dumps(ANALYSIS)) for i in range(1, 6)])
+            conn.commit()
+
+            statements = []
+            service.database.call(lambda db: db.set_trace_callback(statements.append))
+            results = asyncio.run(service.batch_process_images(list(range(1, 9)), batch_size=4))
+            assert results == {"processed": 8, "failed": 0, "skipped": 0}, results
+            assert fake.calls == 3
+            lookups = [s for s in statements if s.lstrip().startswith('SELECT') and 'vision_analysis_cache' in s]
+            assert len(lookups) == 1, lookups
+
+            # Recent analyses are answered from memory
+            conn.execute("DELETE FROM vision_analysis_cache")
+            conn.commit()
+            conn.close()
+            assert asyncio.run(service.analyze_image(1, "missing.jpg")) == ANALYSIS
+            assert asyncio.run(service.analyze_image(8, "missing.jpg")) == ANALYSIS
+            service.close()
+    finally:
+        fake.close()
+
+def main():
+    print("Testing VisionService against a fake OpenAI server...")
+    test_batch_limits_concurrency()
+    test_retries_rate_limited_calls()
+    test_batch_stops_at_cost_limit()
+    test_token_bucket_rate()
+    test_process_by_priority_spends_budget_on_top_ranked()
+    test_process_by_priority_ranks_own_database()
+    test_near_duplicate_reuses_analysis()
+    test_batch_cache_lookup_is_one_query()
+    print("✓ VisionService tests passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import time
+from datetime import datetime
+from services.shared.weather_analytics import WeatherAnalytics
+
+def loaded_analytics():
+    """WeatherAnalytics holding 48 UTC hours of weather from 2024-07-01, without a database."""
+    analytics = WeatherAnalytics(refresh_interval=3600)
+    weather = [(f"2024-07-{1 + h // 24:02d} {h % 24:02d}:00:00", 20.0 + h % 5, 50, 3, 0, 40, 1013)
+               for h in range(48)]
+    activity = [("2024-07-01 17:00:00", "Turdus migratorius", 3)]
+    analytics._append(weather, activity)
+    analytics._last_refresh = time.monotonic()
+    return analytics
+
+def test_correlation_window_is_local_time():
+    """The requested end and the returned series are local time, while the grid is UTC."""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'America/Chicago'  # UTC-5 in July
+    time.tzset()
+    try:
+        stats = loaded_analytics().correlation('temperature', days=1, end=datetime(2024, 7, 1, 12))
+        series = stats['series']
+        # Local noon is 17:00 UTC; the window starts at the first hour with weather
+        assert len(series) == 18, len(series)
+        assert series[0]['timestamp'] == '2024-06-30 19:00:00'
+        assert series[-1]['timestamp'] == '2024-07-01 12:00:00'
+        assert series[-1]['detection_count'] == 3
+    finally:
+        if previous is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = previous
+        time.tzset()
+
+def main():
+    print("Testing weather analytics...")
+    test_correlation_window_is_local_time()
+    print("✓ Weather analytics tests passed")
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,299 @@
 import os
 import json
+import random
+import time
 import asyncio
-from typing import Dict, List, Optional
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Optional
 import sqlite3
-from datetime import datetime, timedelta
-from openai import AsyncOpenAI
+from datetime import datetime, date, timedelta
+import cv2
+import numpy as np
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from services.shared.database import DatabaseManager
+from services.shared.perceptual_hash import dhash
+from services.shared.vision_priority import VisionPriorityScheduler
+
+# Errors worth retrying: rate limiting, timeouts, dropped connections and 5xx responses
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+class TokenBucket:
+    """Async rate limiter allowing ``rate`` acquisitions per second, in bursts of up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        # Waiters queue on the lock, so they are served in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class RunningCost:
+    """Today's Vision API spend, kept in memory so budget checks need no database query.
+
+    ``spent`` is the cost of finished calls and ``reserved`` the estimated cost
+    of calls still in flight, so concurrent calls cannot overshoot a limit by
+    more than one estimate. ``reconcile`` resets ``spent`` to the total in
+    vision_api_costs, which also counts other processes' calls.
+    """
+
+    def __init__(self):
+        self.day = date.today()
+        self.spent = 0.0
+        self.reserved = 0.0
+
+    def _roll_over(self) -> None:
+        if date.today() != self.day:
+            self.day = date.today()
+            self.spent = 0.0
+
+    def reserve(self, amount: float, limit: float) -> bool:
+        self._roll_over()
+        # Small tolerance so floating point sums do not reject a call that exactly fits
+        if self.spent + self.reserved + amount > limit + 1e-9:
+            return False
+        self.reserved += amount
+        return True
+
+    def release(self, amount: float) -> None:
+        self.reserved = max(0.0, self.reserved - amount)
+
+    def add(self, cost: float) -> None:
+        self._roll_over()
+        self.spent += cost
+
+    def reconcile(self, spent_today: float) -> None:
+        self._roll_over()
+        self.spent = spent_today
+
+
+class DatabaseThread:
+    """Runs SQLite work on one thread that owns one long-lived connection.
+
+    Each job is a function taking the connection. Async code awaits ``run``,
+    so the event loop never blocks on connecting or querying, and jobs are
+    executed one at a time in submission order. Synchronous code can use
+    ``call``. A job that raises is rolled back and the error is re-raised
+    in the caller.
+    """
+
+    def __init__(self, db_path: str):
+        # Opened here so connection errors surface in the constructor
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="vision-db", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args) -> Future:
+        future = Future()
+        self._jobs.put((fn, args, future))
+        return future
+
+    async def run(self, fn: Callable, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def call(self, fn: Callable, *args):
+        return self.submit(fn, *args).result()
+
+    def close(self) -> None:
+        self._jobs.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                fn, args, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(self._conn, *args))
+                except Exception as e:
+                    self._conn.rollback()
+                    future.set_exception(e)
+        finally:
+            self._conn.close()
+
+
+class AnalysisCache:
+    """vision_analysis_cache, with the ``hot_size`` most recently used analyses kept in memory.
+
+    Reads and writes go through a DatabaseThread. ``get_many`` answers what
+    it can from memory and looks up the rest with one IN query per 500 ids.
+    Misses are not remembered, as another process may add the analysis later.
+    Meant to be used from one event loop at a time.
+    """
+
+    def __init__(self, database: DatabaseThread, hot_size: int = 1024):
+        self.database = database
+        self.hot_size = hot_size
+        # detection_id -> analysis JSON, decoded on every read so callers get their own copy
+        self._hot: "OrderedDict[int, str]" = OrderedDict()
+
+    def _remember(self, detection_id: int, analysis_data: str) -> None:
+        self._hot[detection_id] = analysis_data
+        self._hot.move_to_end(detection_id)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    async def get(self, detection_id: int) -> Optional[Dict]:
+        return (await self.get_many([detection_id])).get(detection_id)
+
+    async def get_many(self, detection_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Cached analyses of the given detections, by detection id. Uncached ids are left out."""
+        found = {}
+        missing = []
+        for detection_id in dict.fromkeys(detection_ids):
+            analysis_data = self._hot.get(detection_id)
+            if analysis_data is None:
+                missing.append(detection_id)
+                continue
+            self._hot.move_to_end(detection_id)
+            found[detection_id] = json.loads(analysis_data)
+        if missing:
+            for detection_id, analysis_data in await self.database.run(self._select, missing):
+                self._remember(detection_id, analysis_data)
+                found[detection_id] = json.loads(analysis_data)
+        return found
+
+    async def put(
+        self,
+        detection_id: int,
+        analysis_data: str,
+        clarity_score: float,
+        composition_score: float,
+        behavior_tags: str,
+        cost_tokens: int
+    ) -> None:
+        """Store an analysis in the database and in memory."""
+        await self.database.run(
+            self._insert, detection_id, analysis_data, clarity_score, composition_score, behavior_tags, cost_tokens
+        )
+        self._remember(detection_id, analysis_data)
+
+    @staticmethod
+    def _select(conn: sqlite3.Connection, detection_ids: List[int]) -> List[tuple]:
+        rows = []
+        # Chunked to stay below SQLite's variable limit
+        for i in range(0, len(detection_ids), 500):
+            chunk = detection_ids[i:i + 500]
+            cursor = conn.execute("""
+                SELECT detection_id, analysis_data
+                FROM vision_analysis_cache
+                WHERE detection_id IN ({})
+            """.format(','.join('?' * len(chunk))), chunk)
+            rows.extend((row['detection_id'], row['analysis_data']) for row in cursor.fetchall())
+        return rows
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, *values) -> None:
+        conn.execute("""
+            INSERT INTO vision_analysis_cache
+            (detection_id, analysis_data, clarity_score, composition_score, behavior_tags, cost_tokens)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, values)
+        conn.commit()
+
 
 class VisionService:
-    def __init__(self, db_path: str = "/data/speciesid.db"):
-        """Initialize the Vision Service with OpenAI client and database connection."""
+    def __init__(
+        self,
+        db_path: str = "/data/speciesid.db",
+        client: Optional[AsyncOpenAI] = None,
+        events_path: str = "/path/to/frigate/events",
+        phash_index=None,
+        max_concurrency: int = 4,
+        requests_per_minute: float = 50,
+        max_retries: int = 4,
+        cost_per_1k_tokens: float = 0.01,
+        cache_size: int = 1024
+    ):
+        """Initialize the Vision Service with OpenAI client and database connection.
+
+        Args:
+            db_path: SQLite database holding the cache and cost tables
+            client: OpenAI client to use, e.g. one pointed at a local fake server
+            events_path: Directory holding <frigate event>/snapshot.jpg
+            phash_index: A services.shared.perceptual_hash.PerceptualHashIndex over the
+                same database; when given, near-duplicate snapshots reuse an existing
+                analysis instead of a new call
+            max_concurrency: Maximum API calls in flight at once
+            requests_per_minute: Average API request rate, with bursts of max_concurrency
+            max_retries: Retries for rate limited, timed out or failed calls
+            cost_per_1k_tokens: Price used for cost tracking
+            cache_size: Number of recent analyses kept in memory
+        """
         self.db_path = db_path
-        self.client = AsyncOpenAI()
-        self._setup_database()
+        # Retries are done here, with the rate limiter, rather than inside the client
+        self.client = client or AsyncOpenAI(max_retries=0)
+        self.events_path = events_path
+        self.phash_index = phash_index
+        self.max_retries = max_retries
+        self.cost_per_1k_tokens = cost_per_1k_tokens
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._rate_limit = TokenBucket(requests_per_minute / 60, max_concurrency)
+        self.costs = RunningCost()
+        # Expected cost of one analysis, updated from actual usage
+        self.cost_estimate = cost_per_1k_tokens
+        # All database access happens on this thread, off the event loop
+        self.database = DatabaseThread(db_path)
+        self.cache = AnalysisCache(self.database, cache_size)
+        # Ranking queries go through SQLAlchemy; one engine is shared by every scheduler
+        self._scheduler_database = DatabaseManager(db_path)
+        self.database.call(self._setup_database)
+        self.costs.reconcile(self.database.call(self._spent_today))
 
-    def _get_db_connection(self) -> sqlite3.Connection:
-        """Create a database connection."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def close(self) -> None:
+        """Stop the database thread and close its connection."""
+        self.database.close()
 
-    def _setup_database(self) -> None:
+    @staticmethod
+    def _setup_database(conn: sqlite3.Connection) -> None:
         """Ensure required tables exist."""
-        conn = self._get_db_connection()
-        try:
-            # Create cache table for API responses
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS vision_analysis_cache (
-                    detection_id INTEGER PRIMARY KEY,
-                    analysis_data TEXT,  -- JSON string of OpenAI response
-                    clarity_score REAL,
-                    composition_score REAL,
-                    behavior_tags TEXT,  -- JSON array of behaviors
-                    cost_tokens INTEGER,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (detection_id) REFERENCES detections(id)
-                )
-            """)
-            
-            # Create cost tracking table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS vision_api_costs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    date DATE,
-                    total_tokens INTEGER,
-                    total_cost REAL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            conn.commit()
-        finally:
-            conn.close()
+        # Create cache table for API responses
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS vision_analysis_cache (
+                detection_id INTEGER PRIMARY KEY,
+                analysis_data TEXT,  -- JSON string of OpenAI response
+                clarity_score REAL,
+                composition_score REAL,
+                behavior_tags TEXT,  -- JSON array of behaviors
+                cost_tokens INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (detection_id) REFERENCES detections(id)
+            )
+        """)
+        
+        # Create cost tracking table
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS vision_api_costs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date DATE UNIQUE,
+                total_tokens INTEGER,
+                total_cost REAL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        conn.commit()
 
     async def analyze_image(self, detection_id: int, image_path: str) -> Optional[Dict]:
         """
@@ -64,18 +307,26 @@ class VisionService:
             Dict containing analysis results or None if analysis fails
         """
         # Check cache first
-        cached = self._get_cached_analysis(detection_id)
+        cached = await self.cache.get(detection_id)
         if cached:
             return cached
+        return await self._analyze(detection_id, image_path)
 
+    async def _analyze(self, detection_id: int, image_path: str) -> Optional[Dict]:
+        """Call the Vision API for an uncached image and cache the result."""
         try:
             # Prepare the image
             with open(image_path, 'rb') as image_file:
                 # TODO: Convert image to base64 if needed
                 image_data = image_file.read()
 
+            # A near-identical snapshot from the same visit may already be paid for
+            reused = await self._reuse_duplicate_analysis(detection_id, image_data)
+            if reused is not None:
+                return reused
+
             # Analyze with OpenAI
-            response = await self.client.chat.completions.create(
+            response = await self._create_completion(
                 model="gpt-4-vision-preview",
                 messages=[
                     {
@@ -113,11 +364,14 @@ class VisionService:
                 max_tokens=1000
             )
 
+            # Tokens are paid for even if the response turns out to be unusable
+            await self._record_cost(response.usage.total_tokens)
+
             # Parse response
             analysis = json.loads(response.choices[0].message.content)
             
             # Cache results
-            self._cache_analysis(
+            await self.cache.put(
                 detection_id=detection_id,
                 analysis_data=response.choices[0].message.content,
                 clarity_score=analysis['clarity_score'],
@@ -132,63 +386,103 @@ class VisionService:
             print(f"Error analyzing image: {e}")
             return None
 
-    def _get_cached_analysis(self, detection_id: int) -> Optional[Dict]:
-        """Get cached analysis results if they exist."""
-        conn = self._get_db_connection()
-        try:
-            cursor = conn.execute("""
-                SELECT analysis_data
-                FROM vision_analysis_cache
-                WHERE detection_id = ?
-            """, (detection_id,))
-            result = cursor.fetchone()
-            if result:
-                return json.loads(result['analysis_data'])
+    async def _reuse_duplicate_analysis(self, detection_id: int, image_data: bytes) -> Optional[Dict]:
+        """Index the snapshot's perceptual hash and copy the analysis of a near-duplicate, if any."""
+        if self.phash_index is None:
             return None
-        finally:
-            conn.close()
-
-    def _cache_analysis(
-        self,
-        detection_id: int,
-        analysis_data: str,
-        clarity_score: float,
-        composition_score: float,
-        behavior_tags: str,
-        cost_tokens: int
-    ) -> None:
-        """Cache analysis results and update cost tracking."""
-        conn = self._get_db_connection()
         try:
-            # Cache analysis
-            conn.execute("""
-                INSERT INTO vision_analysis_cache
-                (detection_id, analysis_data, clarity_score, composition_score, behavior_tags, cost_tokens)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                detection_id,
-                analysis_data,
-                clarity_score,
-                composition_score,
-                behavior_tags,
-                cost_tokens
-            ))
-
-            # Update cost tracking
-            today = datetime.now().date()
-            cost = (cost_tokens / 1000) * 0.01  # $0.01 per 1K tokens
-            
+            # Decoding and the index's database queries block, so they run off the event loop
+            duplicates = await asyncio.to_thread(self._near_duplicates, detection_id, image_data)
+            if not duplicates:
+                return None
+            cached = await self.cache.get_many(duplicates)
+            for other_id in duplicates:
+                analysis = cached.get(other_id)
+                if analysis is None:
+                    continue
+                await self.cache.put(
+                    detection_id=detection_id,
+                    analysis_data=json.dumps(analysis),
+                    clarity_score=analysis['clarity_score'],
+                    composition_score=analysis['composition_score'],
+                    behavior_tags=json.dumps(analysis['behaviors']),
+                    cost_tokens=0
+                )
+                print(f"Reused vision analysis of near-duplicate detection {other_id} for {detection_id}")
+                return analysis
+        except Exception as e:
+            print(f"Error checking for near-duplicate analyses: {e}")
+        return None
+
+    def _near_duplicates(self, detection_id: int, image_data: bytes) -> List[int]:
+        """Add the snapshot's hash to the index and return near-duplicate detections, closest first."""
+        # A quarter-size decode is plenty for an 8x9 hash
+        image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        if image is None:
+            return []
+        phash = dhash(image)
+        self.phash_index.add(detection_id, phash)
+        return self.phash_index.near_duplicates(detection_id, phash)
+
+    async def _create_completion(self, **kwargs):
+        """Make a chat completion request within the rate and concurrency limits, retrying transient errors."""
+        for attempt in range(self.max_retries + 1):
+            await self._rate_limit.acquire()
+            async with self._semaphore:
+                try:
+                    return await self.client.chat.completions.create(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    if attempt == self.max_retries:
+                        raise
+                    error = e
+            # Back off outside the semaphore so other calls can use the slot
+            delay = self._retry_delay(error, attempt)
+            print(f"Vision API call failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_delay(error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying: the server's Retry-After if given, else jittered exponential backoff."""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), 60.0)
+            except ValueError:
+                pass
+        return min(2 ** attempt, 30.0) * random.uniform(0.5, 1.0)
+
+    async def _record_cost(self, tokens: int) -> None:
+        """Add a call's cost to the running total and to vision_api_costs."""
+        cost = (tokens / 1000) * self.cost_per_1k_tokens
+        self.costs.add(cost)
+        # Move the per-call estimate towards what calls actually cost
+        self.cost_estimate = 0.8 * self.cost_estimate + 0.2 * cost
+
+        def do_insert(conn):
             conn.execute("""
                 INSERT INTO vision_api_costs (date, total_tokens, total_cost)
                 VALUES (?, ?, ?)
                 ON CONFLICT (date) DO UPDATE SET
                     total_tokens = total_tokens + excluded.total_tokens,
                     total_cost = total_cost + excluded.total_cost
-            """, (today, cost_tokens, cost))
-            
+            """, (datetime.now().date(), tokens, cost))
             conn.commit()
-        finally:
-            conn.close()
+        await self.database.run(do_insert)
+
+    @staticmethod
+    def _spent_today(conn: sqlite3.Connection) -> float:
+        cursor = conn.execute("""
+            SELECT COALESCE(SUM(total_cost), 0) as daily_cost
+            FROM vision_api_costs
+            WHERE date = ?
+        """, (datetime.now().date(),))
+        return cursor.fetchone()['daily_cost']
+
+    async def reconcile_costs(self) -> float:
+        """Reset the running cost to today's total in vision_api_costs and return it."""
+        self.costs.reconcile(await self.database.run(self._spent_today))
+        return self.costs.spent
 
     async def batch_process_images(
         self,
@@ -197,87 +491,120 @@ class VisionService:
         cost_limit: float = 5.0
     ) -> Dict[str, int]:
         """
-        Process multiple images in batches with cost control.
+        Process multiple images with a pool of workers under a daily cost limit.
+
+        Each worker takes the next detection as soon as its previous one is
+        done, so a slow call only holds up its own worker. Before every paid
+        call the worker reserves the expected cost against the running daily
+        total, and stops once the limit would be exceeded.
         
         Args:
             detection_ids: List of detection IDs to process
             batch_size: Number of images to process in parallel
-            cost_limit: Maximum cost in USD for this batch
+            cost_limit: Maximum daily cost in USD
             
         Returns:
-            Dict with success and failure counts
+            Dict with processed, failed and skipped counts
         """
-        # Check today's costs
-        conn = self._get_db_connection()
-        try:
-            cursor = conn.execute("""
-                SELECT COALESCE(SUM(total_cost), 0) as daily_cost
-                FROM vision_api_costs
-                WHERE date = DATE('now')
-            """)
-            daily_cost = cursor.fetchone()['daily_cost']
-            
-            if daily_cost >= cost_limit:
-                print(f"Daily cost limit reached: ${daily_cost:.2f}")
-                return {"processed": 0, "skipped": len(detection_ids)}
-        finally:
-            conn.close()
+        results = {"processed": 0, "failed": 0, "skipped": 0}
+        if await self.reconcile_costs() >= cost_limit:
+            print(f"Daily cost limit reached: ${self.costs.spent:.2f}")
+            results["skipped"] = len(detection_ids)
+            return results
 
-        results = {"processed": 0, "skipped": 0}
-        
-        # Process in batches
-        for i in range(0, len(detection_ids), batch_size):
-            batch = detection_ids[i:i + batch_size]
-            
-            # Get image paths for batch
-            conn = self._get_db_connection()
-            try:
-                cursor = conn.execute("""
-                    SELECT id, frigate_event
-                    FROM detections
-                    WHERE id IN ({})
-                """.format(','.join('?' * len(batch))), batch)
-                images = cursor.fetchall()
-            finally:
-                conn.close()
-
-            # Process batch in parallel
-            tasks = []
-            for img in images:
-                image_path = f"/path/to/frigate/events/{img['frigate_event']}/snapshot.jpg"
-                if os.path.exists(image_path):
-                    tasks.append(self.analyze_image(img['id'], image_path))
-                else:
-                    results["skipped"] += 1
+        events = await self.database.run(self._get_frigate_events, detection_ids)
+        # One query for the whole batch instead of one per detection
+        cached = await self.cache.get_many(detection_ids)
+        pending = deque(detection_ids)
+        limit_reached = False
 
-            if tasks:
-                batch_results = await asyncio.gather(*tasks)
-                results["processed"] += sum(1 for r in batch_results if r is not None)
-                results["skipped"] += sum(1 for r in batch_results if r is None)
+        async def worker():
+            nonlocal limit_reached
+            while pending and not limit_reached:
+                detection_id = pending.popleft()
+                if detection_id not in events:
+                    results["skipped"] += 1
+                    continue
+                if detection_id in cached:
+                    results["processed"] += 1
+                    continue
+                image_path = os.path.join(self.events_path, events[detection_id], "snapshot.jpg")
+                if not os.path.exists(image_path):
+                    results["skipped"] += 1
+                    continue
 
-            # Check cost after each batch
-            conn = self._get_db_connection()
-            try:
-                cursor = conn.execute("""
-                    SELECT COALESCE(SUM(total_cost), 0) as daily_cost
-                    FROM vision_api_costs
-                    WHERE date = DATE('now')
-                """)
-                daily_cost = cursor.fetchone()['daily_cost']
-                
-                if daily_cost >= cost_limit:
-                    print(f"Cost limit reached after processing {results['processed']} images")
-                    results["skipped"] += len(detection_ids) - (i + batch_size)
+                estimate = self.cost_estimate
+                if not self.costs.reserve(estimate, cost_limit):
+                    limit_reached = True
+                    pending.appendleft(detection_id)
                     break
-            finally:
-                conn.close()
+                try:
+                    analysis = await self._analyze(detection_id, image_path)
+                finally:
+                    self.costs.release(estimate)
+                results["processed" if analysis is not None else "failed"] += 1
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(batch_size, len(detection_ids))))))
 
+        if limit_reached:
+            print(f"Cost limit reached after processing {results['processed']} images")
+        results["skipped"] += len(pending)
         return results
 
+    def priority_scheduler(self, **kwargs) -> VisionPriorityScheduler:
+        """A VisionPriorityScheduler that ranks detections in this service's database."""
+        return VisionPriorityScheduler(database=self._scheduler_database, **kwargs)
+
+    async def process_by_priority(
+        self,
+        scheduler=None,
+        batch_size: int = 10,
+        cost_limit: float = 5.0,
+        days: int = 7
+    ) -> Dict[str, int]:
+        """
+        Spend what is left of today's budget on the highest-value detections first.
+
+        Args:
+            scheduler: A VisionPriorityScheduler over the same database as db_path;
+                defaults to priority_scheduler()
+            batch_size: Number of images to process in parallel
+            cost_limit: Maximum daily cost in USD
+            days: How far back to look for unanalysed detections
+
+        Returns:
+            Dict with processed, failed and skipped counts
+        """
+        if scheduler is None:
+            scheduler = self.priority_scheduler()
+        remaining = cost_limit - await self.reconcile_costs()
+        affordable = int(remaining / self.cost_estimate + 1e-9) if remaining > 0 else 0
+        # Rank a few extra in case some snapshots are missing
+        candidates = []
+        if affordable:
+            # Ranking queries the database and may score snapshots, so keep it off the event loop
+            candidates = await asyncio.to_thread(scheduler.rank, days=days, limit=affordable + batch_size)
+        return await self.batch_process_images(
+            [c.detection_id for c in candidates], batch_size=batch_size, cost_limit=cost_limit
+        )
+
+    @staticmethod
+    def _get_frigate_events(conn: sqlite3.Connection, detection_ids: List[int]) -> Dict[int, str]:
+        """Map detection ids to their Frigate event ids, querying in chunks below SQLite's variable limit."""
+        events = {}
+        for i in range(0, len(detection_ids), 500):
+            chunk = detection_ids[i:i + 500]
+            cursor = conn.execute("""
+                SELECT id, frigate_event
+                FROM detections
+                WHERE id IN ({})
+            """.format(','.join('?' * len(chunk))), chunk)
+            events.update((row['id'], row['frigate_event']) for row in cursor.fetchall())
+        return events
+
     def get_daily_costs(self, days: int = 30) -> List[Dict]:
         """Get cost tracking data for the last N days."""
-        conn = self._get_db_connection()
-        try:
+        def do_query(conn):
             cursor = conn.execute("""
                 SELECT 
                     date,
@@ -289,5 +616,4 @@ class VisionService:
             """, (f'-{days} days',))
             
             return [dict(row) for row in cursor.fetchall()]
-        finally:
-            conn.close()
+        return self.database.call(do_query)